@@ -39,10 +39,18 @@ class MyConfigParser(ConfigParser):
                        's3:List*'],
             "Resource": arn,
             'Effect': 'Allow'}
+        # Instances publish their bootstrap progress under bootstrap/
+        marker_arn = Join("", ["arn:aws:s3:::", Ref(salt_bucket),
+                               "/bootstrap/*"])
+        bootstrap_marker_policy = {
+            'Action': ['s3:PutObject'],
+            "Resource": marker_arn,
+            'Effect': 'Allow'}
         salt_role_policy = PolicyType(
             "S3SaltPolicy",
             PolicyName="S3SaltPolicy",
-            PolicyDocument={"Statement": [salt_bucket_policy]},
+            PolicyDocument={"Statement": [salt_bucket_policy,
+                                          bootstrap_marker_policy]},
             Roles=[Ref("BaseHostRole")],
         )
         ret.add_resource(salt_role_policy)
@@ -77,6 +85,7 @@ class MyConfigParser(ConfigParser):
 
         bs_path = pkgutil.get_loader('bootstrap_salt').filename
         script = os.path.join(bs_path, './contrib/bootstrap.sh')
+        report_script = os.path.join(bs_path, './contrib/bootstrap_report.py')
         files = {'write_files': [{'encoding': 'b64',
                                   'content': self.kms_data_key,
                                   'owner': 'root:root',
@@ -85,8 +94,14 @@ class MyConfigParser(ConfigParser):
                                  {'content': open(script).read(),
                                   'owner': 'root:root',
                                   'path': '{}/bootstrap.sh'.format(env.bootstrap_script_path),
+                                  'permissions': '0700'},
+                                 {'content': open(report_script).read(),
+                                  'owner': 'root:root',
+                                  'path': '{}/bootstrap_report.py'.format(env.bootstrap_script_path),
                                   'permissions': '0700'}]}
-        commands = {'runcmd': ['{}/bootstrap.sh v{}'.format(env.bootstrap_script_path, self.__version__)]}
+        commands = {'runcmd': ['{}/bootstrap.sh v{} {}-salt'.format(env.bootstrap_script_path,
+                                                                    self.__version__,
+                                                                    self.stack_name)]}
         ret.append({
             'content': yaml.dump(commands),
             'mime_type': 'text/cloud-config'
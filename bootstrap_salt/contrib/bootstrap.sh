@@ -1,8 +1,40 @@
 #!/bin/bash
 REVISION=$1
+SALT_BUCKET=$2
+STARTED=$(date +%s)
+REPORT="$(dirname $0)/bootstrap_report.py"
+LOG=/var/log/bootstrap-salt.log
+STAGE=ssh-up
+exec > >(tee -a $LOG) 2>&1
+
+report() {
+    if [ -n "$SALT_BUCKET" ]; then
+        # Reporting is best effort and must not trigger the ERR trap
+        python $REPORT $SALT_BUCKET "$@" --started $STARTED || true
+    fi
+}
+
+stage_done() {
+    report $STAGE
+    STAGE=$1
+}
+
+fail() {
+    EXIT_CODE=$?
+    trap - ERR
+    echo "bootstrap.sh: failed in stage $STAGE with exit code $EXIT_CODE"
+    { echo "$STAGE"; tail -n 50 $LOG; } > /tmp/bootstrap_failed
+    report failed --exit-code $EXIT_CODE --failed-stage $STAGE --log $LOG
+    exit $EXIT_CODE
+}
+set -o errtrace
+trap fail ERR
+
+stage_done packages
 wget https://raw.githubusercontent.com/saltstack/salt-bootstrap/6080a18e6c7c2d49335978fa69fa63645b45bc2a/bootstrap-salt.sh -O /tmp/bootstrap-salt.sh
 chmod 700 /tmp/bootstrap-salt.sh
-apt-get update && apt-get -y install python-pip git python-dev
+apt-get update
+apt-get -y install python-pip git python-dev
 pip install boto
 pip install gnupg
 pip install --pre github3.py
@@ -11,7 +43,15 @@ cd /tmp
 git clone --depth 1 --branch $REVISION https://github.com/ministryofjustice/bootstrap-salt.git
 cd ./bootstrap-salt/bootstrap_salt
 cp -Lrf ./contrib/* /
+stage_done salt-installed
 /tmp/bootstrap-salt.sh git v2014.7.5
 salt-call saltutil.sync_all
-/usr/local/bin/salt_utils.py -s highstate
+stage_done highstated
+# A failed initial highstate doesn't fail the bootstrap, its exit code is
+# reported with the done marker
+HIGHSTATE_EXIT_CODE=0
+/usr/local/bin/salt_utils.py -s highstate || HIGHSTATE_EXIT_CODE=$?
+stage_done done
+trap - ERR
 touch /tmp/bootstrap_done
+report done --exit-code $HIGHSTATE_EXIT_CODE
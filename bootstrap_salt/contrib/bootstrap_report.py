@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+Publish bootstrap progress markers to the stack's salt bucket.
+
+bootstrap.sh runs this before boto or anything else has been installed, so
+it only uses the standard library. Requests are signed with the instance
+role's credentials from the metadata service, or with the AWS_* environment
+variables if they are set.
+
+Markers are written to bootstrap/<instance-id>/<stage>, so that
+wait_for_minions can see the progress of every instance with a single
+listing of the bucket. The stages are ssh-up, packages, salt-installed,
+highstated and done, or failed if the bootstrap script fails.
+"""
+import argparse
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import sys
+import time
+import urllib
+import urllib2
+
+METADATA_URL = 'http://169.254.169.254/latest/meta-data/'
+MARKER_PREFIX = 'bootstrap'
+
+
+def get_metadata(path):
+    return urllib2.urlopen(METADATA_URL + path, timeout=5).read()
+
+
+def get_credentials():
+    """
+    Returns:
+        (tuple): The access key, secret key and session token, which may be
+            None
+    """
+    if os.environ.get('AWS_ACCESS_KEY_ID'):
+        return (os.environ['AWS_ACCESS_KEY_ID'],
+                os.environ['AWS_SECRET_ACCESS_KEY'],
+                os.environ.get('AWS_SESSION_TOKEN'))
+    role = get_metadata('iam/security-credentials/').splitlines()[0]
+    creds = json.loads(get_metadata('iam/security-credentials/' + role))
+    return creds['AccessKeyId'], creds['SecretAccessKey'], creds['Token']
+
+
+def get_region():
+    if os.environ.get('AWS_DEFAULT_REGION'):
+        return os.environ['AWS_DEFAULT_REGION']
+    return get_metadata('placement/availability-zone')[:-1]
+
+
+def sign(key, msg):
+    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()
+
+
+def put_object(endpoint, region, bucket, key, body, credentials, now=None):
+    """
+    Upload an object to S3 with a signature version 4 PUT request.
+
+    Args:
+        endpoint(string): The S3 endpoint, e.g. https://s3.eu-west-1.amazonaws.com
+        region(string): The bucket's region
+        bucket(string): The bucket name
+        key(string): The object key
+        body(string): The object contents
+        credentials(tuple): The access key, secret key and session token
+        now(datetime): The time to sign the request with, defaults to now
+    """
+    access_key, secret_key, token = credentials
+    now = now or datetime.datetime.utcnow()
+    amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+    date_stamp = now.strftime('%Y%m%d')
+    host = endpoint.split('://', 1)[-1].rstrip('/')
+    uri = '/{0}/{1}'.format(bucket, urllib.quote(key, safe='/~'))
+    payload_hash = hashlib.sha256(body).hexdigest()
+
+    headers = {'host': host,
+               'x-amz-content-sha256': payload_hash,
+               'x-amz-date': amz_date}
+    if token:
+        headers['x-amz-security-token'] = token
+    signed_headers = ';'.join(sorted(headers))
+    canonical_request = '\n'.join([
+        'PUT', uri, '',
+        ''.join('{0}:{1}\n'.format(name, headers[name])
+                for name in sorted(headers)),
+        signed_headers, payload_hash])
+
+    scope = '{0}/{1}/s3/aws4_request'.format(date_stamp, region)
+    string_to_sign = '\n'.join([
+        'AWS4-HMAC-SHA256', amz_date, scope,
+        hashlib.sha256(canonical_request).hexdigest()])
+    signing_key = sign(('AWS4' + secret_key).encode('utf-8'), date_stamp)
+    for part in (region, 's3', 'aws4_request'):
+        signing_key = sign(signing_key, part)
+    signature = hmac.new(signing_key, string_to_sign.encode('utf-8'),
+                         hashlib.sha256).hexdigest()
+    headers['Authorization'] = (
+        'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, '
+        'Signature={3}'.format(access_key, scope, signed_headers, signature))
+    headers['Content-Type'] = 'application/json'
+
+    request = urllib2.Request(endpoint.rstrip('/') + uri, data=body,
+                              headers=headers)
+    request.get_method = lambda: 'PUT'
+    urllib2.urlopen(request, timeout=30).read()
+
+
+def build_marker(instance_id, stage, exit_code=None, started=None,
+                 log_file=None, log_lines=50, failed_stage=None, now=None):
+    """
+    Returns:
+        (dict): The marker contents: the instance, stage, exit code,
+            timings, the stage that failed if any and, if a log file is
+            given, the tail of the log
+    """
+    now = now or time.time()
+    marker = {'instance_id': instance_id,
+              'stage': stage,
+              'exit_code': exit_code,
+              'reported': now}
+    if failed_stage:
+        marker['failed_stage'] = failed_stage
+    if started is not None:
+        marker['started'] = started
+        marker['duration'] = now - started
+    if log_file:
+        try:
+            with open(log_file) as log:
+                marker['log_tail'] = log.readlines()[-log_lines:]
+        except IOError:
+            pass
+    return marker
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Publish a bootstrap progress marker to the salt bucket')
+    parser.add_argument('bucket', help='The stack salt bucket')
+    parser.add_argument('stage', help='The bootstrap stage reached')
+    parser.add_argument('--exit-code', dest='exit_code', type=int,
+                        default=None)
+    parser.add_argument('--started', dest='started', type=float,
+                        help='Unix time the bootstrap started', default=None)
+    parser.add_argument('--log', dest='log_file', default=None,
+                        help='Log file to include the tail of')
+    parser.add_argument('--failed-stage', dest='failed_stage', default=None,
+                        help='The stage the bootstrap failed in')
+    parser.add_argument('--instance-id', dest='instance_id', default=None)
+    parser.add_argument('--endpoint', dest='endpoint', default=None,
+                        help='S3 endpoint, for testing against a stand-in')
+    args = parser.parse_args(argv)
+
+    instance_id = args.instance_id or get_metadata('instance-id')
+    region = get_region()
+    endpoint = args.endpoint or 'https://s3.{0}.amazonaws.com'.format(region)
+    marker = build_marker(instance_id, args.stage, exit_code=args.exit_code,
+                          started=args.started, log_file=args.log_file,
+                          failed_stage=args.failed_stage)
+    key = '{0}/{1}/{2}'.format(MARKER_PREFIX, instance_id, args.stage)
+    try:
+        put_object(endpoint, region, args.bucket, key, json.dumps(marker),
+                   get_credentials())
+    except (urllib2.URLError, IOError, ValueError, KeyError) as err:
+        # Reporting is best effort, it must never break the bootstrap
+        sys.stderr.write('bootstrap_report: could not publish {0}: {1}\n'
+                         .format(key, err))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
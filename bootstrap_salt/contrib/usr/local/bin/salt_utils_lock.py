@@ -0,0 +1 @@
+../../../../salt_utils_lock.py
\ No newline at end of file
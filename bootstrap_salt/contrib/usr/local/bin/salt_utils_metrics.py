@@ -0,0 +1 @@
+../../../../salt_utils_metrics.py
\ No newline at end of file
@@ -0,0 +1 @@
+../../../../sls_index.py
\ No newline at end of file
@@ -1,8 +1,11 @@
 import boto.ec2
+import logging
 import cloudformation
 import ssh
 import utils
 
+STACK_NAME_TAG = 'aws:cloudformation:stack-name'
+
 
 class EC2:
 
@@ -31,6 +34,26 @@ class EC2:
         return [x.ip_address for x in
                 self.conn_ec2.get_only_instances(instance_ids=instance_id_list)]
 
+    def get_stack_instance_placements(self, stack_name):
+        instance_ids = self.cfn.get_stack_instance_ids(stack_name)
+        return self.get_instance_placements(instance_ids)
+
+    def get_instance_placements(self, instance_id_list):
+        """
+        Get where each instance is running, from the same DescribeInstances
+        call as get_instance_public_ips.
+
+        Returns:
+            (list): A dict for each instance with its public 'ip', 'az' and
+                'asg', the name of its autoscaling group or None
+        """
+        if not instance_id_list:
+            return []
+        return [{'ip': x.ip_address,
+                 'az': x.placement,
+                 'asg': x.tags.get('aws:autoscaling:groupName')}
+                for x in self.conn_ec2.get_only_instances(instance_ids=instance_id_list)]
+
     def get_instance_private_ips(self, instance_id_list):
         if not instance_id_list:
             return []
@@ -58,33 +81,108 @@ class EC2:
         resv = self.conn_ec2.get_all_reservations([inst_id])
         return [i for r in resv for i in r.instances][0] if resv else None
 
-    def is_ssh_up_on_all_instances(self, stack_id):
+    def is_ssh_up_on_all_instances(self, stack_id, up=None):
         """
         Returns False if no instances found
         Returns False if any instance is not available over SSH
         Returns True if all found instances available over SSH
+
+        The instances are probed at the same time. Instances in up have
+        already been found to be available and aren't probed again; up is
+        updated with any more that are.
         """
         instances = self.get_instance_public_ips(
             self.cfn.get_stack_instance_ids(stack_id))
         if not instances:
             return False
-        if all([ssh.is_ssh_up(i) for i in instances]):
+        up = set() if up is None else up
+        up.update(ssh.probe_ssh([i for i in instances if i not in up]))
+        if all([i in up for i in instances]):
             return True
         return False
 
-    def wait_for_ssh(self, stack_id, timeout=300, interval=30):
-        return utils.timeout(timeout, interval)(
-            self.is_ssh_up_on_all_instances)(stack_id)
+    def wait_for_ssh(self, stack_id, timeout=300, interval=5, max_interval=30):
+        """
+        Wait for SSH to be up on every instance in the stack. The first
+        retry comes after a second, then the wait between checks starts at
+        interval and backs off, with jitter, up to max_interval.
+
+        Raises:
+            CfnTimeoutError: if SSH isn't up everywhere within the timeout
+        """
+        up = set()
+
+        def log_progress(attempt, elapsed, duration, result):
+            logging.info("wait_for_ssh: {0} instances up after {1:.0f}s "
+                         "(check {2} took {3:.1f}s)"
+                         .format(len(up), elapsed, attempt, duration))
+
+        return utils.timeout(timeout, interval, backoff=1.5,
+                             max_interval=max_interval, jitter=0.1,
+                             first_interval=min(1, interval),
+                             on_attempt=log_progress)(
+            self.is_ssh_up_on_all_instances)(stack_id, up)
 
     def get_all_stack_ips(self):
+        """
+        Returns:
+            (dict): The stack name of every running stack instance in the
+                region, by public IP
+        """
+        return dict((ip, stack_name)
+                    for stack_name, ips in self.get_stack_hosts_index().items()
+                    for ip in ips)
+
+    def get_stack_hosts_index(self):
+        """
+        Find every running instance in the region that belongs to a
+        CloudFormation stack. The instances are filtered on the stack tag
+        by EC2, and boto follows each page of results, so the scan is
+        complete however many instances there are.
+
+        Returns:
+            (dict): The public IPs of the instances of each stack. Instances
+                without a public IP are left out.
+        """
         instance_filter = {
-            'instance-state-name': 'running'
+            'instance-state-name': 'running',
+            'tag-key': STACK_NAME_TAG
         }
         instances = self.conn_ec2.get_only_instances(filters=instance_filter,
-                                                     max_results=200)
-
-        required_tag = "aws:cloudformation:stack-name"
-        eligible = {i.ip_address: i.tags[required_tag]
-                    for i in instances if required_tag in i.tags}
-
-        return eligible
+                                                     max_results=1000)
+        index = {}
+        for instance in instances:
+            if instance.ip_address and STACK_NAME_TAG in instance.tags:
+                index.setdefault(instance.tags[STACK_NAME_TAG], []).append(
+                    instance.ip_address)
+        return index
+
+
+def get_stack_hosts_index(aws_profile_name, regions):
+    """
+    Find the running instances of every stack in several regions, scanning
+    the regions at the same time.
+
+    Args:
+        aws_profile_name(string): The AWS profile
+        regions(list): The regions to scan
+
+    Returns:
+        (dict): For each stack, its 'region' and the public IPs of its
+            'hosts'
+
+    Raises:
+        Exception: the error from any region that couldn't be scanned, so
+            that the index is never silently incomplete
+    """
+    def scan(region):
+        return EC2(aws_profile_name, region).get_stack_hosts_index()
+
+    results = utils.run_concurrently(scan, regions, pool_size=len(regions) or 1)
+    index = {}
+    for region in regions:
+        if isinstance(results[region], BaseException):
+            raise results[region]
+        for stack_name, hosts in results[region].items():
+            index[stack_name] = {'region': region, 'hosts': hosts}
+    return index
@@ -3,6 +3,7 @@ import sys
 
 class BootstrapCfnError(Exception):
     def __init__(self, msg):
+        super(BootstrapCfnError, self).__init__(msg)
         print >> sys.stderr, "[ERROR] {0}: {1}".format(self.__class__.__name__, msg)
 
 
@@ -29,6 +30,58 @@ class ProfileNotFoundError(BootstrapCfnError):
         )
 
 
+class BootstrapError(BootstrapCfnError):
+    def __init__(self, host, stage, log_tail=None):
+        self.host = host
+        self.stage = stage
+        self.log_tail = log_tail or []
+        super(BootstrapError, self).__init__(
+            "Bootstrap failed on {0} during stage '{1}':\n{2}".format(
+                host, stage, ''.join(self.log_tail))
+        )
+
+
+class RemoteCommandError(BootstrapCfnError):
+    def __init__(self, host, command, return_code, output):
+        self.host = host
+        self.command = command
+        self.return_code = return_code
+        self.output = output
+        super(RemoteCommandError, self).__init__(
+            "'{0}' failed on {1} with exit code {2}:\n{3}".format(
+                command, host, return_code, output)
+        )
+
+
+class LocalCommandError(BootstrapCfnError):
+    def __init__(self, command, return_code):
+        self.command = command
+        self.return_code = return_code
+        super(LocalCommandError, self).__init__(
+            "'{0}' failed with exit code {1}".format(command, return_code)
+        )
+
+
+class HostTimeoutError(BootstrapCfnError):
+    def __init__(self, host, timeout):
+        self.host = host
+        self.timeout = timeout
+        super(HostTimeoutError, self).__init__(
+            "{0} did not finish within {1}s".format(host, timeout)
+        )
+
+
+class RolloutError(BootstrapCfnError):
+    def __init__(self, hosts, results):
+        self.hosts = hosts
+        self.results = results
+        super(RolloutError, self).__init__(
+            "Rollout did not complete on {0} hosts: {1}".format(
+                len(hosts), ', '.join('{0} ({1})'.format(host, results[host])
+                                      for host in hosts))
+        )
+
+
 class SaltStateError(BootstrapCfnError):
     pass
 
@@ -14,19 +14,28 @@ import pkgutil
 import gnupg
 import base64
 import shutil
+import socket
+import time
 
 import bootstrap_cfn.config as config
 from fabric.api import env, execute, parallel, task, \
-    local, get, settings, sudo
-from fabric.contrib import files
+    local, settings
 import fabric.decorators
 from fabric.exceptions import NetworkError
+from paramiko import SSHException
 from bootstrap_cfn.fab_tasks import _validate_fabric_env, \
     get_stack_name, get_basic_config, cfn_create, cfn_delete, cfn_update
 
-from ec2 import EC2
+from ec2 import EC2, get_stack_hosts_index
 from bootstrap_salt.kms import KMS
+import bootstrap_salt.rolling as rolling
+from bootstrap_salt.s3 import S3
+import bootstrap_salt.errors as errors
+from bootstrap_salt.fleet import FleetExecutor
+from bootstrap_salt.inventory import NON_TERMINATED, RUNNING, StackInventory
+import bootstrap_salt.ssh as ssh
 import bootstrap_salt.utils as utils
+import bootstrap_salt.sls_index as sls_index
 from bootstrap_salt.config import MyConfigParser
 
 from .deploy_lib import github
@@ -54,6 +63,25 @@ env.cloudformation_parser = MyConfigParser
 env.bootstrap_script_path = '/usr/local/bin'
 env.bootstrap_tmp_path = '/tmp'
 
+# Seconds to cache stack inventories on disk between fab runs, set with
+# fab --set inventory_cache_ttl=60
+env.inventory_cache_ttl = 0
+
+# The stack inventories of this fab run, by profile, region and stack name
+inventories = {}
+
+# Where bootstrap.sh publishes its progress markers in the salt bucket, and
+# the stages it reports in order
+BOOTSTRAP_MARKER_PREFIX = 'bootstrap/'
+BOOTSTRAP_STAGES = ['ssh-up', 'packages', 'salt-installed', 'highstated', 'done']
+
+# Where run_state has salt_utils.py write each host's results
+STATE_REPORT_FILE = '/tmp/bootstrap-salt-run-state.json'
+
+# Seconds upgrade_packages waits for any output from an upgrade or reboot
+# before giving up on it
+UPGRADE_OUTPUT_TIMEOUT = 1800
+
 
 @task
 def aws(profile_name):
@@ -170,13 +198,9 @@ def get_kms_data_key():
     if not ips:
         return create_kms_data_key()
 
-    env.host_string = '{0}@{1}'.format(env.user, ips[0])
-    key = StringIO.StringIO()
-    get(remote_path='/etc/salt.key.enc', local_path=key, use_sudo=True)
-    key.seek(0)
-    data = key.read()
-    data = base64.b64encode(data)
-    return data
+    data = ssh.get_connection(ips[0], env.user).read_file('/etc/salt.key.enc',
+                                                          use_sudo=True)
+    return base64.b64encode(data)
 
 
 bcfn_create, bcfn_delete, bcfn_update = cfn_create, cfn_delete, cfn_update
@@ -205,6 +229,8 @@ def cfn_update(*args, **kwargs):
     env.kms_data_key = get_kms_data_key()
 
     bcfn_update(*args, **kwargs)
+    # The update may have replaced instances
+    get_inventory().invalidate()
 
 
 @task
@@ -215,13 +241,69 @@ def cfn_delete(*args, **kwargs):
     bcfn_delete(*args, pre_delete_callbacks=pre_delete_callbacks, **kwargs)
 
 
+def get_inventory(states=RUNNING):
+    """
+    Get the inventory of the current stack. It is shared by every task in
+    this fab run, so the stack's instances are only looked up once.
+
+    Args:
+        states(tuple): The instance states to look up
+
+    Returns:
+        (StackInventory): The inventory
+    """
+    _validate_fabric_env()
+    key = (env.aws, env.aws_region, get_stack_name())
+    if key + (states,) not in inventories:
+        inventories[key + (states,)] = StackInventory(
+            *key, cache_ttl=env.inventory_cache_ttl, states=states)
+    return inventories[key + (states,)]
+
+
 def get_instance_ips():
     """
     Get a list of the public IPs of the current instances in the stack.
     """
-    ec2 = get_connection(EC2)
-    stack_name = get_stack_name()
-    return ec2.get_stack_instance_public_ips(stack_name)
+    return get_inventory().ips()
+
+
+def get_instance_placements():
+    """
+    Get the public IP, availability zone and autoscaling group of each of
+    the current instances in the stack.
+    """
+    return get_inventory().placements()
+
+
+def spread_by_placement(instances):
+    """
+    Order instances so that each availability zone and autoscaling group is
+    spread evenly through the list. Any slice of the list then holds about
+    the same share of each AZ and ASG, so a batch never takes out a whole
+    AZ or the instances behind one load balancer.
+
+    Args:
+        instances(list): dicts with the 'ip', 'az' and 'asg' of each instance
+
+    Returns:
+        (list): The IPs of the instances, spread out
+    """
+    groups = {}
+    order = []
+    for instance in instances:
+        key = (instance.get('asg'), instance.get('az'))
+        if key not in groups:
+            groups[key] = []
+            order.append(key)
+        groups[key].append(instance['ip'])
+    # Place the nth of k instances in a group at (n + 0.5) / k of the way
+    # through the list
+    positions = []
+    for rank, key in enumerate(order):
+        ips = groups[key]
+        for i, ip in enumerate(ips):
+            positions.append(((i + 0.5) / len(ips), rank, ip))
+    return [ip for _, _, ip in sorted(positions)]
 
 
 def get_ips_batch(fraction=None):
@@ -231,8 +313,10 @@ def get_ips_batch(fraction=None):
     If a fraction is specified the ips are split into batches sized by
     that fraction i.e. 4 ips with fraction=0.5 will return:
     [['ip1', 'ip2'],['ip3','ip4']]
+    The ips are first spread across availability zones and autoscaling
+    groups, so each batch takes an even share of each out of service.
     '''
-    ips = get_instance_ips()
+    ips = spread_by_placement(get_instance_placements())
     if fraction:
         number_in_batch = int(math.ceil(len(ips) * float(fraction)))
         return [ips[i: (i + number_in_batch)] for i in xrange(0, len(ips), number_in_batch)]
@@ -241,57 +325,200 @@ def get_ips_batch(fraction=None):
 
 
 @task
-def wait_for_minions(timeout=600, interval=20):
+def wait_for_minions(timeout=600, interval=20, pool_size=10, method='ssh',
+                     max_interval=60):
     """
     This task ensures that the initial bootstrap has finished on all
     stack instances.
 
+    By default this checks each instance for /tmp/bootstrap_done over
+    SSH, which works whichever bootstrap.sh launched it. With method=s3 it
+    waits for the markers bootstrap.sh publishes to the salt bucket
+    instead, which needs a single listing of the bucket per check and no
+    SSH, but instances launched with an older bootstrap.sh never publish
+    them. The stack's instances are looked up again on every check, and
+    the wait goes on until at least as many instances as its autoscaling
+    groups want have reported, so instances still launching are waited
+    for too.
+
+    The first recheck comes quickly, then the wait between checks starts
+    at interval and backs off, with jitter, up to max_interval.
+
     Args:
         timeout(int): time to wait for bootstrap to finish
         interval(int): time to wait in-between checks
+        pool_size(int): maximum number of hosts to check at once over SSH
+        method(string): 's3' to wait for the bootstrap markers, or 'ssh' to
+            check each instance for /tmp/bootstrap_done
+        max_interval(int): longest time to wait in-between checks
     """
     _validate_fabric_env()
     stack_name = get_stack_name()
-    ec2 = get_connection(EC2)
+    pending = set()
+
+    def log_progress(attempt, elapsed, duration, result):
+        logging.info("wait_for_minions: {0} instances still bootstrapping "
+                     "after {1:.0f}s (check {2} took {3:.1f}s)"
+                     .format(len(pending), elapsed, attempt, duration))
+
+    wait = utils.timeout(int(timeout), int(interval), backoff=1.5,
+                         max_interval=max(int(interval), int(max_interval)),
+                         jitter=0.1, first_interval=min(5, int(interval)),
+                         on_attempt=log_progress)
+    if method == 's3':
+        s3 = get_connection(S3)
+        bucket_name = '{0}-salt'.format(stack_name)
+        launched = get_inventory(states=NON_TERMINATED)
+        reported = set()
+
+        def is_stack_reported():
+            instance_ids = set(instance['id'] for instance in
+                               launched.instances(refresh=True))
+            expected = max(launched.desired_capacity(), 1)
+            pending.clear()
+            pending.update(instance_ids - reported)
+            is_bootstrap_reported(s3, bucket_name, pending)
+            reported.update(instance_ids - pending)
+            if len(instance_ids) < expected:
+                logging.info("wait_for_minions: {0} of {1} instances "
+                             "launched".format(len(instance_ids), expected))
+                return False
+            return not pending
+
+        logging.info("Waiting for bootstrap script to finish on all instances...")
+        wait(is_stack_reported)()
+        return
     logging.info("Waiting for SSH on all instances...")
-    ec2.wait_for_ssh(stack_name)
-    fab_hosts = get_instance_ips()
+    get_connection(EC2).wait_for_ssh(stack_name)
+    # Only look the instances up once they are all running with SSH up, so
+    # that instances still launching are waited for and have their IPs
+    inventory = get_inventory()
+    inventory.invalidate()
+    pending.update(inventory.ips())
     logging.info("Waiting for bootstrap script to finish on all instances...")
-    utils.timeout(timeout, interval)(is_bootstrap_done)(fab_hosts)
+    wait(is_bootstrap_done)(pending, pool_size=int(pool_size))
 
 
-def is_bootstrap_done(hosts):
+def is_bootstrap_done(hosts, pool_size=10, timeout=60):
     """
-    Loops through a list of IPs and checks for the prescence of
+    Checks a set of IPs concurrently for the prescence of
     /tmp/bootstrap_done to ensure that the launch config has finished
-    executing. The call will also try to handle the case where we lose
-    ssh during the wait, which can happen if another action triggers
-    a reboot.
+    executing. Hosts that have finished are removed from the set, so later
+    polls only check the hosts still bootstrapping. A host we lose ssh to
+    during the wait, which can happen if another action triggers a reboot,
+    is left in the set and reconnected to on the next poll.
 
     Args:
-        hosts(list): A list of IPs to check
+        hosts(set): The IPs still to check, updated in place
+        pool_size(int): Maximum number of hosts to check at once
+        timeout(int): Seconds to allow each host's check
+
+    Returns:
+        bool: True once every host has finished bootstrapping
+
+    Raises:
+        BootstrapError: as soon as any host's bootstrap script has failed
     """
-    ret = []
-    for host in hosts:
-        env.host_string = '{0}@{1}'.format(env.user, host)
-        target_file = '{}/bootstrap_done'.format(env.bootstrap_tmp_path)
-        try:
-            file_exists = files.exists(target_file)
-            ret.append(file_exists)
-            if file_exists:
-                logging.info("Salt bootstrap file {} on host {}..."
-                             .format(target_file, host))
-            else:
-                logging.info("Salt bootstrap file {} not found on host {}..."
-                             .format(target_file, host))
-        except NetworkError:
-            logging.warning("Could not connect to host {}, attempting to recover connection..."
-                            .format(host))
-            # Catch a network error and try again
-            stack_name = get_stack_name()
-            ec2 = get_connection(EC2)
-            ec2.wait_for_ssh(stack_name)
-    return all(ret)
+    executor = FleetExecutor(pool_size=pool_size, timeout=timeout,
+                             user=env.user)
+    for host, result in executor.run(check_bootstrap_done, list(hosts)).items():
+        done = result.value
+        if not result.ok:
+            logging.warning("Could not check host {}, will reconnect "
+                            "on the next check: {}".format(host, result.error))
+        elif isinstance(done, basestring):
+            lines = done.splitlines(True)
+            raise errors.BootstrapError(host,
+                                        lines[0].strip() if lines else 'unknown',
+                                        lines[1:])
+        elif done:
+            logging.info("Salt bootstrap finished on host {}...".format(host))
+            hosts.discard(host)
+        else:
+            logging.info("Salt bootstrap not finished on host {}..."
+                         .format(host))
+    return not hosts
+
+
+def get_bootstrap_markers(s3, bucket_name):
+    """
+    List the bootstrap markers in the salt bucket with a single listing.
+
+    Args:
+        s3(S3): The S3 connection
+        bucket_name(string): The stack's salt bucket
+
+    Returns:
+        (dict): The stages each instance has reported, keyed by instance ID
+    """
+    markers = {}
+    for key in s3.list_keys(bucket_name, BOOTSTRAP_MARKER_PREFIX):
+        parts = key.name[len(BOOTSTRAP_MARKER_PREFIX):].split('/')
+        if len(parts) == 2:
+            markers.setdefault(parts[0], set()).add(parts[1])
+    return markers
+
+
+def is_bootstrap_reported(s3, bucket_name, instance_ids):
+    """
+    Check the bootstrap markers for a set of instances. Instances that have
+    finished are removed from the set.
+
+    Args:
+        s3(S3): The S3 connection
+        bucket_name(string): The stack's salt bucket
+        instance_ids(set): The instances still to check, updated in place
+
+    Returns:
+        bool: True once every instance has finished bootstrapping
+
+    Raises:
+        BootstrapError: as soon as any instance reports that its bootstrap
+            failed
+    """
+    markers = get_bootstrap_markers(s3, bucket_name)
+    for instance_id in sorted(instance_ids):
+        stages = markers.get(instance_id, set())
+        if 'failed' in stages:
+            marker = s3.get_json(bucket_name, '{0}{1}/failed'.format(
+                BOOTSTRAP_MARKER_PREFIX, instance_id)) or {}
+            raise errors.BootstrapError(instance_id,
+                                        marker.get('failed_stage', 'unknown'),
+                                        marker.get('log_tail'))
+        if 'done' not in stages:
+            reached = [stage for stage in BOOTSTRAP_STAGES if stage in stages]
+            logging.info("Salt bootstrap on instance {} has reached stage {}..."
+                         .format(instance_id, reached[-1] if reached else 'pending'))
+            continue
+        instance_ids.discard(instance_id)
+        marker = s3.get_json(bucket_name, '{0}{1}/done'.format(
+            BOOTSTRAP_MARKER_PREFIX, instance_id)) or {}
+        logging.info("Salt bootstrap finished on instance {} in {:.0f}s..."
+                     .format(instance_id, marker.get('duration', 0)))
+        if marker.get('exit_code'):
+            logging.warning("The initial highstate on instance {} exited "
+                            "with {}".format(instance_id, marker['exit_code']))
+    return not instance_ids
+
+
+def check_bootstrap_done(conn):
+    """
+    Check a host for /tmp/bootstrap_done. This is run on each host by
+    is_bootstrap_done.
+
+    Args:
+        conn(PooledConnection): The connection to the host
+
+    Returns:
+        bool: Whether the file exists. If the bootstrap script failed, the
+            contents of /tmp/bootstrap_failed are returned instead: the
+            failed stage followed by the tail of the bootstrap log.
+    """
+    target_file = '{}/bootstrap_done'.format(env.bootstrap_tmp_path)
+    failed_file = '{}/bootstrap_failed'.format(env.bootstrap_tmp_path)
+    if conn.run('test -e {0}'.format(failed_file), warn_only=True).succeeded:
+        return conn.read_file(failed_file, use_sudo=True)
+    return conn.run('test -e {0}'.format(target_file), warn_only=True).succeeded
 
 
 def get_connection(klass, optional=False):
@@ -328,6 +555,8 @@ def delete_tar_task():
 def delete_tar(stack_name, **kwargs):
     with settings(warn_only=True):
         local("aws s3 --profile {0} rm s3://{1}-salt/srv.tar.gpg".format(quote(env.aws), quote(stack_name)))
+        local("aws s3 --profile {0} rm --recursive s3://{1}-salt/{2}"
+              .format(quote(env.aws), quote(stack_name), BOOTSTRAP_MARKER_PREFIX))
 
 
 @task
@@ -393,6 +622,13 @@ def upload_salt():
     with open(os.path.join(cfg_path, 'cloudformation.sls'), 'w') as cfg_file:
         yaml.dump(cfg, cfg_file)
 
+    # Ship a dependency index of the salt tree so minions can work out which
+    # states are affected by the changes since the bundle they last applied.
+    index = sls_index.build_index(tmp_folder,
+                                  state_roots=[remote_state_dir, '/srv/salt-formulas'],
+                                  pillar_root=remote_pillar_dir)
+    sls_index.write_index(index, os.path.join(tmp_folder, "./{0}".format(sls_index.INDEX_FILE)))
+
     local("chmod -R 755 {0}".format(tmp_folder))
     local("chmod -R 700 {0}{1}".format(tmp_folder, quote(remote_state_dir)))
     local("chmod -R 700 {0}{1}".format(tmp_folder, quote(remote_pillar_dir)))
@@ -402,15 +638,11 @@ def upload_salt():
                         root_dir=tmp_folder)
     shutil.rmtree(tmp_folder)
 
-    env.host_string = '{0}@{1}'.format(env.user, get_instance_ips()[0])
     # Here we get the encypted data key for this specific stack, we then use
     # KMS to get the plaintext key and use that key to encrypt the salt content
     # We get the key over SSH because it is unique to each stack.
-
-    key = StringIO.StringIO()
-
-    get(remote_path='/etc/salt.key.enc', local_path=key, use_sudo=True)
-    key.seek(0)
+    conn = ssh.get_connection(get_instance_ips()[0], env.user)
+    key = StringIO.StringIO(conn.read_file('/etc/salt.key.enc', use_sudo=True))
     encrypt_file('./srv.tar', key_file=key)
     key.close()
 
@@ -500,10 +732,18 @@ def generate_ssh_key_pillar(force=False, strict=True):
 
 
 @task
-def check_admins_exist():
+def check_admins_exist(pool_size=10, stop_early=False):
     """
     Check that we have set some admins in the pillar, exit with error code 1 if not
 
+    The instances are checked concurrently and the result for each one is
+    logged as a table.
+
+    Args:
+        pool_size(int): maximum number of instances to check at once
+        stop_early(bool): stop checking further instances as soon as one
+            fails the check
+
     Return:
         bool: True if admins exist in the pillars of all available instances,
             False otherwise
@@ -511,35 +751,77 @@ def check_admins_exist():
     # Find all instance ips and check admins on all of them. If one
     # instance lacks admins then the check fails
     host_ips = get_instance_ips()
+    results = check_admins(host_ips, pool_size=int(pool_size),
+                           stop_early=utils.parse_bool(stop_early))
+
+    width = max([len(host_ip) for host_ip in host_ips] + [len('HOST')])
+    logging.info("check_admins_exist: {0:<{1}}  ADMINS".format('HOST', width))
     for host_ip in host_ips:
-        # Create a host string for the instance
-        host = '{0}@{1}'.format(env.user, host_ip)
-        env.host_string = host
+        result = results.get(host_ip)
+        if host_ip not in results:
+            summary = 'not checked'
+        elif isinstance(result, BaseException):
+            summary = 'error: {0}'.format(result)
+        elif not result:
+            summary = 'none'
+        else:
+            summary = ', '.join(result)
+        logging.info("check_admins_exist: {0:<{1}}  {2}".format(host_ip, width, summary))
+
+    failed = [host_ip for host_ip in host_ips
+              if isinstance(results.get(host_ip), BaseException) or not results.get(host_ip)]
+    if failed:
+        link = "https://github.com/ministryofjustice/bootstrap-salt#github-based-ssh-key-generation"
+        logging.error(("check_admins_exist: No admins found in pillar on hosts '%s', "
+                       "please create them, see '%s'. "
+                       "Default user removal will be skipped until admins are set."
+                       % (', '.join(failed), link)))
+        return False
+    return True
+
+
+def check_admins(host_ips, pool_size=10, stop_early=False):
+    """
+    Load the admins from the pillar of several instances concurrently.
+
+    Args:
+        host_ips(list): The instances to check
+        pool_size(int): Maximum number of instances to check at once
+        stop_early(bool): Skip the instances not yet checked as soon as one
+            has no admins
+
+    Returns:
+        (dict): The admin usernames found on each instance, or the exception
+            raised checking it. Instances that were skipped are left out.
+    """
+    def get_admins(conn):
         # Load the admins pillar data
-        admins_json = sudo('/usr/bin/salt-call pillar.get admins --out=json 2> /dev/null',
-                           shell=False)
-        admins_dict = json.loads(admins_json).get('local', {})
+        admins_json = conn.sudo('/usr/bin/salt-call pillar.get admins --out=json 2> /dev/null')
         # If we have no admins data in 'local' then we have no admins
         # We also assume that we have admins if we have *any* data, a
         # simplistic test
-        if len(admins_dict) <= 0:
-            link = "https://github.com/ministryofjustice/bootstrap-salt#github-based-ssh-key-generation"
-            logging.error(("check_admins_exist: No admins found in pillar on host '%s', "
-                           "please create them, see '%s'. "
-                           "Default user removal will be skipped until admins are set."
-                           % (host_ip, link)))
-            return False
+        return sorted(json.loads(admins_json).get('local', {}).keys())
 
-        logging.info(("check_admins_exist: Found admins '%s' on host '%s'"
-                      % (', '.join(admins_dict.keys()),
-                         host_ip)))
-    return True
+    def failed(host_ip, result):
+        return not result.ok or not result.value
+
+    executor = FleetExecutor(pool_size=pool_size, user=env.user)
+    results = executor.run(get_admins, host_ips,
+                           stop=failed if stop_early else None)
+    return dict((host_ip, result.result) for host_ip, result in results.items())
 
 
 @task
-def upgrade_packages(packages, fraction=None, restart=False):
+def upgrade_packages(packages, fraction=None, restart=False,
+                     max_in_flight=None, failure_budget=0, health_timeout=600):
     """
-    Upgrade the packages specified, optionally rebooting afterwards
+    Upgrade the packages specified, optionally rebooting afterwards.
+
+    Hosts are upgraded in a rolling window of at most max_in_flight hosts.
+    As soon as a host has been upgraded and is healthy again, meaning it
+    is back up if it was rebooted and its minion responds to test.ping,
+    the next host is started. Once more than failure_budget hosts have
+    failed, no more hosts are started.
 
     Args:
         packages(list): List of packages to update. These can be a simple list
@@ -547,33 +829,303 @@ def upgrade_packages(packages, fraction=None, restart=False):
             '["package1", "package2"]' - get the latest versions of package1 and package2
             '["package1", {"package2", "1.2.3"}]' - get the latest versions of package1,
                 and version 1.2.3 of package2.
-        fraction(float): The decimal fraction of minions to deploy to None means
-            all in one batch
+        fraction(float): The decimal fraction of minions to upgrade at once,
+            None means all at once
         restart(bool): False to not reboot after installation, True to reboot the instance.
+        max_in_flight(int): The maximum number of hosts to upgrade at once,
+            overrides fraction
+        failure_budget(int): The number of hosts that may fail before the
+            rollout is stopped
+        health_timeout(int): Seconds to wait for a host to become healthy
+            after its upgrade
+
+    Raises:
+        RolloutError: if any host failed or was skipped
     """
-    for batch in get_ips_batch(fraction):
-        rup = fabric.decorators.hosts(batch)(run_upgrade_packages)
-        execute(rup, packages, fraction, restart)
+    restart = utils.parse_bool(restart)
+    batches = get_ips_batch(fraction)
+    hosts = [host for batch in batches for host in batch]
+    if max_in_flight is None:
+        max_in_flight = len(batches[0]) if batches else 1
+    # Boot IDs from before each host was rebooted, to tell when it is back
+    boot_ids = {}
+
+    def upgrade(host):
+        if restart:
+            boot_ids[host] = get_boot_id(host)
+        run_upgrade_packages(host, packages, restart)
 
+    def health_check(host):
+        return wait_for_healthy(host, boot_ids.get(host), int(health_timeout))
 
-@parallel
-def run_upgrade_packages(packages, fraction=None, restart=False):
-    state = "pkg.install refresh=True only_upgrade=True pkgs='{}'".format(packages)
-    if fraction:
-        sudo('/usr/bin/salt-call {}'.format(state), shell=False)
-        if restart:
-            sudo('/usr/bin/salt-call system.reboot', shell=False)
+    scheduler = rolling.RollingScheduler(max_in_flight=int(max_in_flight),
+                                         failure_budget=int(failure_budget),
+                                         health_check=health_check)
+    results = scheduler.run(hosts, upgrade)
+    for host in hosts:
+        logging.info("upgrade_packages: {0:<16} {1}".format(host, results[host]))
+    failed = [host for host in hosts if results[host] != rolling.OK]
+    if failed:
+        raise errors.RolloutError(failed, results)
+    return results
+
+
+def run_upgrade_packages(host, packages, restart=False):
+    """
+    Upgrade packages on a single host with salt, optionally rebooting it.
+
+    Args:
+        host(string): The host's IP
+        packages(list): The packages to upgrade, as for upgrade_packages
+        restart(bool): True to reboot the host afterwards
+
+    Raises:
+        RemoteCommandError: if the upgrade fails
+    """
+    state = "pkg.install refresh=True only_upgrade=True pkgs={0}".format(
+        quote(str(packages)))
+    commands = ['/usr/bin/salt-call {0}'.format(state)]
+    if restart:
+        commands.append('/usr/bin/salt-call system.reboot')
+    conn = ssh.get_connection(host)
+    # The connection drops as the host goes down, so the reboot never
+    # reports back. If the host goes without closing the connection, the
+    # timeout stops us waiting on it for ever. It applies to each read, so
+    # it has to allow for pkg.install, which prints nothing until it's done.
+    results = conn.run_batch(commands, sudo=True, warn_only=True,
+                             timeout=UPGRADE_OUTPUT_TIMEOUT)
+    if restart:
+        ssh.pool.discard(conn.host_string)
+    if not results:
+        raise errors.RemoteCommandError(host, commands[0], None, '')
+    if results[0].failed:
+        raise errors.RemoteCommandError(host, commands[0],
+                                        results[0].return_code, results[0])
+
+
+def get_boot_id(host):
+    """
+    Returns:
+        (string): The host's boot ID, which changes each time it boots
+    """
+    return ssh.get_connection(host).run('cat /proc/sys/kernel/random/boot_id')
+
+
+def wait_for_healthy(host, boot_id=None, timeout=600, interval=10):
+    """
+    Wait for a host to come back after an upgrade: for it to have rebooted
+    if a boot ID from before the reboot is given, and for its minion to
+    respond.
+
+    Args:
+        host(string): The host's IP
+        boot_id(string): The boot ID before the host was rebooted, None if
+            it wasn't rebooted
+        timeout(int): Seconds to wait
+        interval(int): Seconds between checks
+
+    Returns:
+        bool: True once the host is healthy
+
+    Raises:
+        CfnTimeoutError: if the host isn't healthy within the timeout
+    """
+    @utils.timeout(timeout, interval)
+    def is_healthy():
+        try:
+            conn = ssh.get_connection(host)
+            if boot_id is not None and conn.run(
+                    'cat /proc/sys/kernel/random/boot_id') == boot_id:
+                return False
+            return conn.sudo('/usr/bin/salt-call test.ping',
+                             warn_only=True).succeeded
+        except (NetworkError, errors.RemoteCommandError, EOFError,
+                socket.error, SSHException):
+            logging.info("wait_for_healthy: {0} is not up yet".format(host))
+            return False
+    return is_healthy()
+
+
+@task
+def run_state(state='highstate', canary=1, pool_size=10, slowest=5,
+              summary_file=None, extra_args='', timeout=None):
+    """
+    Run salt_utils.py on every instance in the stack, on a canary first and,
+    if that succeeds, on the rest of the stack pool_size instances at a
+    time. Each instance's state results and timings are collected into a
+    summary of the failing states and the slowest instances, which is
+    logged and optionally written as JSON.
+
+    Args:
+        state(string): The state to run, or several SLS IDs separated by
+            spaces
+        canary(int): The number of instances to run the state on first
+        pool_size(int): The number of instances to run the state on at once
+            after the canaries
+        slowest(int): The number of slowest instances to report
+        summary_file(string): Path to write the summary to as JSON
+        extra_args(string): Further arguments for salt_utils.py, e.g.
+            '--changed-only'
+        timeout(int): Seconds to allow each instance, after which it is
+            given up on and counted as failed, None for no limit
+
+    Returns:
+        (dict): The summary, as returned by summarise_state_results
+
+    Raises:
+        RolloutError: if the state failed on any instance, or the canary
+            failed and the rest of the stack was skipped
+    """
+    hosts = spread_by_placement(get_instance_placements())
+    canary = int(canary)
+    canaries, rest = hosts[:canary], hosts[canary:]
+
+    timeout = int(timeout) if timeout else None
+
+    def run(conn):
+        return run_state_on_host(conn, state, extra_args)
+
+    def run_on(hosts, pool_size):
+        executor = FleetExecutor(pool_size=pool_size, timeout=timeout,
+                                 user=env.user)
+        return dict((host, result.result)
+                    for host, result in executor.run(run, hosts).items())
+
+    results = run_on(canaries, max(canary, 1))
+    if all(not isinstance(result, BaseException) and result['succeeded']
+           for result in results.values()):
+        results.update(run_on(rest, int(pool_size)))
     else:
-        sudo('/usr/bin/salt-call {}'.format(state), shell=False)
-        if restart:
-            sudo('/usr/bin/salt-call system.reboot', shell=False)
+        logging.error("run_state: State failed on the canary, not running it "
+                      "on the rest of the stack")
+
+    summary = summarise_state_results(hosts, results, slowest=int(slowest))
+    log_state_summary(summary)
+    if summary_file:
+        with open(summary_file, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    if summary['failed'] or summary['skipped']:
+        statuses = dict([(host, 'failed') for host in summary['failed']] +
+                        [(host, 'skipped') for host in summary['skipped']])
+        raise errors.RolloutError(summary['failed'] + summary['skipped'],
+                                  statuses)
+    return summary
+
+
+def run_state_on_host(conn, state, extra_args=''):
+    """
+    Run salt_utils.py on a host and fetch the JSON timing report it writes.
+
+    Args:
+        conn(PooledConnection): The connection to the host
+        state(string): The state, or SLS IDs separated by spaces
+        extra_args(string): Further arguments for salt_utils.py
+
+    Returns:
+        (dict): The host's exit code, whether it succeeded, how long it took
+            in seconds, its timing report, or None if it didn't write one,
+            and the tail of its output
+    """
+    command = ('/usr/local/bin/salt_utils.py -s {0} --output none '
+               '--timing-report {1} {2}'.format(
+                   ' '.join(quote(sls) for sls in state.split()),
+                   STATE_REPORT_FILE, extra_args))
+    started = time.time()
+    # Remove the report of any earlier run first, in case this one writes
+    # none
+    steps = conn.run_batch(
+        ['rm -f {0}'.format(STATE_REPORT_FILE), command,
+         'cat {0}'.format(STATE_REPORT_FILE)],
+        sudo=True, warn_only=True, stop_on_error=False)
+    duration = time.time() - started
+    if len(steps) < 3:
+        raise errors.RemoteCommandError(conn.host, command, None,
+                                        '\n'.join(steps))
+    result = steps[1]
+    try:
+        report = json.loads(steps[2]) if steps[2].succeeded else None
+    except ValueError:
+        report = None
+    return {'return_code': result.return_code,
+            'succeeded': result.succeeded,
+            'duration': duration,
+            'report': report,
+            'output': result.splitlines()[-20:]}
+
+
+def summarise_state_results(hosts, results, slowest=5):
+    """
+    Aggregate the results of run_state_on_host across the stack.
+
+    Args:
+        hosts(list): All of the hosts, in the order they were run
+        results(dict): The result, or the exception raised, for each host
+            the state was run on
+        slowest(int): The number of slowest hosts to include
+
+    Returns:
+        (dict): The hosts that 'succeeded', 'failed' or were 'skipped',
+            the 'slowest' hosts with their durations, the 'failing_states'
+            with the hosts each failed on, and the 'errors' output by each
+            failed host
+    """
+    summary = {'succeeded': [], 'failed': [], 'skipped': [],
+               'slowest': [], 'failing_states': {}, 'errors': {}}
+    durations = []
+    for host in hosts:
+        if host not in results:
+            summary['skipped'].append(host)
+            continue
+        result = results[host]
+        if isinstance(result, BaseException):
+            summary['failed'].append(host)
+            summary['errors'][host] = [str(result)]
+            continue
+        durations.append((result['duration'], host))
+        if not result['succeeded']:
+            summary['failed'].append(host)
+            summary['errors'][host] = result['output']
+        else:
+            summary['succeeded'].append(host)
+        for state in (result['report'] or {}).get('failed', []):
+            failing = summary['failing_states'].setdefault(
+                state['id'], {'sls': state['sls'], 'hosts': [],
+                              'comment': state['comment']})
+            failing['hosts'].append(host)
+    summary['slowest'] = [{'host': host, 'duration': duration}
+                          for duration, host in sorted(durations, reverse=True)[:slowest]]
+    return summary
+
+
+def log_state_summary(summary):
+    logging.info("run_state: {0} succeeded, {1} failed, {2} skipped".format(
+        len(summary['succeeded']), len(summary['failed']),
+        len(summary['skipped'])))
+    for slow in summary['slowest']:
+        logging.info("run_state: {0:>8.1f}s {1}".format(slow['duration'],
+                                                        slow['host']))
+    for state_id, failing in sorted(summary['failing_states'].items()):
+        logging.error("run_state: {0} ({1}) failed on {2}: {3}".format(
+            state_id, failing['sls'], ', '.join(failing['hosts']),
+            failing['comment']))
+    for host in summary['failed']:
+        logging.error("run_state: {0} failed:\n{1}".format(
+            host, '\n'.join(summary['errors'][host])))
 
 
 @task
-def update_users():
+def update_users(pool_size=10, regions=None):
     """
     Setup a special fab environment to prepare for an all stack sync
     user job.
+
+    The GitHub token is encrypted and uploaded to each stack's salt bucket
+    once, before the users are synced on pool_size hosts at a time.
+
+    Args:
+        pool_size(int): The number of hosts to sync users on at once
+        regions(string): Space separated regions to find stacks in,
+            defaults to the current region
     """
 
     try:
@@ -581,52 +1133,90 @@ def update_users():
     except:
         sys.exit("update_users requires a valid GH_TOKEN from github. Exiting...")
 
-    ec2_conn = get_connection(EC2, optional=True)
-    instances = ec2_conn.get_all_stack_ips()
-
-    # initialize lookup table
-    env.eght = dict()
+    regions = regions.split() if regions else [env.aws_region]
+    index = get_stack_hosts_index(env.aws, regions)
+    instances = dict((host, stack_name)
+                     for stack_name, stack in index.items()
+                     for host in stack['hosts'])
+    stack_regions = dict((stack_name, stack['region'])
+                         for stack_name, stack in index.items())
 
     if env.environment and env.application:
-        dec_func = fabric.decorators.hosts(get_instance_ips())(sync_users)
+        hosts = get_instance_ips()
     elif env.hosts:
-        dec_func = fabric.decorators.hosts(env.hosts)(sync_users)
+        hosts = env.hosts
     else:
-        dec_func = fabric.decorators.hosts(instances.keys())(sync_users)
+        hosts = instances.keys()
 
-    env.stack_names = instances
-    execute(dec_func)
-    local("rm /tmp/ght-*")
+    try:
+        published = publish_github_tokens(hosts, instances,
+                                          pool_size=int(pool_size),
+                                          stack_regions=stack_regions)
+        hosts = [host for host in hosts if instances[host] in published]
+        if hosts:
+            with settings(pool_size=int(pool_size)):
+                execute(fabric.decorators.hosts(hosts)(sync_users))
+    finally:
+        local("rm -f /tmp/ght-*")
+
+
+def publish_github_tokens(hosts, stack_names, pool_size=10,
+                          stack_regions=None):
+    """
+    Encrypt the GitHub token with each stack's data key and upload it to
+    the stack's salt bucket. This is done once per stack, up to pool_size
+    stacks at a time, reading the stack's encrypted data key from the first
+    of its hosts.
+
+    Args:
+        hosts(list): The hosts users are being synced on
+        stack_names(dict): The stack name of each host
+        pool_size(int): The number of stacks to publish to at once
+        stack_regions(dict): The region of each stack, for its KMS key,
+            defaults to the current region
+
+    Returns:
+        (set): The stacks the token was published to. Stacks that failed
+            are logged and left out.
+    """
+    stack_hosts = {}
+    for host in hosts:
+        stack_hosts.setdefault(stack_names[host], host)
+
+    def publish(conn):
+        stack = stack_names[conn.host]
+        filename = "/tmp/ght-{0}".format(stack)
+        with open(filename, "w") as fd:
+            fd.write(env.github_token)
+
+        # Encrypt the token with the stack's data key
+        key = StringIO.StringIO(conn.read_file('/etc/salt.key.enc', use_sudo=True))
+        region = (stack_regions or {}).get(stack, env.aws_region)
+        encrypt_file(filename, key_file=key, kms_conn=KMS(env.aws, region))
+        command = "aws s3 --profile {0} cp {1}.gpg s3://{2}-salt/ght-{2}.gpg".format(
+            quote(env.aws), quote(filename), quote(stack))
+        result = local(command)
+        if result.failed:
+            raise errors.LocalCommandError(command, result.return_code)
+
+    # warn_only is set here rather than in each thread, because settings
+    # changes the global env and threads restoring it could race
+    with settings(warn_only=True):
+        executor = FleetExecutor(pool_size=pool_size, user=env.user)
+        results = executor.run(publish, stack_hosts.values())
+    published = set()
+    for host, result in results.items():
+        if not result.ok:
+            logging.error("publish_github_tokens: Could not publish the token "
+                          "for {0}, skipping its hosts: {1}"
+                          .format(stack_names[host], result.error))
+        else:
+            published.add(stack_names[host])
+    return published
 
 
-@parallel(pool_size=2)
+@parallel
 def sync_users():
-    kms = get_connection(KMS, optional=True)
-
-    # Find stack id
-    stack = env.stack_names[env.host].split("-")
-    stack_name = "{0}-{1}".format(stack[0], stack[1])
-    filename = "/tmp/ght-{0}".format(stack_name)
-    s3_filename = "ght-{0}.gpg".format(env.stack_names[env.host])
-
-    if stack_name not in env.eght:
-        # Write token
-        fd = open(filename, "w")
-        fd.write(env.github_token)
-        fd.close()
-
-        # Encrypt out gh.token
-        key = StringIO.StringIO()
-        get(remote_path='/etc/salt.key.enc', local_path=key, use_sudo=True)
-        key.seek(0)
-        env.environment = stack[1]      # Setting the environment :(
-        encrypt_file(filename, key_file=key, kms_conn=kms)
-        key.close()
-        local("aws s3 --profile {0} cp {1}.gpg s3://{2}-salt/{3}".format(quote(env.aws),
-                                                                         quote(filename),
-                                                                         quote(env.stack_names[env.host]),
-                                                                         s3_filename))
-        env.eght[stack_name] = "env.stack_names[env.host].gpg"
-
-    sudo("salt-call saltutil.sync_modules")
-    sudo("salt-call github_user.addremove_users")
+    ssh.get_connection(env.host_string).run_batch(
+        ["salt-call saltutil.sync_modules",
+         "salt-call github_user.addremove_users"], sudo=True)
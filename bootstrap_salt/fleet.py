@@ -0,0 +1,116 @@
+import logging
+import time
+
+import errors
+import ssh
+import utils
+
+
+class HostResult(object):
+    """
+    The outcome of running a function on one host with the FleetExecutor.
+    """
+
+    def __init__(self, host, value=None, error=None, duration=0.0):
+        """
+        Args:
+            host(string): The host
+            value: What the function returned
+            error(Exception): The exception raised connecting to the host or
+                by the function, or the SystemExit of a fabric abort, if any
+            duration(float): Seconds the host took
+        """
+        self.host = host
+        self.value = value
+        self.error = error
+        self.duration = duration
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def timed_out(self):
+        return isinstance(self.error, errors.HostTimeoutError)
+
+    @property
+    def result(self):
+        """
+        The value returned, or the exception raised if the host failed
+        """
+        return self.value if self.ok else self.error
+
+    def __repr__(self):
+        return 'HostResult({0!r}, value={1!r}, error={2!r})'.format(
+            self.host, self.value, self.error)
+
+
+class FleetExecutor(object):
+    """
+    Run a function on many hosts at once from threads in this process,
+    without touching fabric's global env. The function is called with an
+    explicit connection to its host, from the pool in bootstrap_salt.ssh
+    by default.
+
+    At most pool_size hosts are worked on at once. A host that takes longer
+    than the timeout is given up on: its connection is closed, which ends
+    any command still running on it, and the next host is started.
+    """
+
+    def __init__(self, pool_size=10, timeout=None, user=None, connect=None):
+        """
+        Args:
+            pool_size(int): Maximum number of hosts to work on at once
+            timeout(int): Seconds to allow each host, None for no limit
+            user(string): The user to connect as, defaults to fabric's
+                env.user
+            connect(function): Called with a host and user to get its
+                connection, defaults to ssh.get_connection
+        """
+        self.pool_size = max(int(pool_size), 1)
+        self.timeout = timeout
+        self.user = user
+        self.connect = connect or ssh.get_connection
+
+    def call(self, func, host, conns):
+        started = time.time()
+        try:
+            conn = self.connect(host, self.user)
+            conns[host] = conn
+            result = HostResult(host, value=func(conn))
+        except (Exception, SystemExit) as err:
+            # A fabric abort raises SystemExit, which is the host's error
+            # rather than the end of the run
+            result = HostResult(host, error=err)
+        result.duration = time.time() - started
+        return result
+
+    def run(self, func, hosts, stop=None):
+        """
+        Run a function on each host.
+
+        Args:
+            func(function): Called with the connection to each host
+            hosts(list): The hosts to run it on
+            stop(function): Called with each host and its HostResult as
+                they finish. If it returns True, hosts that haven't started
+                yet are skipped.
+
+        Returns:
+            (dict): The HostResult for each host. Skipped hosts are left
+                out.
+        """
+        conns = {}
+        return utils.run_concurrently(
+            lambda host: self.call(func, host, conns), hosts,
+            pool_size=self.pool_size, stop=stop, timeout=self.timeout,
+            on_timeout=lambda host: self.give_up(host, conns.get(host)))
+
+    def give_up(self, host, conn):
+        logging.warning("FleetExecutor: {0} did not finish within {1}s, "
+                        "giving up on it".format(host, self.timeout))
+        if conn is not None:
+            # Unblock the thread still waiting on the host
+            conn.close()
+        return HostResult(host, error=errors.HostTimeoutError(host, self.timeout),
+                          duration=self.timeout)
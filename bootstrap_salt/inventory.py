@@ -0,0 +1,170 @@
+import json
+import logging
+import os
+import tempfile
+import time
+
+import boto.ec2
+import boto.ec2.autoscale
+
+import utils
+
+# Where inventories are cached between fab invocations
+CACHE_DIR = os.path.expanduser('~/.cache/bootstrap-salt/inventory')
+
+STACK_NAME_TAG = 'aws:cloudformation:stack-name'
+ASG_NAME_TAG = 'aws:autoscaling:groupName'
+
+# Instance states to look up, by default only running instances
+RUNNING = ('running',)
+NON_TERMINATED = ('pending', 'running', 'stopping', 'stopped')
+
+
+class StackInventory(object):
+    """
+    The running instances of a stack, found with a single DescribeInstances
+    call filtered on the stack name tag CloudFormation gives them. Other
+    instance states can be asked for with states, e.g. to see instances
+    that are still launching.
+
+    The instances are looked up once and then remembered, so a fab run only
+    asks EC2 once however many tasks need them. With a cache_ttl they are
+    also cached on disk, so fab invocations within cache_ttl seconds of
+    each other share them too.
+    """
+
+    conn_ec2 = None
+    conn_autoscale = None
+
+    def __init__(self, aws_profile_name, aws_region_name, stack_name,
+                 cache_ttl=0, cache_dir=CACHE_DIR, states=RUNNING):
+        """
+        Args:
+            aws_profile_name(string): The AWS profile
+            aws_region_name(string): The stack's region
+            stack_name(string): The stack name
+            cache_ttl(int): Seconds to cache the instances on disk for, 0
+                not to cache them on disk
+            cache_dir(string): Where to cache instances on disk
+            states(tuple): The instance states to look up
+        """
+        self.aws_profile_name = aws_profile_name
+        self.aws_region_name = aws_region_name
+        self.stack_name = stack_name
+        self.cache_ttl = int(cache_ttl or 0)
+        self.states = tuple(states)
+        cache_name = '{0}-{1}-{2}'.format(aws_profile_name, aws_region_name,
+                                          stack_name)
+        if self.states != RUNNING:
+            cache_name += '-' + '-'.join(sorted(self.states))
+        self.cache_file = os.path.join(cache_dir, cache_name + '.json')
+        self._instances = None
+
+    def instances(self, refresh=False):
+        """
+        Args:
+            refresh(bool): Look the instances up again
+
+        Returns:
+            (list): A dict for each instance with its 'id', public 'ip',
+                'private_ip', 'az', 'state' and 'asg', the name of its
+                autoscaling group or None
+        """
+        if refresh:
+            self.invalidate()
+        if self._instances is None:
+            self._instances = self.read_cache()
+        if self._instances is None:
+            self._instances = self.describe_instances()
+            self.write_cache(self._instances)
+        return self._instances
+
+    def describe_instances(self):
+        if self.conn_ec2 is None:
+            self.conn_ec2 = utils.connect_to_aws(boto.ec2, self)
+        filters = {'tag:{0}'.format(STACK_NAME_TAG): self.stack_name,
+                   'instance-state-name': list(self.states)}
+        return [{'id': x.id,
+                 'ip': x.ip_address,
+                 'private_ip': x.private_ip_address,
+                 'az': x.placement,
+                 'state': x.state,
+                 'asg': x.tags.get(ASG_NAME_TAG)}
+                for x in self.conn_ec2.get_only_instances(filters=filters)]
+
+    def desired_capacity(self):
+        """
+        Look up how many instances the stack's autoscaling groups want. This
+        isn't cached, as it is used to wait for a stack to reach its size.
+
+        Returns:
+            (int): The total desired capacity of the stack's autoscaling
+                groups
+        """
+        if self.conn_autoscale is None:
+            self.conn_autoscale = utils.connect_to_aws(boto.ec2.autoscale,
+                                                       self)
+        capacity = 0
+        next_token = None
+        while True:
+            groups = self.conn_autoscale.get_all_groups(next_token=next_token)
+            for group in groups:
+                if any(tag.key == STACK_NAME_TAG and
+                       tag.value == self.stack_name for tag in group.tags):
+                    capacity += group.desired_capacity
+            next_token = groups.next_token
+            if not next_token:
+                return capacity
+
+    def ids(self):
+        return [instance['id'] for instance in self.instances()]
+
+    def ips(self):
+        return [instance['ip'] for instance in self.instances()]
+
+    def placements(self):
+        return [{'ip': instance['ip'], 'az': instance['az'],
+                 'asg': instance['asg']}
+                for instance in self.instances()]
+
+    def read_cache(self):
+        if not self.cache_ttl:
+            return None
+        try:
+            with open(self.cache_file) as cache:
+                cached = json.load(cache)
+        except (IOError, ValueError):
+            return None
+        age = time.time() - cached.get('time', 0)
+        if not 0 <= age < self.cache_ttl:
+            return None
+        logging.debug("StackInventory: Using instances of {0} cached {1:.0f}s "
+                      "ago".format(self.stack_name, age))
+        return cached.get('instances')
+
+    def write_cache(self, instances):
+        if not self.cache_ttl:
+            return
+        cache_dir = os.path.dirname(self.cache_file)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir, 0700)
+            # Write to a temporary file and rename it into place, so other
+            # fab runs never read a partial cache
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir)
+            with os.fdopen(fd, 'w') as cache:
+                json.dump({'time': time.time(), 'instances': instances}, cache)
+            os.rename(tmp_path, self.cache_file)
+        except (IOError, OSError) as err:
+            logging.warning("StackInventory: Could not cache instances: {0}"
+                            .format(err))
+
+    def invalidate(self):
+        """
+        Forget the instances, for when the stack has changed.
+        """
+        self._instances = None
+        try:
+            os.remove(self.cache_file)
+        except OSError:
+            pass
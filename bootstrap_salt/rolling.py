@@ -0,0 +1,99 @@
+import logging
+
+import utils
+
+
+# Outcomes of a host in a rollout
+OK = 'ok'
+FAILED = 'failed'
+UNHEALTHY = 'unhealthy'
+SKIPPED = 'skipped'
+
+
+class RollingScheduler(object):
+    """
+    Apply an action to hosts with a sliding window of at most max_in_flight
+    hosts at a time. A host only leaves the window once the action has
+    finished and the host has passed its health check, and the next host
+    starts straight away, so a rollout isn't held up waiting for the
+    slowest host of a fixed batch.
+
+    Each host that fails the action or its health check uses up the failure
+    budget. Once more hosts have failed than the budget allows, no more
+    hosts are started; the hosts already in flight are left to finish.
+    """
+
+    def __init__(self, max_in_flight=1, failure_budget=0, health_check=None):
+        """
+        Args:
+            max_in_flight(int): Maximum number of hosts being worked on at
+                once
+            failure_budget(int): Number of hosts that may fail before the
+                rollout is stopped
+            health_check(function): Called with a host once its action has
+                finished, returns True if the host is healthy. None to skip
+                health checks.
+        """
+        self.max_in_flight = max(int(max_in_flight), 1)
+        self.failure_budget = int(failure_budget)
+        self.health_check = health_check
+
+    def process(self, host, action):
+        logging.info("RollingScheduler: Starting host {}".format(host))
+        try:
+            action(host)
+        except Exception:
+            logging.exception("RollingScheduler: Action failed on host {}"
+                              .format(host))
+            return FAILED
+        if self.health_check is not None:
+            try:
+                healthy = self.health_check(host)
+            except Exception:
+                logging.exception("RollingScheduler: Health check failed on "
+                                  "host {}".format(host))
+                return UNHEALTHY
+            if not healthy:
+                return UNHEALTHY
+        return OK
+
+    def run(self, hosts, action):
+        """
+        Roll an action out to the hosts, in order.
+
+        Args:
+            hosts(list): The hosts to roll out to
+            action(function): Called with each host, raises an exception if
+                the action fails
+
+        Returns:
+            (dict): The outcome for each host, OK, FAILED, UNHEALTHY or
+                SKIPPED if the rollout was stopped before it started
+        """
+        failures = [0]
+
+        def finished(host, outcome):
+            logging.info("RollingScheduler: Host {} finished: {}"
+                         .format(host, outcome))
+            if outcome == OK:
+                return False
+            failures[0] += 1
+            if failures[0] == self.failure_budget + 1:
+                logging.error("RollingScheduler: {} hosts failed, exceeding "
+                              "the failure budget of {}. Stopping the "
+                              "rollout.".format(failures[0],
+                                                self.failure_budget))
+            return failures[0] > self.failure_budget
+
+        results = utils.run_concurrently(
+            lambda host: self.process(host, action), hosts,
+            pool_size=self.max_in_flight, stop=finished)
+        for host, outcome in results.items():
+            if isinstance(outcome, BaseException):
+                # A fabric abort in the action or health check
+                logging.error("RollingScheduler: Host {} aborted: {}"
+                              .format(host, outcome))
+                results[host] = FAILED
+        for host in hosts:
+            results.setdefault(host, SKIPPED)
+        return results
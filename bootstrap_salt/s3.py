@@ -0,0 +1,53 @@
+import json
+
+import boto.s3
+
+import utils
+
+
+class S3:
+    """
+    This class gives us the ability to talk to S3
+    using the same connectivity options as bootstrap-cfn
+
+    This means we can connect cross-account by creating an aws
+    profile called cross-account and passing an environment
+    variable called AWS_ROLE_ARN_ID
+    """
+
+    conn_s3 = None
+    aws_region_name = None
+    aws_profile_name = None
+
+    def __init__(self, aws_profile_name, aws_region_name='eu-west-1'):
+        self.aws_profile_name = aws_profile_name
+        self.aws_region_name = aws_region_name
+
+        self.conn_s3 = utils.connect_to_aws(boto.s3, self)
+
+    def get_bucket(self, bucket_name):
+        return self.conn_s3.get_bucket(bucket_name, validate=False)
+
+    def list_keys(self, bucket_name, prefix=''):
+        """
+        List the keys in a bucket under a prefix. A single request is made
+        unless there are more than 1000 keys.
+
+        Args:
+            bucket_name(string): The bucket to list
+            prefix(string): Only list keys starting with this prefix
+
+        Returns:
+            (list): The boto Key objects
+        """
+        return list(self.get_bucket(bucket_name).list(prefix=prefix))
+
+    def get_json(self, bucket_name, key_name):
+        """
+        Returns:
+            The decoded JSON contents of a key, or None if it doesn't exist
+        """
+        key = self.get_bucket(bucket_name).get_key(key_name)
+        if key is None:
+            return None
+        return json.loads(key.get_contents_as_string())
@@ -4,13 +4,16 @@ import logging
 import sys
 import subprocess
 
+from salt_utils_metrics import SaltUtilsMetrics, TEXTFILE_DIR
+
 # Set up the logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("bootstrap-salt::salt_utils")
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger('boto').setLevel(logging.CRITICAL)
 
-if __name__ == "__main__":
+
+def get_parser():
     parser = argparse.ArgumentParser(
         description=('Update the salt config '
                      'from a remote s3 store and run a salt state')
@@ -18,8 +21,15 @@ if __name__ == "__main__":
     parser.add_argument('-s',
                         dest='state',
                         type=str,
-                        help='Name of state or highstate'
+                        nargs='+',
+                        help=('Name of state or highstate, several SLS IDs '
+                              'may be given to run them in one salt call')
                         )
+    parser.add_argument('--concurrent',
+                        dest='concurrent',
+                        help=('Run SLS IDs that share no dependencies '
+                              'concurrently'),
+                        action='store_true')
     parser.add_argument('--disable-update',
                         dest='disable_update',
                         help=('Disable the updating of salt config data '
@@ -43,6 +53,82 @@ if __name__ == "__main__":
                         help=('Level of logging detail, '
                               'debug, info, warning, error or critical'),
                         default="info")
+    parser.add_argument('--splay',
+                        dest='splay',
+                        type=int,
+                        help=('Wait up to this many seconds before fetching '
+                              'new salt data, to spread load across the fleet'),
+                        default=0)
+    parser.add_argument('--stagger',
+                        dest='stagger',
+                        help=('Pick the splay delay from a hash of the '
+                              'instance ID rather than at random'),
+                        action='store_true')
+    parser.add_argument('--rate-limit',
+                        dest='rate_limit',
+                        type=float,
+                        help='Maximum AWS requests per second when updating',
+                        default=None)
+    parser.add_argument('--retries',
+                        dest='retries',
+                        type=int,
+                        help='Retries for throttled AWS requests when updating',
+                        default=5)
+    parser.add_argument('--unchanged',
+                        dest='unchanged',
+                        choices=['run', 'skip', 'test'],
+                        help=("What to do when the salt data, grains and "
+                              "pillar are unchanged since the last successful "
+                              "run of the state"),
+                        default='run')
+    parser.add_argument('--changed-only',
+                        dest='changed_only',
+                        help=("Only apply the parts of the highstate affected "
+                              "by changes since the last highstated bundle"),
+                        action='store_true')
+    parser.add_argument('--timing-report',
+                        dest='timing_report',
+                        type=str,
+                        help="Write a JSON report of state timings to this file",
+                        default=None)
+    parser.add_argument('--output',
+                        dest='output',
+                        choices=['highstate', 'compact', 'none'],
+                        help=("How to print state results, the full highstate "
+                              "output, only failures and changes, or nothing"),
+                        default='highstate')
+    parser.add_argument('--metrics-dir',
+                        dest='metrics_dir',
+                        type=str,
+                        help=("node-exporter textfile collector directory to "
+                              "write metrics to"),
+                        default=TEXTFILE_DIR)
+    return parser
+
+
+def get_update_args(args):
+    """
+    Returns:
+        (list): The salt_utils_update.py command line for these arguments
+    """
+    update_args = ["salt_utils_update.py",
+                   "--loglevel",
+                   args.loglevel,
+                   "--splay",
+                   str(args.splay),
+                   "--retries",
+                   str(args.retries),
+                   "--metrics-dir",
+                   args.metrics_dir]
+    if args.stagger:
+        update_args.append("--stagger")
+    if args.rate_limit:
+        update_args.extend(["--rate-limit", str(args.rate_limit)])
+    return update_args
+
+
+if __name__ == "__main__":
+    parser = get_parser()
     args = parser.parse_args()
     logger.debug("Running with arg {}"
                  .format(args))
@@ -60,16 +146,24 @@ if __name__ == "__main__":
         logger.critical("The state argument is required unless the update_only "
                         " argument is set... aborting")
         sys.exit(1)
+    if args.state and 'highstate' in args.state and len(args.state) > 1:
+        logger.critical("highstate can't be run together with other states, "
+                        "please run it on its own... aborting")
+        sys.exit(1)
 
+    metrics = SaltUtilsMetrics('salt_utils', args.metrics_dir)
+    success = True
     if not args.disable_update:
         # Sync the salt data from an the s3 store and synchronise
-        return_code = subprocess.call(["salt_utils_update.py",
-                                       "--loglevel",
-                                       args.loglevel])
+        update_args = get_update_args(args)
+        with metrics.phase('update'):
+            return_code = subprocess.call(update_args)
         if return_code != 0:
+            success = False
             if not args.ignore_errors:
                 logger.critical("There was a problem updating the "
                                 "remote salt data...aborting.")
+                metrics.write(success)
                 sys.exit(return_code)
             else:
                 logger.critical("There was a problem updating the remote salt data, "
@@ -77,17 +171,33 @@ if __name__ == "__main__":
 
     if not args.update_only:
         # Run the state
-        return_code = subprocess.call(["salt_utils_state.py",
-                                       "-s",
-                                       args.state,
-                                       "--loglevel",
-                                       args.loglevel])
+        state_args = ["salt_utils_state.py", "-s"]
+        state_args.extend(args.state)
+        state_args.extend(["--loglevel",
+                           args.loglevel,
+                           "--unchanged",
+                           args.unchanged,
+                           "--output",
+                           args.output,
+                           "--metrics-dir",
+                           args.metrics_dir])
+        if args.changed_only:
+            state_args.append("--changed-only")
+        if args.concurrent:
+            state_args.append("--concurrent")
+        if args.timing_report:
+            state_args.extend(["--timing-report", args.timing_report])
+        with metrics.phase('state'):
+            return_code = subprocess.call(state_args)
         if return_code != 0:
+            success = False
             if not args.ignore_errors:
                 logger.critical("There was a problem running the "
                                 "salt state...aborting.")
+                metrics.write(success)
                 sys.exit(return_code)
             else:
                 logger.critical("There was a problem running the salt state,"
                                 "ignore errors set so continuing execution.")
+    metrics.write(success)
     sys.exit(0)
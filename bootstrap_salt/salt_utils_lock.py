@@ -0,0 +1,105 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger("bootstrap-salt::salt_utils_lock")
+
+# Lock and status files live on tmpfs, next to the cached data key, so a
+# reboot clears any stale state.
+LOCK_DIR = '/run/bootstrap-salt'
+
+
+class SaltUtilsLock():
+    """
+    An exclusive lock shared by the salt_utils scripts, so that an update or
+    state run started by cron cannot overlap with one started over SSH or by
+    the agent.
+
+    The lock also keeps a small status file recording when each kind of run
+    last finished, which lets a run that had to wait for the lock work out
+    whether the run it waited on already did its work for it.
+    """
+
+    def __init__(self, name='salt_utils', lock_dir=None):
+        """
+        Args:
+            name(string): Name of the lock
+            lock_dir(string): Directory for the lock and status files,
+                defaults to LOCK_DIR
+        """
+        lock_dir = lock_dir or LOCK_DIR
+        self.lock_dir = lock_dir
+        self.lock_file = os.path.join(lock_dir, '{0}.lock'.format(name))
+        self.status_file = os.path.join(lock_dir, '{0}.status'.format(name))
+        self.fd = None
+        self.started = None
+
+    def acquire(self):
+        """
+        Take the lock, waiting for any run that currently holds it.
+        """
+        try:
+            os.makedirs(self.lock_dir, 0700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self.fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            logger.info("acquire: Another salt_utils run is in progress, "
+                        "waiting for it to finish...")
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        self.started = time.time()
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def read_status(self):
+        try:
+            with open(self.status_file) as status_file:
+                return json.load(status_file)
+        except (IOError, ValueError):
+            return {}
+
+    def last_run(self, kind):
+        """
+        Args:
+            kind(string): The kind of run, e.g. 'update' or 'state'
+        Returns:
+            (dict): Details of the last successful run of this kind, with
+                'started' and 'finished' timestamps, or None
+        """
+        return self.read_status().get(kind)
+
+    def record_run(self, kind, **details):
+        """
+        Record a successful run while holding the lock. The status file is
+        replaced atomically.
+
+        Args:
+            kind(string): The kind of run, e.g. 'update' or 'state'
+            details: Any extra details to store with the run
+        """
+        status = self.read_status()
+        details.update({'started': self.started, 'finished': time.time()})
+        status[kind] = details
+        tmp_file = '{0}.{1}'.format(self.status_file, os.getpid())
+        with open(tmp_file, 'w') as status_file:
+            json.dump(status, status_file)
+        os.rename(tmp_file, self.status_file)
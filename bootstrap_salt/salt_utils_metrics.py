@@ -0,0 +1,150 @@
+import contextlib
+import logging
+import os
+import re
+import time
+
+logger = logging.getLogger("bootstrap-salt::salt_utils_metrics")
+
+# The default directory of node-exporter's textfile collector
+TEXTFILE_DIR = '/var/lib/node_exporter/textfile_collector'
+
+METRIC_HELP = {
+    'bootstrap_salt_phase_duration_seconds':
+        'Time spent in each phase of the last run',
+    'bootstrap_salt_bundle_size_bytes':
+        'Size of the last downloaded salt bundle',
+    'bootstrap_salt_bundle_info':
+        'Version of the salt bundle last applied',
+    'bootstrap_salt_states':
+        'Number of states in the last state run, by status',
+    'bootstrap_salt_last_run_success':
+        'Whether the last run succeeded',
+    'bootstrap_salt_last_run_timestamp_seconds':
+        'Time the last run finished',
+    'bootstrap_salt_last_success_timestamp_seconds':
+        'Time the last successful run finished',
+}
+
+SAMPLE_RE = re.compile(r'^(\w+)(\{.*\})?\s+(\S+)$')
+
+
+class SaltUtilsMetrics():
+    """
+    Collect metrics for a salt_utils script and write them for
+    node-exporter's textfile collector, so that slow or stale minions can be
+    alerted on. Each script writes its own file, which is replaced
+    atomically so node-exporter never reads a partial file.
+    """
+
+    def __init__(self, script, textfile_dir=None):
+        """
+        Args:
+            script(string): Name of the script, used for the file name and
+                the 'script' label, e.g. 'salt_utils_update'
+            textfile_dir(string): Directory node-exporter reads, defaults to
+                TEXTFILE_DIR
+        """
+        self.script = script
+        self.textfile_dir = textfile_dir or TEXTFILE_DIR
+        self.path = os.path.join(self.textfile_dir,
+                                 'bootstrap_salt_{0}.prom'.format(script))
+        self.samples = {}
+
+    def reset(self):
+        """
+        Forget the samples of the last run, so that a long running process
+        that records several runs, such as the update agent, only writes
+        the series from the latest one.
+        """
+        self.samples = {}
+
+    def set(self, metric, value, **labels):
+        """
+        Set a gauge, labelled with the script name and any extra labels.
+        """
+        labels['script'] = self.script
+        self.samples[(metric, tuple(sorted(labels.items())))] = value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time a phase of the run, e.g. 'download' or 'state'. The duration
+        is recorded even if the phase fails.
+        """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.set('bootstrap_salt_phase_duration_seconds',
+                     time.time() - started, phase=name)
+
+    def previous_value(self, metric):
+        """
+        Returns:
+            (float): The value of a metric in the file written by the last
+                run, or None
+        """
+        try:
+            with open(self.path) as textfile:
+                for line in textfile:
+                    sample = SAMPLE_RE.match(line.strip())
+                    if sample and sample.group(1) == metric:
+                        return float(sample.group(3))
+        except (IOError, ValueError):
+            pass
+        return None
+
+    def render(self):
+        lines = []
+        for metric in sorted(set(key[0] for key in self.samples)):
+            if metric in METRIC_HELP:
+                lines.append('# HELP {0} {1}'
+                             .format(metric, METRIC_HELP[metric]))
+            lines.append('# TYPE {0} gauge'.format(metric))
+            for (name, labels), value in sorted(self.samples.items()):
+                if name != metric:
+                    continue
+                label_text = ','.join(
+                    '{0}="{1}"'.format(key, str(label).replace('\\', '\\\\')
+                                                      .replace('"', '\\"'))
+                    for key, label in labels)
+                lines.append('{0}{{{1}}} {2}'
+                             .format(metric, label_text, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, success):
+        """
+        Record the outcome of the run and write the metrics file. The last
+        success timestamp is carried over from the previous file when the
+        run failed, so that staleness can still be alerted on. Nothing is
+        written if node-exporter's textfile directory doesn't exist.
+
+        Args:
+            success(bool): Whether the run succeeded
+        """
+        if not os.path.isdir(self.textfile_dir):
+            logger.debug("write: {} does not exist, not writing metrics"
+                         .format(self.textfile_dir))
+            return
+        now = time.time()
+        self.set('bootstrap_salt_last_run_success', int(bool(success)))
+        self.set('bootstrap_salt_last_run_timestamp_seconds', now)
+        if success:
+            last_success = now
+        else:
+            last_success = self.previous_value(
+                'bootstrap_salt_last_success_timestamp_seconds')
+        if last_success is not None:
+            self.set('bootstrap_salt_last_success_timestamp_seconds',
+                     last_success)
+
+        tmp_file = '{0}.{1}'.format(self.path, os.getpid())
+        try:
+            with open(tmp_file, 'w') as textfile:
+                textfile.write(self.render())
+            os.chmod(tmp_file, 0644)
+            os.rename(tmp_file, self.path)
+        except (IOError, OSError) as err:
+            logger.warning("write: Could not write metrics to {}: {}"
+                           .format(self.path, err))
@@ -2,19 +2,38 @@
 import argparse
 from salt.log.setup import setup_console_logger, setup_logfile_logger
 
+import hashlib
+import heapq
+import json
+import errno
 import logging
+import multiprocessing
+import os
+import shutil
+import time
 
 import salt
 import salt.client
 import salt.config
 import salt.output
 
+from salt_utils_lock import SaltUtilsLock
+from salt_utils_metrics import SaltUtilsMetrics, TEXTFILE_DIR
+import sls_index
+
 # Set up the logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("bootstrap-salt::salt_utils_state")
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger('boto').setLevel(logging.CRITICAL)
 
+# The decrypted salt bundle, as extracted by salt_utils_update.py
+BUNDLE_FILE = '/srv.tar'
+
+# A copy of the SLS index from the last bundle that was highstated, used to
+# work out what has changed since
+APPLIED_SLS_INDEX_FILE = '/var/cache/salt/bootstrap-salt/applied_sls_index.json'
+
 
 class BootstrapUtilError(Exception):
     def __init__(self, msg):
@@ -29,15 +48,54 @@ class SaltParserError(BootstrapUtilError):
     pass
 
 
+def run_sls_group(args):
+    """
+    Run a group of SLS IDs with a salt caller of its own, in a
+    multiprocessing worker.
+
+    Args:
+        args(tuple): The SLS IDs and the keyword arguments for state.sls
+    Returns:
+        The state results, or a list of errors
+    """
+    group, kwargs = args
+    try:
+        return salt.client.Caller().function(
+            'state.sls', ','.join(group), concurrent=True, **kwargs)
+    except Exception as err:
+        # Salt's exceptions may not survive the trip back to the parent
+        return ["Running {} failed: {}".format(','.join(group), err)]
+
+
 class SaltUtilsStateWrapper():
     """
     Class to wrap the saltutil state caller. It provides some logging
     and error parsing.
     """
     caller = None
+    timing_report_file = None
+    slowest = 10
+    output = 'highstate'
+    metrics = None
 
-    def __init__(self):
+    def __init__(self, timing_report_file=None, slowest=10,
+                 output='highstate', metrics=None):
+        """
+        Args:
+            timing_report_file(string): Path to write a JSON timing report
+                of each state run to, or None
+            slowest(int): Number of slowest states to report
+            output(string): How to print state results, 'highstate' for
+                salt's full highstate output, 'compact' for only failures,
+                changes and counts, or 'none'
+            metrics(SaltUtilsMetrics): Where to record the state run's
+                timing and results, defaults to metrics for salt_utils_state
+        """
         self.caller = salt.client.Caller()
+        self.timing_report_file = timing_report_file
+        self.slowest = slowest
+        self.output = output
+        self.metrics = metrics or SaltUtilsMetrics('salt_utils_state')
 
     def highstate(self):
         """
@@ -45,54 +103,386 @@ class SaltUtilsStateWrapper():
         """
         self.state("highstate")
 
-    def state(self, state):
+    def run(self, state, unchanged='run', changed_only=False,
+            concurrent=False):
         """
-        Run a salt state with data from the remote s3 bucket
+        Run a salt state while holding the salt_utils lock, so it cannot
+        overlap with an update or another state run. If the same state
+        finished successfully while we were waiting for the lock, and the
+        salt data has not been updated since it started, it is not run
+        again.
+
+        Args:
+            state(string): the state to run, or a comma separated list of
+                SLS IDs
+            unchanged(string): What to do when the salt bundle, grains and
+                pillar are identical to the last successful run of this
+                state: 'run' it anyway, 'skip' it, or do a 'test' run
+            changed_only(bool): For a highstate, only apply the SLS IDs
+                affected by changes since the last highstated bundle
+            concurrent(bool): Run independent SLS IDs concurrently
+        Raises:
+            SaltParserError: if any minion cannot execute the state
+            SaltStateError: if any state execution returns False
+        """
+        requested = time.time()
+        with SaltUtilsLock() as lock:
+            last_state = lock.last_run('state')
+            last_update = lock.last_run('update')
+            if (last_state and last_state['finished'] >= requested and
+                    last_state.get('state') == state and
+                    (last_update is None or
+                     last_update['finished'] <= last_state['started'])):
+                logger.info("run: State '{}' was run by another process "
+                            "while waiting, skipping".format(state))
+                return True
+
+            fingerprint = None
+            if unchanged != 'run':
+                fingerprint = self.get_fingerprint(state)
+                if (last_state and last_state.get('state') == state and
+                        last_state.get('fingerprint') == fingerprint):
+                    if unchanged == 'skip':
+                        logger.info("run: Nothing has changed since the last "
+                                    "run of '{}', skipping".format(state))
+                        return True
+                    logger.info("run: Nothing has changed since the last "
+                                "run of '{}', doing a test run".format(state))
+                    return self.state(state, test=True, concurrent=concurrent)
+            with self.metrics.phase('state'):
+                if changed_only and state == 'highstate':
+                    result = self.changed_highstate(concurrent=concurrent)
+                else:
+                    result = self.state(state, concurrent=concurrent)
+            if state == 'highstate':
+                self.record_applied_index()
+            lock.record_run('state', state=state, fingerprint=fingerprint)
+        return result
+
+    def run_with_metrics(self, state, **kwargs):
+        """
+        Run a state as run() does and write its metrics, whether it
+        succeeds or fails.
 
         Args:
             state(string): the state to run
+            kwargs: Options for run()
+        """
+        self.metrics.reset()
+        success = False
+        try:
+            result = self.run(state, **kwargs)
+            success = True
+        finally:
+            self.metrics.write(success)
+        return result
+
+    def get_changed_sls(self):
+        """
+        Work out which of this minion's SLS IDs are affected by the changes
+        between the current bundle and the last one highstated.
+
+        Returns:
+            (list): The SLS IDs to apply, or None if a full highstate is
+                needed
+        """
+        affected = sls_index.affected_sls(
+            sls_index.load_index(APPLIED_SLS_INDEX_FILE),
+            sls_index.load_index(sls_index.INDEX_FILE))
+        if affected is None:
+            return None
+        top = self.caller.function('state.show_top')
+        if not isinstance(top, dict):
+            return None
+        top_sls = set(sls for env_sls in top.values() for sls in env_sls)
+        return sorted(affected & top_sls)
+
+    def changed_highstate(self, concurrent=False):
+        """
+        Apply only the SLS IDs affected by changes since the last highstated
+        bundle, falling back to a full highstate if they can't be worked
+        out.
+
+        Args:
+            concurrent(bool): Run independent SLS IDs concurrently
+        Raises:
+            SaltParserError: if any minion cannot execute the state
+            SaltStateError: if any state execution returns False
+        """
+        targets = self.get_changed_sls()
+        if targets is None:
+            logger.info("changed_highstate: Can't tell what has changed, "
+                        "running a full highstate")
+            return self.state('highstate')
+        if not targets:
+            logger.info("changed_highstate: No states are affected by the "
+                        "changes, nothing to do")
+            return True
+        logger.info("changed_highstate: Applying affected states: {}"
+                    .format(', '.join(targets)))
+        return self.state(','.join(targets), concurrent=concurrent)
+
+    def record_applied_index(self):
+        if not os.path.isfile(sls_index.INDEX_FILE):
+            return
+        try:
+            os.makedirs(os.path.dirname(APPLIED_SLS_INDEX_FILE), 0700)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        shutil.copyfile(sls_index.INDEX_FILE, APPLIED_SLS_INDEX_FILE)
+
+    def get_fingerprint(self, state):
+        """
+        Fingerprint the inputs of a state run: the state name, a digest of
+        the salt bundle and hashes of the grains and pillar.
+
+        Args:
+            state(string): the state to run
+        Returns:
+            (string): A hex digest identifying the inputs
+        """
+        fingerprint = hashlib.sha256(state)
+        if os.path.isfile(BUNDLE_FILE):
+            with open(BUNDLE_FILE, 'rb') as bundle:
+                for chunk in iter(lambda: bundle.read(1024 * 1024), ''):
+                    fingerprint.update(chunk)
+        for function in ('grains.items', 'pillar.items'):
+            data = self.caller.function(function)
+            fingerprint.update(json.dumps(data, sort_keys=True, default=str))
+        return fingerprint.hexdigest()
+
+    def state(self, state, test=False, concurrent=False):
+        """
+        Run a salt state with data from the remote s3 bucket
+
+        Args:
+            state(string): the state to run, or a comma separated list of
+                SLS IDs to run together in one salt call
+            test(bool): Only report what would change
+            concurrent(bool): Split the SLS IDs into groups that share no
+                dependencies and run the groups concurrently
         Raises:
             SaltParserError: if any minion cannot execute the state
             SaltStateError: if any state execution returns False
         """
         logger.info("state: Running state '{}'...".format(state))
 
+        kwargs = {'test': True} if test else {}
         # Highstate has its own state call
         if state == 'highstate':
-            result = self.caller.function('state.highstate')
+            result = self.caller.function('state.highstate', **kwargs)
+        elif concurrent and ',' in state:
+            result = self.concurrent_sls(state.split(','), **kwargs)
         else:
-            result = self.caller.function('state.sls', state)
+            result = self.caller.function('state.sls', state, **kwargs)
         logger.debug("state: State results: {}".format(result))
-        return self.check_state_result(result)
+        return self.check_state_result(result, test=test)
+
+    def concurrent_sls(self, sls_ids, **kwargs):
+        """
+        Run groups of independent SLS IDs concurrently using salt's
+        concurrent state runs, and merge their results. Salt's loader
+        isn't thread safe, so each group runs in a process of its own.
+
+        Args:
+            sls_ids(list): The SLS IDs to run
+        Returns:
+            (dict): The merged state results, or a list of errors if any
+                group could not be run
+        """
+        groups = sls_index.independent_groups(
+            sls_index.load_index(sls_index.INDEX_FILE), sls_ids)
+        logger.info("concurrent_sls: Running {} group(s) concurrently: {}"
+                    .format(len(groups),
+                            '; '.join(','.join(group) for group in groups)))
+        if len(groups) == 1:
+            return self.caller.function('state.sls', ','.join(groups[0]),
+                                        **kwargs)
+
+        pool = multiprocessing.Pool(len(groups))
+        try:
+            results = pool.map(run_sls_group,
+                               [(group, kwargs) for group in groups])
+        finally:
+            pool.close()
+            pool.join()
+
+        merged = {}
+        errors = []
+        for result in results:
+            if isinstance(result, dict):
+                merged.update(result)
+            elif isinstance(result, list):
+                errors.extend(result)
+            else:
+                errors.append(str(result))
+        if errors:
+            for state_id, state_result in merged.items():
+                if state_result.get('result') is False:
+                    errors.append("State {} failed".format(state_id))
+            return errors
+        return merged
+
+    def timing_report(self, result):
+        """
+        Build a timing report from the durations salt records for each
+        state.
+
+        Args:
+            result(dict): salt results dictionary
+        Returns:
+            (dict): The total time, the slowest states, the total time per
+                SLS and the time spent in changed and unchanged states, all
+                in milliseconds
+        """
+        report = self.new_timing_report()
+        for state_id, state_result in result.iteritems():
+            self.add_state_timing(report, state_id, state_result)
+        return self.finish_timing_report(report)
 
-    def check_state_result(self, result):
+    @staticmethod
+    def new_timing_report():
+        return {'states': 0,
+                'total': 0.0,
+                'changed': 0.0,
+                'unchanged': 0.0,
+                'slowest': [],
+                'by_sls': {}}
+
+    def add_state_timing(self, report, state_id, state_result):
+        """
+        Add one state to a timing report, keeping only the slowest states
+        so that the report can be built while the results are walked.
+
+        Args:
+            report(dict): A report from new_timing_report
+            state_id(string): The state ID from the results dictionary
+            state_result(dict): The result of the state
+        """
+        state = {'id': state_id,
+                 'sls': state_result.get('__sls__', 'unknown'),
+                 'duration': self.state_duration(state_result),
+                 'start_time': state_result.get('start_time'),
+                 'run_num': state_result.get('__run_num__'),
+                 'changed': bool(state_result.get('changes')),
+                 'result': state_result.get('result')}
+        report['states'] += 1
+        by_sls = report['by_sls']
+        by_sls[state['sls']] = by_sls.get(state['sls'], 0.0) + state['duration']
+        if state['changed']:
+            report['changed'] += state['duration']
+        else:
+            report['unchanged'] += state['duration']
+        slowest = report['slowest']
+        entry = (state['duration'], report['states'], state)
+        if len(slowest) < self.slowest:
+            heapq.heappush(slowest, entry)
+        elif slowest and entry > slowest[0]:
+            heapq.heapreplace(slowest, entry)
+
+    @staticmethod
+    def finish_timing_report(report):
+        report['total'] = report['changed'] + report['unchanged']
+        report['slowest'] = [item[2] for item in
+                             sorted(report['slowest'], reverse=True)]
+        return report
+
+    @staticmethod
+    def state_duration(state_result):
+        duration = state_result.get('duration', 0)
+        if isinstance(duration, basestring):
+            # Older salt versions report e.g. "12.3 ms"
+            try:
+                duration = float(duration.split()[0])
+            except (ValueError, IndexError):
+                duration = 0
+        return float(duration or 0)
+
+    def log_timing_report(self, report):
+        logger.info("timing_report: {} states took {:.0f}ms, {:.0f}ms in "
+                    "states with changes and {:.0f}ms in unchanged states"
+                    .format(report['states'], report['total'],
+                            report['changed'], report['unchanged']))
+        for state in report['slowest']:
+            logger.info("timing_report: {:>10.0f}ms {} ({})"
+                        .format(state['duration'], state['id'], state['sls']))
+        for sls, duration in sorted(report['by_sls'].items(),
+                                    key=lambda item: item[1],
+                                    reverse=True)[:self.slowest]:
+            logger.info("timing_report: {:>10.0f}ms total in sls {}"
+                        .format(duration, sls))
+        if self.timing_report_file:
+            with open(self.timing_report_file, 'w') as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+
+    def check_state_result(self, result, test=False):
         """
-        Takes a salt results dictionary, prints the output
-        in salts highstate output format and checks all states
-        executed successfully. Returns True on success.
+        Takes a salt results dictionary, prints the output in the
+        configured output format and checks all states executed
+        successfully. Returns True on success.
+
+        The results are checked and the timing report built in a single
+        pass, so that large highstates don't need any copies of the result
+        held in memory.
 
         Args:
             result(dict): salt results dictionary
+            test(bool): The result is from a test run, where a result of
+                None means the state would make changes
 
         Raises:
             SaltParserError: if any minion cannot execute the state
             SaltStateError: if any state execution returns False
         """
-        __opts__ = salt.config.minion_config('/etc/salt/minion')
-        salt.output.display_output({'local': result},
-                                   out='highstate',
-                                   opts=__opts__)
+        if self.output == 'highstate':
+            __opts__ = salt.config.minion_config('/etc/salt/minion')
+            salt.output.display_output({'local': result},
+                                       out='highstate',
+                                       opts=__opts__)
         if isinstance(result, dict):
-            # This uses a syntax parsing check to verify true results
-            results = [v['result'] for v in result.values()]
-            if all(results):
+            report = self.new_timing_report()
+            failed = changed = 0
+            failed_states = []
+            for state_id, state_result in result.iteritems():
+                self.add_state_timing(report, state_id, state_result)
+                ok = state_result['result']
+                state_failed = ok is False if test else not ok
+                state_changed = bool(state_result.get('changes'))
+                failed += state_failed
+                changed += state_changed
+                if state_failed:
+                    failed_states.append({
+                        'id': state_id,
+                        'sls': state_result.get('__sls__', 'unknown'),
+                        'comment': state_result.get('comment', '')})
+                if self.output == 'compact' and (state_failed or
+                                                 state_changed):
+                    self.display_compact(state_id, state_result,
+                                         state_failed)
+            report = self.finish_timing_report(report)
+            report['failed'] = failed_states
+            self.log_timing_report(report)
+            if self.output == 'compact':
+                print("Summary: {0} states, {1} changed, {2} failed"
+                      .format(len(result), changed, failed))
+            if not test:
+                for status, count in (('total', len(result)),
+                                      ('changed', changed),
+                                      ('failed', failed)):
+                    self.metrics.set('bootstrap_salt_states', count,
+                                     status=status)
+            if not failed:
                 logging.info("check_state_result: All states successful")
                 return True
             else:
                 raise SaltStateError('State did not execute successfully')
         elif isinstance(result, list):
                 for entry in result:
-                    if "failed" in entry.lower() or "error" in entry.lower():
+                    if self.output == 'compact':
+                        print(entry)
+                    lowered = entry.lower()
+                    if "failed" in lowered or "error" in lowered:
                         logging.critical("check_state_result: "
                                          "State failed, '{}'"
                                          .format(entry))
@@ -103,24 +493,93 @@ class SaltUtilsStateWrapper():
         else:
             raise SaltParserError('Minion could not parse state data')
 
+    def display_compact(self, state_id, state_result, failed):
+        """
+        Print one line for a state that failed or made changes.
+
+        Args:
+            state_id(string): The state ID from the results dictionary, e.g.
+                'pkg_|-nginx_|-nginx_|-installed'
+            state_result(dict): The result of the state
+            failed(bool): The state failed
+        """
+        parts = state_id.split('_|-')
+        if len(parts) == 4:
+            name = '{0}.{3}: {2}'.format(*parts)
+        else:
+            name = state_id
+        if failed:
+            print("Failed:  {0} ({1}): {2}"
+                  .format(name, state_result.get('__sls__', 'unknown'),
+                          state_result.get('comment', '')))
+        else:
+            print("Changed: {0} ({1}): {2}"
+                  .format(name, state_result.get('__sls__', 'unknown'),
+                          ', '.join(sorted(state_result['changes']))))
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run salt states')
     parser.add_argument('-s',
                         dest='state',
                         type=str,
-                        help='Name of state or highstate',
+                        nargs='+',
+                        help=('Name of state or highstate, several SLS IDs '
+                              'may be given to run them in one salt call'),
                         required=True)
+    parser.add_argument('--concurrent',
+                        dest='concurrent',
+                        help=('Run SLS IDs that share no dependencies '
+                              'concurrently'),
+                        action='store_true')
     parser.add_argument('--loglevel',
                         dest='loglevel',
                         type=str,
                         help=("Level of logging detail, "
                               "debug, info, warning, error or critical"),
                         default="info")
+    parser.add_argument('--unchanged',
+                        dest='unchanged',
+                        choices=['run', 'skip', 'test'],
+                        help=("What to do when the salt data, grains and "
+                              "pillar are unchanged since the last successful "
+                              "run of the state"),
+                        default='run')
+    parser.add_argument('--changed-only',
+                        dest='changed_only',
+                        help=("Only apply the parts of the highstate affected "
+                              "by changes since the last highstated bundle"),
+                        action='store_true')
+    parser.add_argument('--timing-report',
+                        dest='timing_report',
+                        type=str,
+                        help=("Write a JSON report of state timings and failed "
+                              "states to this file"),
+                        default=None)
+    parser.add_argument('--output',
+                        dest='output',
+                        choices=['highstate', 'compact', 'none'],
+                        help=("How to print state results, the full highstate "
+                              "output, only failures and changes, or nothing"),
+                        default='highstate')
+    parser.add_argument('--metrics-dir',
+                        dest='metrics_dir',
+                        type=str,
+                        help=("node-exporter textfile collector directory to "
+                              "write metrics to"),
+                        default=TEXTFILE_DIR)
     args = parser.parse_args()
+    if 'highstate' in args.state and len(args.state) > 1:
+        parser.error("highstate can't be run together with other states")
     setup_console_logger(log_level=args.loglevel)
     setup_logfile_logger(log_path='/var/log/salt/minion',
                          log_level=args.loglevel)
 
-    salt_utils_state_wrapper = SaltUtilsStateWrapper()
-    salt_utils_state_wrapper.state(args.state)
+    salt_utils_state_wrapper = SaltUtilsStateWrapper(
+        timing_report_file=args.timing_report,
+        output=args.output,
+        metrics=SaltUtilsMetrics('salt_utils_state', args.metrics_dir))
+    salt_utils_state_wrapper.run_with_metrics(','.join(args.state),
+                                              unchanged=args.unchanged,
+                                              changed_only=args.changed_only,
+                                              concurrent=args.concurrent)
@@ -4,25 +4,89 @@ from salt.log.setup import setup_console_logger, setup_logfile_logger
 
 import boto.s3
 import boto.kms
+from boto.exception import BotoServerError
 import gnupg
 import shutil
 
 import base64
+import errno
+import hashlib
+import json
 import logging
 import os
+import random
 import sys
+import threading
+import time
 
 import salt
 import salt.client
 import salt.config
 import tarfile
 
+from salt_utils_lock import SaltUtilsLock
+from salt_utils_metrics import SaltUtilsMetrics, TEXTFILE_DIR
+from salt_utils_state import SaltUtilsStateWrapper
+
 # Set up the logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("bootstrap-salt::salt_utils_update")
 logging.getLogger("requests").setLevel(logging.WARNING)
 logging.getLogger('boto').setLevel(logging.CRITICAL)
 
+# The S3 etag of the last bundle that was applied to this minion, used by
+# the agent to tell whether a new bundle has been uploaded.
+BUNDLE_VERSION_FILE = '/srv.tar.etag'
+
+# The decrypted data key is cached here so that each salt_utils run does not
+# need a KMS round trip. /run is a tmpfs, so the key never reaches the disk.
+DATA_KEY_CACHE_FILE = '/run/bootstrap-salt/salt.key'
+DATA_KEY_CACHE_TTL = 3600
+
+# AWS error codes that mean "slow down" rather than a real failure
+THROTTLING_ERROR_CODES = ('Throttling',
+                          'ThrottlingException',
+                          'RequestLimitExceeded',
+                          'SlowDown',
+                          'ServiceUnavailable')
+
+
+class TokenBucket():
+    """
+    A simple token bucket used to cap the rate of AWS requests made by
+    this minion, so retries and polls back off instead of piling up.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Args:
+            rate(float): Tokens added to the bucket per second
+            capacity(float): Maximum number of tokens held, defaults to
+                one second's worth
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take a token, sleeping until one is available.
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            wait = (1 - self.tokens) / self.rate
+            self.tokens = 0
+            self.last = now + wait
+        time.sleep(wait)
+
 
 class SaltUtilsUpdateWrapper():
     """
@@ -32,19 +96,103 @@ class SaltUtilsUpdateWrapper():
     caller = None
     kms_connection = None
     s3_connection = None
+    bucket_name = None
+    data_key = None
+    data_key_digest = None
+    key_cache_ttl = DATA_KEY_CACHE_TTL
+    splay = 0
+    stagger = False
+    retries = 5
+    rate_limiter = None
+    metrics = None
 
-    def __init__(self):
+    def __init__(self, splay=0, stagger=False, rate_limit=None, retries=5,
+                 key_cache_ttl=DATA_KEY_CACHE_TTL, metrics=None):
+        """
+        Args:
+            splay(int): Spread updates over this many seconds
+            stagger(bool): Derive the splay delay from a hash of the
+                instance ID instead of picking it at random, so each minion
+                always takes the same slot in the window
+            rate_limit(float): Maximum AWS requests per second, None for
+                no limit
+            retries(int): Number of times to retry throttled AWS requests
+            key_cache_ttl(int): Seconds to cache the decrypted data key on
+                tmpfs for, 0 to disable the tmpfs cache
+            metrics(SaltUtilsMetrics): Where to record phase timings and
+                bundle details, defaults to metrics for salt_utils_update
+        """
         self.caller = salt.client.Caller()
+        self.splay = splay
+        self.stagger = stagger
+        self.retries = retries
+        self.key_cache_ttl = key_cache_ttl
+        if rate_limit:
+            self.rate_limiter = TokenBucket(rate_limit)
+        self.metrics = metrics or SaltUtilsMetrics('salt_utils_update')
 
-    def get_salt_data(self):
+    def get_splay_delay(self):
         """
-        Download the salt configuration and support files from an S3
-        bucket and extract them to the correct folder.
+        Work out how long this minion should wait before fetching new salt
+        data.
+
+        Returns:
+            (float): The delay in seconds
         """
-        logger.info("get_salt_data: Getting remote salt data...")
+        if not self.splay:
+            return 0
+        if self.stagger:
+            instance_id = self.caller.function(
+                'grains.item', 'aws_instance_id')['aws_instance_id']
+            digest = hashlib.md5(str(instance_id)).hexdigest()
+            return int(digest, 16) % int(self.splay)
+        return random.uniform(0, self.splay)
+
+    def wait_for_splay(self):
+        delay = self.get_splay_delay()
+        if delay:
+            logger.info("wait_for_splay: Waiting {:.1f}s before updating..."
+                        .format(delay))
+            time.sleep(delay)
+
+    def call_aws(self, func, *args, **kwargs):
+        """
+        Call an AWS API function, respecting the rate limit and retrying
+        throttled or unavailable responses with exponential backoff and
+        full jitter.
 
-        # Set up the connection to AWS
-        logger.info("get_salt_data: Setting up AWS connection...")
+        Args:
+            func(callable): The boto function to call
+        Returns:
+            The return value of func
+        """
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                return func(*args, **kwargs)
+            except BotoServerError as err:
+                throttled = (err.status in (500, 503) or
+                             err.error_code in THROTTLING_ERROR_CODES)
+                if not throttled or attempt >= self.retries:
+                    raise
+                delay = random.uniform(0, min(60, 2 ** attempt))
+                logger.warning("call_aws: {} returned {} {}, retrying in {:.1f}s"
+                               .format(getattr(func, '__name__', func),
+                                       err.status, err.error_code, delay))
+                attempt += 1
+                time.sleep(delay)
+
+    def connect(self):
+        """
+        Set up the AWS connections for this stack's salt bucket. The
+        connections are kept on the wrapper so that repeated calls, as made
+        by the agent, reuse them.
+        """
+        if self.s3_connection is not None:
+            return
+        logger.info("connect: Setting up AWS connection...")
         stack_name_grain = self.caller.function(
             'grains.item',
             'aws:cloudformation:stack-name'
@@ -56,18 +204,61 @@ class SaltUtilsUpdateWrapper():
                                       'aws_region')['aws_region']
         self.kms_connection = boto.kms.connect_to_region(region)
         self.s3_connection = boto.s3.connect_to_region(region)
+        self.bucket_name = '{0}-salt'.format(stack_name)
+
+    def get_remote_bundle(self):
+        """
+        Look up the encrypted salt tar file in the salt bucket. This is a
+        single HEAD request, so it is cheap enough to poll.
+
+        Returns:
+            (boto.s3.key.Key): The bundle key, or None if nothing has been
+                uploaded yet
+        """
+        self.connect()
+        logger.debug("get_remote_bundle: Checking s3 bucket: {}"
+                     .format(self.bucket_name))
+        bucket = self.s3_connection.get_bucket(self.bucket_name, validate=False)
+        return self.call_aws(bucket.get_key, 'srv.tar.gpg')
+
+    def get_applied_version(self):
+        """
+        Read the version of the bundle currently extracted on this minion.
+
+        Returns:
+            (string): The etag of the last bundle applied, or None
+        """
+        try:
+            with open(BUNDLE_VERSION_FILE) as version_file:
+                return version_file.read().strip() or None
+        except IOError:
+            return None
+
+    def set_applied_version(self, version):
+        with open(BUNDLE_VERSION_FILE, 'w') as version_file:
+            version_file.write(version)
+        os.chmod(BUNDLE_VERSION_FILE, 0600)
+
+    def get_salt_data(self):
+        """
+        Download the salt configuration and support files from an S3
+        bucket and extract them to the correct folder.
+        """
+        logger.info("get_salt_data: Getting remote salt data...")
 
         # If the s3 stored tar file exists, download it and decrypt
-        bucket_name = '{0}-salt'.format(stack_name)
-        logger.info("get_salt_data: Getting salt data from s3 bucket: {}"
-                    .format(bucket_name))
-        tar_file = self.s3_connection.get_bucket(bucket_name).get_key('srv.tar.gpg')
+        tar_file = self.get_remote_bundle()
         if tar_file:
             logger.info("get_salt_data: Found tar file: {}"
                         .format(tar_file))
-            tar_file.get_contents_to_filename('/srv.tar.gpg')
+            with self.metrics.phase('download'):
+                self.call_aws(tar_file.get_contents_to_filename,
+                              '/srv.tar.gpg')
             os.chmod('/srv.tar.gpg', 0700)
-            self.decrypt_salt_data()
+            self.metrics.set('bootstrap_salt_bundle_size_bytes',
+                             os.path.getsize('/srv.tar.gpg'))
+            with self.metrics.phase('decrypt'):
+                self.decrypt_salt_data()
             os.chmod('/srv.tar', 0700)
         # If this stack has not been highstated yet, no tar file will
         # be available
@@ -77,12 +268,15 @@ class SaltUtilsUpdateWrapper():
             sys.exit(0)
 
         # Delete the previous configuration files and extract the new
-        logger.info("get_salt_data: Deleting previous salt config...")
-        shutil.rmtree('/srv/salt', ignore_errors=True)
-        shutil.rmtree('/srv/pillar', ignore_errors=True)
-        logger.info("get_salt_data: Extracting tar file...".format(tar_file))
-        self.untar(filename='/srv.tar', path='/')
-        logger.info("get_salt_data: Extracted tar file...".format(tar_file))
+        with self.metrics.phase('extract'):
+            logger.info("get_salt_data: Deleting previous salt config...")
+            shutil.rmtree('/srv/salt', ignore_errors=True)
+            shutil.rmtree('/srv/pillar', ignore_errors=True)
+            logger.info("get_salt_data: Extracting tar file...")
+            self.untar(filename='/srv.tar', path='/')
+        logger.info("get_salt_data: Extracted tar file...")
+        if tar_file:
+            self.set_applied_version(tar_file.etag)
 
     def untar(self, filename, path='/'):
         """
@@ -102,6 +296,86 @@ class SaltUtilsUpdateWrapper():
             tar.extractall(path=path)
         logger.info("untar: Tar file extracted")
 
+    def get_data_key(self, key_file='/etc/salt.key.enc'):
+        """
+        Decrypt the stack's data key with KMS. The plaintext key is kept on
+        the wrapper for the life of the process, and in a root-only file on
+        tmpfs for key_cache_ttl seconds so that separate runs can share it.
+        Both caches are invalidated if the contents of key_file change.
+
+        Args:
+            key_file(string): The path to the file containing the key to use
+        Returns:
+            (string): The plaintext data key
+        """
+        encrypted_key = open(key_file).read()
+        digest = hashlib.sha256(encrypted_key).hexdigest()
+        if self.data_key is not None and self.data_key_digest == digest:
+            return self.data_key
+
+        data_key = self.read_cached_data_key(digest)
+        if data_key is None:
+            self.connect()
+            data_key = self.call_aws(self.kms_connection.decrypt,
+                                     encrypted_key)['Plaintext']
+            self.write_cached_data_key(digest, data_key)
+        self.data_key = data_key
+        self.data_key_digest = digest
+        return self.data_key
+
+    def read_cached_data_key(self, digest):
+        """
+        Read the plaintext data key from the tmpfs cache.
+
+        Args:
+            digest(string): sha256 of the encrypted key the cached key must
+                have been decrypted from
+        Returns:
+            (string): The plaintext key, or None if there is no usable
+                cached key
+        """
+        if self.key_cache_ttl <= 0:
+            return None
+        try:
+            with open(DATA_KEY_CACHE_FILE) as cache_file:
+                cached = json.load(cache_file)
+            if cached['digest'] != digest or cached['expires'] <= time.time():
+                return None
+            return base64.b64decode(cached['key'])
+        except (IOError, ValueError, KeyError, TypeError):
+            return None
+
+    def write_cached_data_key(self, digest, data_key):
+        """
+        Atomically write the plaintext data key to the tmpfs cache. Failing
+        to write the cache is not fatal.
+
+        Args:
+            digest(string): sha256 of the encrypted key
+            data_key(string): The plaintext data key
+        """
+        if self.key_cache_ttl <= 0:
+            return
+        cache_dir = os.path.dirname(DATA_KEY_CACHE_FILE)
+        tmp_file = '{0}.{1}'.format(DATA_KEY_CACHE_FILE, os.getpid())
+        try:
+            try:
+                os.makedirs(cache_dir, 0700)
+            except OSError as err:
+                if err.errno != errno.EEXIST:
+                    raise
+            os.chmod(cache_dir, 0700)
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            with os.fdopen(fd, 'w') as cache_file:
+                json.dump({'digest': digest,
+                           'expires': time.time() + self.key_cache_ttl,
+                           'key': base64.b64encode(data_key)},
+                          cache_file)
+            os.rename(tmp_file, DATA_KEY_CACHE_FILE)
+        except (IOError, OSError) as err:
+            logger.warning("write_cached_data_key: Could not cache data key: {}"
+                           .format(err))
+
     def decrypt_salt_data(self,
                           input_file='/srv.tar.gpg',
                           output_file='/srv.tar',
@@ -114,8 +388,7 @@ class SaltUtilsUpdateWrapper():
             output_file(string): The path to the file to save the decrypted output to
             key_file(string): The path to the file containing the key to use
         """
-        key = self.kms_connection.decrypt(open(key_file).read())['Plaintext']
-        key = base64.b64encode(key)
+        key = base64.b64encode(self.get_data_key(key_file))
         gpg = gnupg.GPG()
         gpg.decrypt_file(open(input_file),
                          passphrase=key,
@@ -130,19 +403,117 @@ class SaltUtilsUpdateWrapper():
         # Fetch the remote salt data
         self.get_salt_data()
 
-        if clear_cache:
-            # Clear minions cache for new data
-            cache_clear_result = self.caller.function('saltutil.clear_cache')
-            logger.info("sync_remote_salt_data: Cleared minion cache: {}"
-                        .format(cache_clear_result))
-        # synchronizes custom modules, states, beacons, grains, returners,
-        # output modules, renderers, and utils.
-        sync_result = self.caller.function('saltutil.sync_all', 'refresh=True')
+        with self.metrics.phase('sync'):
+            if clear_cache:
+                # Clear minions cache for new data
+                cache_clear_result = self.caller.function(
+                    'saltutil.clear_cache')
+                logger.info("sync_remote_salt_data: Cleared minion cache: {}"
+                            .format(cache_clear_result))
+            # synchronizes custom modules, states, beacons, grains, returners,
+            # output modules, renderers, and utils.
+            sync_result = self.caller.function('saltutil.sync_all',
+                                               'refresh=True')
         logger.info("sync_remote_salt_data: "
                     "Synchronised dynamic module data: {}"
                     .format(sync_result))
         return sync_result
 
+    def update(self):
+        """
+        Synchronise the remote salt data while holding the salt_utils lock.
+        If another update finished while we were waiting for the lock and
+        the bundle it applied is still the current one, its result is used
+        instead of doing the work again.
+
+        Returns:
+            The saltutil.sync_all result, or None if the update was
+                coalesced into another run
+        """
+        requested = time.time()
+        with SaltUtilsLock() as lock:
+            last_update = lock.last_run('update')
+            if (last_update and last_update['finished'] >= requested and
+                    not self.is_update_available()):
+                logger.info("update: Salt data was updated by another run "
+                            "while waiting, skipping")
+                self.record_version()
+                return None
+            sync_result = self.sync_remote_salt_data()
+            lock.record_run('update', version=self.get_applied_version())
+        self.record_version()
+        return sync_result
+
+    def update_with_metrics(self):
+        """
+        Run an update and write its metrics, whether it succeeds or fails.
+
+        Returns:
+            The result of update()
+        """
+        self.metrics.reset()
+        success = False
+        try:
+            result = self.update()
+            success = True
+        except SystemExit as err:
+            # An initial bootstrap with no bundle yet exits cleanly
+            success = not err.code
+            raise
+        finally:
+            self.metrics.write(success)
+        return result
+
+    def record_version(self):
+        version = self.get_applied_version()
+        if version:
+            self.metrics.set('bootstrap_salt_bundle_info', 1,
+                             version=version.strip('"'))
+
+    def is_update_available(self):
+        """
+        Check whether the bundle in the salt bucket differs from the one
+        last applied to this minion.
+
+        Returns:
+            bool: True if a new bundle has been uploaded
+        """
+        tar_file = self.get_remote_bundle()
+        if not tar_file:
+            return False
+        return tar_file.etag != self.get_applied_version()
+
+    def run_agent(self, interval=60, state=None):
+        """
+        Poll the salt bucket for new bundles and apply them as they arrive,
+        optionally running a state after each update. Connections, the
+        decrypted data key and the salt caller are kept warm between polls.
+
+        Args:
+            interval(int): Seconds to wait between polls
+            state(string): State to run after applying a new bundle, or
+                None to only update the salt data
+        """
+        logger.info("run_agent: Polling for new salt data every {}s..."
+                    .format(interval))
+        state_wrapper = None
+        if state:
+            state_wrapper = SaltUtilsStateWrapper(
+                metrics=SaltUtilsMetrics('salt_utils_state',
+                                         self.metrics.textfile_dir))
+        while True:
+            try:
+                if self.is_update_available():
+                    logger.info("run_agent: New salt data found, updating...")
+                    self.wait_for_splay()
+                    self.update_with_metrics()
+                    if state_wrapper:
+                        state_wrapper.run_with_metrics(state)
+            except Exception:
+                logger.exception("run_agent: Update failed, "
+                                 "will retry on the next poll")
+            time.sleep(interval)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run salt states')
@@ -151,10 +522,70 @@ if __name__ == "__main__":
                         type=str,
                         help='Level of logging detail',
                         default="info")
+    parser.add_argument('--agent',
+                        dest='agent',
+                        help=('Keep running and apply new salt data as soon '
+                              'as it is uploaded.'),
+                        action='store_true')
+    parser.add_argument('--interval',
+                        dest='interval',
+                        type=int,
+                        help='Seconds between polls in agent mode',
+                        default=60)
+    parser.add_argument('-s',
+                        dest='state',
+                        type=str,
+                        help=('Name of state or highstate to run after each '
+                              'update in agent mode'),
+                        default=None)
+    parser.add_argument('--splay',
+                        dest='splay',
+                        type=int,
+                        help=('Wait up to this many seconds before fetching '
+                              'new salt data, to spread load across the fleet'),
+                        default=0)
+    parser.add_argument('--stagger',
+                        dest='stagger',
+                        help=('Pick the splay delay from a hash of the '
+                              'instance ID rather than at random'),
+                        action='store_true')
+    parser.add_argument('--rate-limit',
+                        dest='rate_limit',
+                        type=float,
+                        help='Maximum AWS requests per second',
+                        default=None)
+    parser.add_argument('--retries',
+                        dest='retries',
+                        type=int,
+                        help='Retries for throttled AWS requests',
+                        default=5)
+    parser.add_argument('--key-cache-ttl',
+                        dest='key_cache_ttl',
+                        type=int,
+                        help=('Seconds to cache the decrypted data key on '
+                              'tmpfs, 0 to disable'),
+                        default=DATA_KEY_CACHE_TTL)
+    parser.add_argument('--metrics-dir',
+                        dest='metrics_dir',
+                        type=str,
+                        help=("node-exporter textfile collector directory to "
+                              "write metrics to"),
+                        default=TEXTFILE_DIR)
     args = parser.parse_args()
     setup_console_logger(log_level=args.loglevel)
     setup_logfile_logger(log_path='/var/log/salt/minion',
                          log_level=args.loglevel)
 
-    salt_utils_update_wrapper = SaltUtilsUpdateWrapper()
-    salt_utils_update_wrapper.sync_remote_salt_data()
+    salt_utils_update_wrapper = SaltUtilsUpdateWrapper(
+        splay=args.splay,
+        stagger=args.stagger,
+        rate_limit=args.rate_limit,
+        retries=args.retries,
+        key_cache_ttl=args.key_cache_ttl,
+        metrics=SaltUtilsMetrics('salt_utils_update', args.metrics_dir))
+    if args.agent:
+        salt_utils_update_wrapper.run_agent(interval=args.interval,
+                                            state=args.state)
+    else:
+        salt_utils_update_wrapper.wait_for_splay()
+        salt_utils_update_wrapper.update_with_metrics()
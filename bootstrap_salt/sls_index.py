@@ -0,0 +1,373 @@
+"""
+Build and query a dependency index of the salt tree shipped in the salt
+bundle.
+
+upload_salt builds the index and ships it in the bundle. On the minion,
+salt_utils_state.py compares it with the index of the last bundle it
+applied to work out which SLS IDs are affected by the files that changed,
+so it can run just those instead of a full highstate.
+
+The index is built from the raw SLS text, without rendering, so it has to
+be conservative: whenever it cannot be sure what a change affects,
+affected_sls returns None and the caller should fall back to a highstate.
+"""
+import hashlib
+import json
+import os
+import re
+
+import yaml
+
+INDEX_FILE = '/srv/sls_index.json'
+INDEX_VERSION = 1
+
+INCLUDE_RE = re.compile(r'^include:\s*$')
+INCLUDE_ENTRY_RE = re.compile(r'^\s+-\s+[\'"]?([^\s\'"]+)[\'"]?\s*$')
+SLS_REQUISITE_RE = re.compile(r'-\s*sls:\s*[\'"]?([^\s\'"]+)')
+PILLAR_KEY_RES = [
+    re.compile(r'pillar\.get\(\s*[\'"]([^\'":]+)'),
+    re.compile(r'pillar\[\s*[\'"]([^\'"]+)'),
+    re.compile(r'[\'"]pillar\.get[\'"]\]\(\s*[\'"]([^\'":]+)'),
+    # Jinja attribute access, e.g. pillar.admins, but not a method call
+    # such as pillar.items()
+    re.compile(r'(?<![\'"])pillar\.(?!get\b)([A-Za-z_]\w*)\b(?!\s*\()'),
+]
+PILLAR_RE = re.compile(r'\bpillar\b')
+# pkg and pkgrepo states, in either style, which all need the dpkg lock
+PKG_STATE_RE = re.compile(r'\bpkg(?:repo)?(?:\.\w+|\s*:)')
+
+
+def sls_id(root, path):
+    """
+    Convert the path of an SLS file to its SLS ID.
+
+    Args:
+        root(string): The file root containing the file
+        path(string): Path of the SLS file
+    Returns:
+        (string): The SLS ID, e.g. 'nginx.conf' for nginx/conf.sls
+    """
+    rel = os.path.relpath(path, root)
+    if rel.endswith('/init.sls'):
+        rel = os.path.dirname(rel)
+    elif rel.endswith('.sls'):
+        rel = rel[:-len('.sls')]
+    return rel.replace('/', '.')
+
+
+def parse_sls(text, package=''):
+    """
+    Find the SLS IDs an SLS file includes or requires, and the top level
+    pillar keys it uses.
+
+    Args:
+        text(string): The unrendered SLS file
+        package(string): The package relative includes are resolved
+            against, e.g. 'nginx' for both nginx/init.sls and nginx/conf.sls
+    Returns:
+        (dict): 'depends', 'pillar_keys', 'dynamic', which is True if
+            an include is templated or pillar is used without a literal
+            key, and so cannot be resolved, and 'packages', which is True
+            if it has pkg states
+    """
+    depends = set()
+    dynamic = False
+    in_include = False
+    for line in text.splitlines():
+        if INCLUDE_RE.match(line):
+            in_include = True
+            continue
+        if in_include:
+            entry = INCLUDE_ENTRY_RE.match(line)
+            if entry:
+                depends.add(entry.group(1))
+            elif line and not line[0].isspace() and not line.startswith('{'):
+                in_include = False
+            if '{{' in line:
+                dynamic = True
+    depends.update(SLS_REQUISITE_RE.findall(text))
+
+    resolved = set()
+    for dep in depends:
+        if dep.startswith('.'):
+            dep = '{0}{1}'.format(package, dep) if package else dep[1:]
+        resolved.add(dep)
+
+    keys = pillar_keys(text)
+    return {'depends': sorted(resolved),
+            'pillar_keys': sorted(keys or ()),
+            'dynamic': dynamic or keys is None,
+            'packages': bool(PKG_STATE_RE.search(text))}
+
+
+def pillar_keys(text):
+    """
+    Find the top level pillar keys used in an SLS file or template.
+
+    Returns:
+        (set): The pillar keys, or None if pillar is used in a way that
+            doesn't name a literal key, e.g. pillar.items() or
+            pillar.get(name), so any pillar change may affect it
+    """
+    keys = set()
+    parsed = set()
+    for pillar_re in PILLAR_KEY_RES:
+        for match in pillar_re.finditer(text):
+            keys.add(match.group(1))
+            parsed.update(xrange(match.start(), match.end()))
+    if any(match.start() not in parsed for match in PILLAR_RE.finditer(text)):
+        return None
+    return keys
+
+
+def file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1024 * 1024), ''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def walk_files(path):
+    for dirpath, dirnames, filenames in os.walk(path):
+        for filename in filenames:
+            yield os.path.join(dirpath, filename)
+
+
+def build_index(bundle_root, state_roots, pillar_root):
+    """
+    Build the dependency index for a staged salt bundle.
+
+    Args:
+        bundle_root(string): The local directory the bundle is staged in,
+            standing in for / on the minion
+        state_roots(list): The minion's salt file roots, e.g. /srv/salt
+        pillar_root(string): The minion's pillar root, e.g. /srv/pillar
+    Returns:
+        (dict): The index
+    """
+    def local(path):
+        return os.path.join(bundle_root, './{0}'.format(path))
+
+    def remote(path):
+        return '/' + os.path.relpath(path, bundle_root)
+
+    index = {'version': INDEX_VERSION,
+             'state_roots': state_roots,
+             'pillar_root': pillar_root,
+             'files': {},
+             'sls': {},
+             'references': {},
+             'pillar': {}}
+
+    for path in walk_files(bundle_root):
+        index['files'][remote(path)] = file_digest(path)
+
+    # Non-SLS files in the file roots and the SLS that mention them, either
+    # as a salt:// source or from a jinja import
+    other_files = {}
+    for root in state_roots:
+        for path in walk_files(local(root)):
+            rel = os.path.relpath(path, local(root))
+            if not path.endswith('.sls'):
+                other_files[remote(path)] = rel
+                continue
+            if rel == 'top.sls':
+                continue
+            sls = sls_id(local(root), path)
+            if sls in index['sls']:
+                # Shadowed by an earlier file root, as on the minion
+                continue
+            with open(path) as sls_file:
+                text = sls_file.read()
+            if rel.endswith('/init.sls'):
+                package = sls
+            else:
+                package = sls.rsplit('.', 1)[0] if '.' in sls else ''
+            entry = parse_sls(text, package)
+            entry['path'] = remote(path)
+            entry['text'] = text
+            index['sls'][sls] = entry
+
+    for path, rel in other_files.items():
+        referenced_by = [ref_sls for ref_sls, ref_entry in index['sls'].items()
+                         if rel in ref_entry['text']]
+        index['references'][path] = sorted(referenced_by)
+        if not referenced_by:
+            continue
+        # Templates see the same pillar as the SLS that renders them
+        try:
+            with open(local(path)) as other_file:
+                keys = pillar_keys(other_file.read())
+        except IOError:
+            continue
+        for sls in referenced_by:
+            entry = index['sls'][sls]
+            if keys is None:
+                entry['dynamic'] = True
+            else:
+                entry['pillar_keys'] = sorted(set(entry['pillar_keys']) | keys)
+
+    for entry in index['sls'].values():
+        del entry['text']
+
+    for path in walk_files(local(pillar_root)):
+        if os.path.relpath(path, local(pillar_root)) == 'top.sls':
+            continue
+        try:
+            with open(path) as pillar_file:
+                data = yaml.safe_load(pillar_file)
+            if data is None:
+                keys = []
+            elif isinstance(data, dict):
+                keys = sorted(data.keys())
+            else:
+                keys = None
+        except yaml.YAMLError:
+            # Most likely templated, so we can't tell which keys it sets
+            keys = None
+        index['pillar'][remote(path)] = keys
+
+    return index
+
+
+def write_index(index, path):
+    with open(path, 'w') as index_file:
+        json.dump(index, index_file, sort_keys=True)
+
+
+def load_index(path):
+    """
+    Returns:
+        (dict): The index stored at path, or None if it is missing, invalid
+            or from a different index version
+    """
+    try:
+        with open(path) as index_file:
+            index = json.load(index_file)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(index, dict) or index.get('version') != INDEX_VERSION:
+        return None
+    return index
+
+
+def changed_files(old_index, new_index):
+    paths = set(old_index['files']) | set(new_index['files'])
+    return set(p for p in paths
+               if old_index['files'].get(p) != new_index['files'].get(p))
+
+
+def affected_sls(old_index, new_index):
+    """
+    Work out which SLS IDs are affected by the changes between two bundles.
+    An SLS is affected if it changed, uses changed pillar data or files, or
+    includes or requires an affected SLS.
+
+    Args:
+        old_index(dict): Index of the previously applied bundle
+        new_index(dict): Index of the current bundle
+    Returns:
+        (set): The affected SLS IDs, or None if the index can't tell and a
+            full highstate is needed
+    """
+    if old_index is None or new_index is None:
+        return None
+    if any(entry['dynamic'] for entry in new_index['sls'].values()):
+        return None
+
+    sls_by_path = {}
+    for index in (old_index, new_index):
+        for sls, entry in index['sls'].items():
+            sls_by_path[entry['path']] = sls
+
+    pillar_root = new_index['pillar_root'].rstrip('/') + '/'
+    state_roots = [root.rstrip('/') + '/' for root in new_index['state_roots']]
+
+    affected = set()
+    for path in changed_files(old_index, new_index):
+        if path == INDEX_FILE:
+            continue
+        if path in sls_by_path:
+            affected.add(sls_by_path[path])
+        elif path.startswith(pillar_root):
+            keys = set()
+            for index in (old_index, new_index):
+                if path not in index['pillar']:
+                    continue
+                if index['pillar'][path] is None:
+                    return None
+                keys.update(index['pillar'][path])
+            if not keys and path not in new_index['pillar']:
+                # The pillar top file, or something we didn't index
+                return None
+            affected.update(sls for sls, entry in new_index['sls'].items()
+                            if keys & set(entry['pillar_keys']))
+        elif any(path.startswith(root) for root in state_roots):
+            referenced_by = (new_index['references'].get(path) or
+                             old_index['references'].get(path))
+            if not referenced_by:
+                return None
+            affected.update(referenced_by)
+        else:
+            return None
+
+    # Anything that includes or requires an affected SLS is affected too
+    dependants = {}
+    for sls, entry in new_index['sls'].items():
+        for dep in entry['depends']:
+            dependants.setdefault(dep, set()).add(sls)
+    pending = list(affected)
+    while pending:
+        for sls in dependants.get(pending.pop(), ()):
+            if sls not in affected:
+                affected.add(sls)
+                pending.append(sls)
+    return affected
+
+
+def independent_groups(index, sls_ids):
+    """
+    Split SLS IDs into groups that can be run concurrently, such that no
+    two groups include or require the same SLS. Only one group has pkg
+    states, because they can't share the dpkg lock.
+
+    Args:
+        index(dict): The SLS index, or None
+        sls_ids(list): The SLS IDs to split
+    Returns:
+        (list): Lists of SLS IDs, in their original order. Everything is
+            put in one group if the index is missing or can't tell.
+    """
+    if (index is None or
+            any(entry['dynamic'] for entry in index['sls'].values()) or
+            any(sls not in index['sls'] for sls in sls_ids)):
+        return [list(sls_ids)]
+
+    def closure(sls):
+        seen = set([sls])
+        pending = [sls]
+        while pending:
+            entry = index['sls'].get(pending.pop())
+            for dep in entry['depends'] if entry else ():
+                if dep not in seen:
+                    seen.add(dep)
+                    pending.append(dep)
+        # Groups that install packages overlap on the dpkg lock. Indexes
+        # from older bundles don't say, so assume they do.
+        if any(index['sls'].get(dep, {}).get('packages', True) for dep in seen):
+            seen.add(('dpkg',))
+        return seen
+
+    groups = []
+    for sls in sls_ids:
+        members = closure(sls)
+        overlapping = [group for group in groups if group[1] & members]
+        merged = [[], members]
+        for group in overlapping:
+            groups.remove(group)
+            merged[0].extend(group[0])
+            merged[1] |= group[1]
+        merged[0].append(sls)
+        groups.append(merged)
+    return [sorted(group[0], key=list(sls_ids).index) for group in groups]
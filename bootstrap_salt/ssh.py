@@ -1,16 +1,469 @@
-import paramiko
-from paramiko.ssh_exception import AuthenticationException, BadHostKeyException
+import errno
+import logging
+import os
+from pipes import quote
+import select
 import socket
+import threading
+import time
+import uuid
+
+from fabric import network
+from fabric.auth import get_password
+from fabric.state import connections, env
+from paramiko.ssh_exception import SSHException
+
+import errors
+
+
+# The prompt sudo is told to use, so that the password is only sent when
+# sudo asks for it
+SUDO_PROMPT = 'bootstrap-salt sudo password:'
+
+# The most sockets to wait on at once, select can't handle more than 1024
+# file descriptors
+PROBE_BATCH_SIZE = 500
 
 
 def is_ssh_up(host):
-    client = paramiko.SSHClient()
-    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    return host in probe_ssh([host])
+
+
+def probe_ssh(hosts, port=22, timeout=5):
+    """
+    Find the hosts with an SSH server answering. A TCP connection is opened
+    to every host at once and only the server's SSH banner is read, so
+    there is no key exchange or login attempt.
+
+    Args:
+        hosts(list): The hosts to probe
+        port(int): The SSH port
+        timeout(int): Seconds to wait for the hosts' banners
+
+    Returns:
+        (set): The hosts that sent an SSH banner
+    """
+    hosts = list(hosts)
+    up = set()
+    for i in xrange(0, len(hosts), PROBE_BATCH_SIZE):
+        up.update(probe_ssh_batch(hosts[i:i + PROBE_BATCH_SIZE], port, timeout))
+    return up
+
+
+def probe_ssh_batch(hosts, port, timeout):
+    deadline = time.time() + timeout
+    connecting = {}
+    for host in hosts:
+        try:
+            family, _, _, _, address = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, socket.SOCK_STREAM)
+        except socket.error:
+            continue
+        sock.setblocking(0)
+        if sock.connect_ex(address) in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            connecting[sock] = host
+        else:
+            sock.close()
+
+    reading = {}
+    banners = {}
+    up = set()
     try:
-        client.connect(host, username='nobody', password='badpassword', timeout=5)
-        return True
-    except (AuthenticationException, BadHostKeyException):
+        while (connecting or reading) and time.time() < deadline:
+            readable, writable, _ = select.select(
+                reading.keys(), connecting.keys(), [],
+                max(deadline - time.time(), 0))
+            for sock in writable:
+                host = connecting.pop(sock)
+                if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                    sock.close()
+                else:
+                    reading[sock] = host
+                    banners[sock] = ''
+            for sock in readable:
+                try:
+                    data = sock.recv(256)
+                except socket.error:
+                    data = ''
+                banners[sock] += data
+                # The server may send other lines before its version string
+                if any(line.startswith('SSH-')
+                       for line in banners[sock].splitlines()):
+                    up.add(reading[sock])
+                elif data and len(banners[sock]) < 8192:
+                    continue
+                del reading[sock]
+                sock.close()
+    finally:
+        for sock in connecting.keys() + reading.keys():
+            sock.close()
+    return up
+
+
+class CommandResult(str):
+    """
+    The output of a remote command, with its exit status, like the results
+    of fabric's run and sudo.
+    """
+    return_code = None
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0
+
+    @property
+    def failed(self):
+        return not self.succeeded
+
+
+class PooledConnection(object):
+    """
+    An authenticated SSH session from the SSHConnectionPool. Commands are
+    run on their own channel, so a connection can be shared between threads
+    without touching fabric's global env.host_string.
+    """
+
+    def __init__(self, host_string, client):
+        """
+        Args:
+            host_string(string): The normalised user@host:port
+            client(paramiko.SSHClient): The connected client
+        """
+        self.host_string = host_string
+        self.client = client
+        self.last_used = time.time()
+        # The number of commands running on the connection, which mustn't
+        # be closed for being idle while they run
+        self.in_use = 0
+        self.in_use_lock = threading.Lock()
+
+    @property
+    def host(self):
+        return network.normalize(self.host_string)[1]
+
+    def is_busy(self):
+        return self.in_use > 0
+
+    def is_healthy(self):
+        """
+        Returns:
+            bool: True if the session is still usable
+        """
+        transport = self.client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (SSHException, EOFError, socket.error):
+            return False
         return True
-    except socket.error:
-        pass
-    return False
+
+    def run(self, command, sudo=False, warn_only=False, timeout=None,
+            strip=True, partial=False):
+        """
+        Run a command on the host. As with fabric, stderr is combined with
+        stdout.
+
+        If sudo asks for a password, it is given fabric's sudo password for
+        the host, or its login password. Unlike fabric, there is no
+        interactive prompt: without a password, sudo must not need one.
+
+        Args:
+            command(string): The shell command to run
+            sudo(bool): Run the command as root with sudo
+            warn_only(bool): Return a failed result instead of raising
+            timeout(int): Seconds to wait for output before giving up
+            strip(bool): Strip trailing newlines from the output
+            partial(bool): If the timeout passes, return the output so far
+                with a return_code of -1, as for a killed command, instead
+                of raising socket.timeout
+
+        Returns:
+            (CommandResult): The output of the command
+
+        Raises:
+            RemoteCommandError: if the command fails and warn_only is not set
+        """
+        self.last_used = time.time()
+        password = self.sudo_password() if sudo else None
+        if password:
+            command = 'sudo -S -p {0} -H {1}'.format(quote(SUDO_PROMPT), command)
+        elif sudo:
+            command = 'sudo -n -H {0}'.format(command)
+        with self.in_use_lock:
+            self.in_use += 1
+        try:
+            result = self.exec_command(command, timeout, strip, password,
+                                       partial)
+        finally:
+            with self.in_use_lock:
+                self.in_use -= 1
+        self.last_used = time.time()
+        if result.failed and not warn_only:
+            raise errors.RemoteCommandError(self.host_string, command,
+                                            result.return_code, result)
+        return result
+
+    def sudo_password(self):
+        """
+        Returns:
+            (string): The password to give sudo, as fabric would: its sudo
+                password for the host if this fabric supports one, or else
+                the login password. None if there isn't one.
+        """
+        user, host, port = network.normalize(self.host_string)
+        return (env.get('sudo_passwords', {}).get(self.host_string) or
+                env.get('sudo_password') or get_password(user, host, port))
+
+    def exec_command(self, command, timeout, strip, password=None,
+                     partial=False):
+        channel = self.client.get_transport().open_session()
+        try:
+            channel.settimeout(timeout)
+            channel.set_combine_stderr(True)
+            channel.exec_command(command)
+            output = []
+            return_code = None
+            while True:
+                try:
+                    data = channel.recv(32768)
+                except socket.timeout:
+                    if not partial:
+                        raise
+                    return_code = -1
+                    break
+                if not data:
+                    break
+                output.append(data)
+                if password is not None and SUDO_PROMPT in ''.join(output):
+                    # Send the password once, and close stdin so that sudo
+                    # fails instead of waiting if it is wrong
+                    output = [''.join(output).replace(SUDO_PROMPT, '', 1)]
+                    channel.sendall(password + '\n')
+                    channel.shutdown_write()
+                    password = None
+                elif password is not None and len(output) > 1:
+                    # sudo asks before the command writes anything, so it
+                    # didn't need a password
+                    password = None
+            output = ''.join(output)
+            result = CommandResult(output.rstrip('\r\n') if strip else output)
+            if return_code is None:
+                return_code = channel.recv_exit_status()
+            result.return_code = return_code
+        finally:
+            channel.close()
+        return result
+
+    def sudo(self, command, **kwargs):
+        return self.run(command, sudo=True, **kwargs)
+
+    def run_batch(self, commands, sudo=False, warn_only=False, timeout=None,
+                  stop_on_error=True):
+        """
+        Run several commands in order as one script, on a single channel
+        and, with sudo, a single sudo call, rather than a round trip each.
+        As with separate calls, each command runs in its own shell.
+
+        Args:
+            commands(list): The shell commands to run
+            sudo(bool): Run the script as root with sudo
+            warn_only(bool): Return failed results instead of raising
+            timeout(int): Seconds to wait for output before giving up on
+                the command running at the time
+            stop_on_error(bool): Don't run the rest of the commands once one
+                has failed
+
+        Returns:
+            (list): A CommandResult for each command that was started. A
+                command that didn't finish, for example a reboot that
+                closed the connection or never answered again, has a
+                return_code of None.
+
+        Raises:
+            RemoteCommandError: if a command fails and warn_only is not set
+        """
+        # Mark where each command's output starts and ends, with a token
+        # the commands' output can't contain by accident
+        marker = 'bootstrap-salt-batch-{0}'.format(uuid.uuid4().hex)
+        script = []
+        for i, command in enumerate(commands):
+            script.append("echo '{0} start {1}'".format(marker, i))
+            # In a subshell, so that each command runs as it would on its
+            # own, and an exit only ends that command
+            script.append('(\n{0}\n)'.format(command))
+            script.append("rc=$?; printf '\\n{0} end {1} %d\\n' $rc".format(marker, i))
+            if stop_on_error:
+                script.append('[ $rc -eq 0 ] || exit $rc')
+        command = 'sh -c {0}'.format(quote('\n'.join(script)))
+        output = self.run(command, sudo=sudo, warn_only=True, timeout=timeout,
+                          partial=True)
+
+        results = []
+        lines = None
+        for line in output.splitlines():
+            if line.startswith(marker + ' start '):
+                lines = []
+            elif line.startswith(marker + ' end ') and lines is not None:
+                results.append(self.batch_result(lines, int(line.split()[-1])))
+                lines = None
+            elif lines is not None:
+                lines.append(line)
+        if lines is not None:
+            # The script was killed or the connection lost during this
+            # command, e.g. by a reboot
+            return_code = output.return_code
+            results.append(self.batch_result(
+                lines, None if return_code == -1 else return_code))
+
+        if warn_only:
+            return results
+        if not results and output.failed:
+            # The script didn't start, e.g. sudo wasn't allowed
+            raise errors.RemoteCommandError(self.host_string, command,
+                                            output.return_code, output)
+        for step, result in zip(commands, results):
+            if result.failed:
+                raise errors.RemoteCommandError(self.host_string, step,
+                                                result.return_code, result)
+        return results
+
+    @staticmethod
+    def batch_result(lines, return_code):
+        result = CommandResult('\n'.join(lines).rstrip('\r\n'))
+        result.return_code = return_code
+        return result
+
+    def read_file(self, path, use_sudo=False):
+        """
+        Returns:
+            (string): The contents of a remote file, unmodified
+        """
+        return self.run("cat '{0}'".format(path.replace("'", "'\\''")),
+                        sudo=use_sudo, strip=False)
+
+    def close(self):
+        self.client.close()
+
+
+class SSHConnectionPool(object):
+    """
+    Keeps authenticated SSH sessions open between fab tasks, keyed by
+    user@host:port, so that chained tasks don't have to repeat the SSH
+    handshake. Connections are made with fabric, so they honour its key,
+    password and gateway settings, and are shared with fabric's own
+    connection cache so fabric operations reuse them too.
+
+    Sessions are checked before they are handed out and closed once they
+    have been idle for idle_timeout seconds with no command running. A
+    forked process, such as a @parallel fabric task, starts with an empty
+    pool.
+    """
+
+    def __init__(self, idle_timeout=300):
+        """
+        Args:
+            idle_timeout(int): Seconds a connection may be unused for before
+                it is closed
+        """
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.pool = {}
+        self.pid = os.getpid()
+
+    def get(self, host_string):
+        """
+        Get a healthy connection to a host, reusing a pooled one if there
+        is one.
+
+        Args:
+            host_string(string): The host, as user@host, host or
+                user@host:port
+
+        Returns:
+            (PooledConnection): The connection
+        """
+        key = network.normalize_to_string(host_string)
+        with self.lock:
+            self.check_pid()
+            self.evict_idle()
+            conn = self.pool.get(key)
+            if conn is not None and not conn.is_healthy():
+                logging.info("SSHConnectionPool: Connection to {} is no "
+                             "longer usable, reconnecting".format(key))
+                self.discard(key)
+                conn = None
+            if conn is not None:
+                conn.last_used = time.time()
+                return conn
+
+        # Connect without holding the lock, so that threads can connect to
+        # different hosts at the same time
+        client = self.connect(key)
+        with self.lock:
+            conn = self.pool.get(key)
+            if conn is not None and conn.client is not client:
+                # Another thread connected to the same host first
+                client.close()
+                connections[key] = conn.client
+            else:
+                conn = PooledConnection(key, client)
+                self.pool[key] = conn
+            conn.last_used = time.time()
+            return conn
+
+    def connect(self, key):
+        if key in connections:
+            # Adopt a session fabric already has open
+            client = dict.__getitem__(connections, key)
+            transport = client.get_transport()
+            if transport is not None and transport.is_active():
+                return client
+        user, host, port = network.normalize(key)
+        client = network.connect(user, host, port, cache=connections)
+        connections[key] = client
+        return client
+
+    def discard(self, key):
+        conn = self.pool.pop(key, None)
+        if conn is None:
+            return
+        conn.close()
+        if key in connections and dict.__getitem__(connections, key) is conn.client:
+            del connections[key]
+
+    def evict_idle(self):
+        now = time.time()
+        for key, conn in self.pool.items():
+            if now - conn.last_used > self.idle_timeout and not conn.is_busy():
+                logging.debug("SSHConnectionPool: Closing idle connection to {}"
+                              .format(key))
+                self.discard(key)
+
+    def check_pid(self):
+        # Sessions can't be shared with a forked child, its parent still
+        # owns them
+        if self.pid != os.getpid():
+            self.pool = {}
+            self.pid = os.getpid()
+
+
+# The pool shared by all tasks in this fab process
+pool = SSHConnectionPool()
+
+
+def get_connection(host, user=None):
+    """
+    Get a pooled connection to a host.
+
+    Args:
+        host(string): The host's IP or name
+        user(string): The user to connect as, defaults to fabric's env.user
+
+    Returns:
+        (PooledConnection): The connection
+    """
+    if user:
+        host = '{0}@{1}'.format(user, host)
+    return pool.get(host)
@@ -1,6 +1,11 @@
+from collections import deque
 import errno
+import logging
 import os
+import Queue
+import random
 import shutil
+import threading
 import time
 
 import boto.exception
@@ -10,22 +15,214 @@ import boto.sts
 from bootstrap_salt import errors
 
 
-def timeout(timeout, interval):
+def monotonic():
+    """
+    Returns:
+        (float): Seconds since an arbitrary point, for measuring intervals.
+            Python 2 has no monotonic clock, so this falls back to the
+            wall clock there.
+    """
+    return getattr(time, 'monotonic', time.time)()
+
+
+class Poller(object):
+    """
+    Call a function until it returns a true value or a deadline passes.
+
+    The deadline is measured from the first call, so the time the checks
+    themselves take counts towards it. The first retry comes after
+    first_interval, to catch things that were nearly ready. After that the
+    wait starts at interval and is multiplied by backoff after each check,
+    up to max_interval, and each wait is varied by up to jitter of its
+    length so that many pollers don't check in step. The last wait is cut
+    short so that a final check is made at the deadline.
+    """
+
+    def __init__(self, timeout, interval, backoff=1, max_interval=None,
+                 jitter=0, first_interval=None, on_attempt=None):
+        """
+        Args:
+            timeout(int): Seconds to keep trying for
+            interval(int): Seconds to wait between checks, before backoff
+            backoff(float): Factor the wait grows by after each check
+            max_interval(int): Longest wait between checks, defaults to
+                the timeout
+            jitter(float): Fraction of each wait to vary it by at random
+            first_interval(int): Seconds to wait before the first retry,
+                defaults to interval
+            on_attempt(function): Called after each check with the attempt
+                number, the seconds elapsed, the seconds the check took and
+                its result
+        """
+        self.timeout = float(timeout)
+        self.interval = float(interval)
+        self.backoff = float(backoff)
+        self.max_interval = float(timeout if max_interval is None else max_interval)
+        self.jitter = float(jitter)
+        self.first_interval = interval if first_interval is None else first_interval
+        self.on_attempt = on_attempt
+
+    def delays(self):
+        """
+        Returns:
+            (generator): The waits between checks, before jitter
+        """
+        yield min(float(self.first_interval), self.max_interval)
+        delay = self.interval
+        while True:
+            yield min(delay, self.max_interval)
+            delay *= self.backoff
+
+    def run(self, func, *args, **kwargs):
+        """
+        Call func with args and kwargs until it returns a true value.
+
+        Returns:
+            The first true value func returned
+
+        Raises:
+            CfnTimeoutError: if func hasn't returned a true value by the
+                deadline
+        """
+        started = monotonic()
+        deadline = started + self.timeout
+        delays = self.delays()
+        attempt = 0
+        checking = 0.0
+        while True:
+            attempt += 1
+            begun = monotonic()
+            result = func(*args, **kwargs)
+            now = monotonic()
+            checking += now - begun
+            if self.on_attempt is not None:
+                self.on_attempt(attempt, now - started, now - begun, result)
+            if result:
+                logging.debug("Poller: {0} succeeded after {1} attempts in "
+                              "{2:.1f}s, {3:.1f}s of it in checks"
+                              .format(func.__name__, attempt, now - started,
+                                      checking))
+                return result
+            if now >= deadline:
+                raise errors.CfnTimeoutError(
+                    "Timeout in {0} after {1} attempts in {2:.0f}s"
+                    .format(func.__name__, attempt, now - started))
+            delay = next(delays)
+            if self.jitter:
+                delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+            time.sleep(max(min(delay, deadline - now), 0))
+
+    def start(self, func, *args, **kwargs):
+        """
+        Poll in a background thread.
+
+        Returns:
+            (PollThread): The running poll, whose result() waits for it
+        """
+        thread = PollThread(self, func, args, kwargs)
+        thread.start()
+        return thread
+
+
+class PollThread(threading.Thread):
+    """
+    A Poller running in the background, so that a caller can wait for
+    several things at once or get on with other work in the meantime.
+    """
+
+    def __init__(self, poller, func, args, kwargs):
+        super(PollThread, self).__init__(name='poll-{0}'.format(func.__name__))
+        self.daemon = True
+        self.poller = poller
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.value = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.value = self.poller.run(self.func, *self.args, **self.kwargs)
+        except Exception as err:
+            self.error = err
+
+    def done(self):
+        return not self.is_alive()
+
+    def result(self, timeout=None):
+        """
+        Wait for the poll to finish.
+
+        Args:
+            timeout(int): Seconds to wait, None to wait until it finishes
+
+        Returns:
+            The value the polled function returned
+
+        Raises:
+            CfnTimeoutError: if the poll timed out, or it is still running
+                after timeout seconds
+        """
+        # Join in short steps so that a KeyboardInterrupt isn't blocked
+        deadline = None if timeout is None else monotonic() + timeout
+        while self.is_alive() and (deadline is None or monotonic() < deadline):
+            self.join(1 if deadline is None else
+                      max(min(1, deadline - monotonic()), 0))
+        if self.is_alive():
+            raise errors.CfnTimeoutError(
+                "Timeout waiting for {0}".format(self.func.__name__))
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+def timeout(timeout, interval, **options):
+    """
+    Decorate a function so that calling it polls it with a Poller until it
+    returns a true value.
+
+    Args:
+        timeout(int): Seconds to keep trying for
+        interval(int): Seconds to wait between checks
+        options: Any other Poller arguments, such as backoff and jitter
+
+    Raises:
+        CfnTimeoutError: from the decorated function, if it hasn't returned
+            a true value within the timeout
+    """
+    poller = Poller(timeout, interval, **options)
+
     def decorate(func):
         def wrapper(*args, **kwargs):
-            attempts = 0
-            while True:
-                result = func(*args, **kwargs)
-                if result:
-                    return result
-                if attempts >= timeout / interval:
-                    raise errors.CfnTimeoutError("Timeout in {0}".format(func.__name__))
-                attempts += 1
-                time.sleep(interval)
+            return poller.run(func, *args, **kwargs)
         return wrapper
     return decorate
 
 
+def timeout_async(timeout, interval, **options):
+    """
+    Like timeout, but calling the decorated function starts polling it in
+    the background and returns a PollThread.
+    """
+    poller = Poller(timeout, interval, **options)
+
+    def decorate(func):
+        def wrapper(*args, **kwargs):
+            return poller.start(func, *args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def parse_bool(value):
+    """
+    Parse a boolean passed to a fab task, which arrives as a string.
+
+    Returns:
+        bool: True for True, 'true', 'yes' or '1'
+    """
+    return str(value).lower() in ('true', 'yes', '1')
+
+
 def connect_to_aws(module, instance):
     try:
         if instance.aws_profile_name == 'cross-account':
@@ -111,3 +308,86 @@ def copytree(src, dst, symlinks=False, ignore=None):
             errors.append((src, dst, str(why)))
     if errors:
         raise shutil.Error, errors
+
+
+def run_concurrently(func, items, pool_size=10, stop=None, timeout=None,
+                     on_timeout=None):
+    """
+    Call func on each item from a pool of threads. This is the loop behind
+    the FleetExecutor and RollingScheduler too.
+
+    Args:
+        func(function): Called with each item
+        items(list): The items to call func on
+        pool_size(int): Maximum number of calls to run at once
+        stop(function): Called with each item and its result as they
+            finish. If it returns True, calls that haven't started yet are
+            skipped. Calls already running are waited for.
+        timeout(float): Seconds to allow each call, None for no limit. A
+            call that takes longer is given up on and the next item started;
+            its thread is left to finish in the background.
+        on_timeout(function): Called with an item whose call timed out,
+            returns its result. By default the result is a HostTimeoutError.
+
+    Returns:
+        (dict): The result of each call, keyed by item. If a call raised an
+            exception, or aborted with SystemExit, that is its result.
+            Skipped items are left out.
+    """
+    pending = deque(items)
+    pool_size = max(int(pool_size), 1)
+    results = {}
+    running = {}
+    finished = Queue.Queue()
+    stopped = False
+
+    def call(item):
+        try:
+            result = func(item)
+        except (Exception, SystemExit) as err:
+            # A fabric abort raises SystemExit, which would otherwise kill
+            # the thread without posting a result and leave us waiting
+            result = err
+        finished.put((item, result))
+
+    def finish(item, result):
+        del running[item]
+        results[item] = result
+        return stop is not None and stop(item, result)
+
+    while running or (pending and not stopped):
+        # Only start as many calls as the pool allows, so that nothing more
+        # is started once stop returns True
+        while pending and not stopped and len(running) < pool_size:
+            item = pending.popleft()
+            thread = threading.Thread(target=call, args=(item,))
+            # A call that has timed out mustn't keep fab from exiting
+            thread.daemon = True
+            running[item] = monotonic()
+            thread.start()
+
+        # Poll so that a KeyboardInterrupt isn't blocked
+        wait = 1
+        if timeout is not None:
+            wait = min(wait, max(min(running.values()) + timeout -
+                                 monotonic(), 0))
+        try:
+            item, result = finished.get(True, wait)
+        except Queue.Empty:
+            pass
+        else:
+            # Ignore a call that finishes after it was given up on
+            if item in running and finish(item, result):
+                stopped = True
+        if timeout is not None:
+            now = monotonic()
+            for item, started in running.items():
+                if now - started < timeout:
+                    continue
+                if on_timeout is not None:
+                    result = on_timeout(item)
+                else:
+                    result = errors.HostTimeoutError(item, timeout)
+                if finish(item, result):
+                    stopped = True
+    return results
@@ -7,14 +7,14 @@ import yaml
 import json
 import boto.cloudformation
 import boto.ec2.autoscale
-import paramiko
 from bootstrap_salt import cloudformation
 from bootstrap_salt import ec2
 from bootstrap_salt import ssh
 from bootstrap_salt import fab_tasks
-from paramiko.ssh_exception import AuthenticationException
 import socket
 import os
+import threading
+import time
 
 
 class BootstrapSaltTestCase(unittest.TestCase):
@@ -80,6 +80,7 @@ class BootstrapSaltTestCase(unittest.TestCase):
         self.stack_name = '{0}-{1}'.format(self.env.application,
                                            self.env.environment)
         self.real_is_ssh_up = ssh.is_ssh_up
+        self.real_probe_ssh = ssh.probe_ssh
 
         self.ec2_mock = mock.Mock(name="boto.ec2.connect_to_region")
         self.ec2_connect_result = mock.Mock(name='cf_connect')
@@ -212,6 +213,49 @@ class BootstrapSaltTestCase(unittest.TestCase):
         ips = ec.get_instance_public_ips(['i-12345'])
         self.assertEqual(ips, ['1.1.1.1'])
 
+    def test_get_instance_placements(self):
+        instance = mock.Mock(ip_address='1.1.1.1', placement='eu-west-1a',
+                             tags={'aws:autoscaling:groupName': 'web'})
+        untagged = mock.Mock(ip_address='2.2.2.2', placement='eu-west-1b',
+                             tags={})
+        self.ec2_connect_result.configure_mock(
+            **{'get_only_instances.return_value': [instance, untagged]})
+
+        ec = ec2.EC2(self.env.aws_profile)
+        self.assertEqual(ec.get_instance_placements(['i-1', 'i-2']),
+                         [{'ip': '1.1.1.1', 'az': 'eu-west-1a', 'asg': 'web'},
+                          {'ip': '2.2.2.2', 'az': 'eu-west-1b', 'asg': None}])
+        self.assertEqual(ec.get_instance_placements([]), [])
+
+    def test_get_stack_hosts_index(self):
+        """
+        Test that every region is scanned with the stack tag filtered by EC2
+        """
+        def instance(ip, stack):
+            return mock.Mock(ip_address=ip, tags={'aws:cloudformation:stack-name': stack})
+        instances = {'eu-west-1': [instance('1.1.1.1', 'app-dev'),
+                                   instance('2.2.2.2', 'app-dev'),
+                                   instance(None, 'app-dev')],
+                     'eu-central-1': [instance('3.3.3.3', 'app-prod')]}
+
+        def connect_to_region(region_name, **kwargs):
+            conn = mock.Mock(name=region_name)
+            conn.get_only_instances.return_value = instances[region_name]
+            return conn
+        self.ec2_mock.side_effect = connect_to_region
+
+        self.assertEqual(ec2.get_stack_hosts_index(self.env.aws_profile,
+                                                   ['eu-west-1', 'eu-central-1']),
+                         {'app-dev': {'region': 'eu-west-1', 'hosts': ['1.1.1.1', '2.2.2.2']},
+                          'app-prod': {'region': 'eu-central-1', 'hosts': ['3.3.3.3']}})
+
+        ec = ec2.EC2(self.env.aws_profile, 'eu-west-1')
+        self.assertEqual(ec.get_all_stack_ips(), {'1.1.1.1': 'app-dev', '2.2.2.2': 'app-dev'})
+        ec.conn_ec2.get_only_instances.assert_called_with(
+            filters={'instance-state-name': 'running',
+                     'tag-key': 'aws:cloudformation:stack-name'},
+            max_results=1000)
+
     def test_is_ssh_up_when_no_instances(self):
         '''
         This is to test that is_ssh_up_on_all_instances
@@ -221,24 +265,22 @@ class BootstrapSaltTestCase(unittest.TestCase):
 
         ec.cfn.get_stack_instance_ids = mock.Mock(return_value=[])
 
-        ssh_mock = mock.Mock()
-        ssh_mock.side_effect = [True, True]
-        ssh.is_ssh_up = ssh_mock
+        probe_mock = mock.Mock(return_value=set())
+        ssh.probe_ssh = probe_mock
 
         self.assertFalse(ec.is_ssh_up_on_all_instances(self.stack_name))
-        ssh.is_ssh_up.asset_has_calls([])
+        self.assertFalse(probe_mock.called)
 
     def test_is_ssh_up_on_all_instances(self):
         ec = ec2.EC2(self.env.aws_profile)
         ec.get_instance_public_ips = mock.Mock(return_value=['1.2.3.4', '2.3.4.5'])
         ec.cfn.get_stack_instance_ids = mock.Mock(return_value=['i-1', 'i-2'])
 
-        ssh_mock = mock.Mock()
-        ssh_mock.side_effect = [True, True]
-        ssh.is_ssh_up = ssh_mock
+        probe_mock = mock.Mock(return_value=set(['1.2.3.4', '2.3.4.5']))
+        ssh.probe_ssh = probe_mock
 
         self.assertTrue(ec.is_ssh_up_on_all_instances(self.stack_name))
-        ssh_mock.assert_has_calls([mock.call('1.2.3.4'), mock.call('2.3.4.5')])
+        probe_mock.assert_called_once_with(['1.2.3.4', '2.3.4.5'])
 
     def test_is_ssh_not_up_on_all_instances(self):
         ec = ec2.EC2(self.env.aws_profile)
@@ -246,44 +288,74 @@ class BootstrapSaltTestCase(unittest.TestCase):
         ec.get_instance_public_ips = mock.Mock(return_value=['1.2.3.4', '2.3.4.5'])
         ec.cfn.get_stack_instance_ids = mock.Mock(return_value=['i-1', 'i-2'])
 
-        ssh_mock = mock.Mock()
-        ssh_mock.side_effect = [True, False]
-        ssh.is_ssh_up = ssh_mock
+        probe_mock = mock.Mock(return_value=set(['1.2.3.4']))
+        ssh.probe_ssh = probe_mock
 
-        self.assertFalse(ec.is_ssh_up_on_all_instances(self.stack_name))
-        ssh_mock.assert_has_calls([mock.call('1.2.3.4'), mock.call('2.3.4.5')])
+        up = set()
+        self.assertFalse(ec.is_ssh_up_on_all_instances(self.stack_name, up))
+        probe_mock.assert_called_once_with(['1.2.3.4', '2.3.4.5'])
+
+        # Instances already up aren't probed again
+        probe_mock.return_value = set(['2.3.4.5'])
+        self.assertTrue(ec.is_ssh_up_on_all_instances(self.stack_name, up))
+        probe_mock.assert_called_with(['2.3.4.5'])
+
+    def listen(self, banner=None):
+        """
+        Listen on a local port, sending banner to each connection if given
+        """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(5)
+        self.addCleanup(server.close)
+
+        def serve():
+            while True:
+                try:
+                    client = server.accept()[0]
+                except socket.error:
+                    return
+                if banner:
+                    client.sendall(banner)
+                self.addCleanup(client.close)
+        thread = threading.Thread(target=serve)
+        thread.daemon = True
+        thread.start()
+        return server.getsockname()[1]
 
     def test_is_ssh_up(self):
-        mock_p = mock.Mock()
-        mock_client = mock.Mock()
-        mock_config = {'connect.side_effect': AuthenticationException}
-        mock_client.configure_mock(**mock_config)
-        mock_p.return_value = mock_client
-        paramiko.SSHClient = mock_p
-        self.assertTrue(ssh.is_ssh_up('1.1.1.1'))
+        port = self.listen('SSH-2.0-OpenSSH_6.6.1p1 Ubuntu-2ubuntu2\r\n')
+        self.assertEqual(ssh.probe_ssh(['127.0.0.1'], port=port), set(['127.0.0.1']))
+        # Other lines may come before the version
+        port = self.listen('Welcome\r\nSSH-2.0-OpenSSH_7.2\r\n')
+        self.assertEqual(ssh.probe_ssh(['127.0.0.1'], port=port), set(['127.0.0.1']))
 
     def test_is_ssh_not_up(self):
-        mock_p = mock.Mock()
-        mock_client = mock.Mock()
-        mock_config = {'connect.side_effect': socket.error}
-        mock_client.configure_mock(**mock_config)
-        mock_p.return_value = mock_client
-        paramiko.SSHClient = mock_p
-        self.assertFalse(ssh.is_ssh_up('1.1.1.1'))
+        # Nothing listening
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.assertEqual(ssh.probe_ssh(['127.0.0.1'], port=port), set())
+        # Listening, but not SSH yet
+        port = self.listen()
+        started = time.time()
+        self.assertEqual(ssh.probe_ssh(['127.0.0.1'], port=port, timeout=0.5), set())
+        self.assertLess(time.time() - started, 2)
 
     @patch('json.loads')
-    @patch('bootstrap_salt.fab_tasks.sudo')
+    @patch('bootstrap_salt.ssh.get_connection')
     @patch("bootstrap_salt.fab_tasks.get_instance_ips")
     def test_check_formulas_exist(self,
                                   mock_get_instance_ips,
-                                  mock_sudo,
+                                  mock_get_connection,
                                   mock_json_loads
                                   ):
         """
         Test checking for admins when we have some in pillar
         """
         mock_get_instance_ips.return_value = ["some-ip", "someother-ip"]
-        mock_sudo.return_value = None
+        mock_get_connection.return_value.sudo.return_value = None
         mock_json_loads.return_value = {
             'local': {
                 'john': {},
@@ -298,18 +370,18 @@ class BootstrapSaltTestCase(unittest.TestCase):
         self.assertTrue(success, msg)
 
     @patch('json.loads')
-    @patch('bootstrap_salt.fab_tasks.sudo')
+    @patch('bootstrap_salt.ssh.get_connection')
     @patch("bootstrap_salt.fab_tasks.get_instance_ips")
     def test_check_formulas_exist_no_admins(self,
                                             mock_get_instance_ips,
-                                            mock_sudo,
+                                            mock_get_connection,
                                             mock_json_loads
                                             ):
         """
         Test checking for admins when we have none in pillar
         """
         mock_get_instance_ips.return_value = ["some-ip", "someother-ip"]
-        mock_sudo.return_value = None
+        mock_get_connection.return_value.sudo.return_value = None
         mock_json_loads.return_value = {
             'local': {}
         }
@@ -318,8 +390,38 @@ class BootstrapSaltTestCase(unittest.TestCase):
         msg = "test:test_check_formulas_exist: Did not return successfully"
         self.assertFalse(success, msg)
 
+    @patch('bootstrap_salt.ssh.get_connection')
+    @patch("bootstrap_salt.fab_tasks.get_instance_ips")
+    def test_check_admins_exist_concurrently(self,
+                                             mock_get_instance_ips,
+                                             mock_get_connection):
+        """
+        Test checking for admins on several hosts at once, stopping early if asked
+        """
+        mock_get_instance_ips.return_value = ["1.1.1.1", "2.2.2.2", "3.3.3.3"]
+        pillars = {'1.1.1.1': '{"local": {"john": {}}}',
+                   '2.2.2.2': '{"local": {}}',
+                   '3.3.3.3': '{"local": {"paul": {}, "ringo": {}}}'}
+
+        def get_connection(host_ip, user):
+            conn = mock.Mock()
+            conn.sudo.return_value = pillars[host_ip]
+            return conn
+        mock_get_connection.side_effect = get_connection
+
+        results = fab_tasks.check_admins(["1.1.1.1", "2.2.2.2", "3.3.3.3"])
+        self.assertEqual(results, {'1.1.1.1': ['john'],
+                                   '2.2.2.2': [],
+                                   '3.3.3.3': ['paul', 'ringo']})
+        self.assertFalse(fab_tasks.check_admins_exist())
+
+        results = fab_tasks.check_admins(["2.2.2.2", "1.1.1.1", "3.3.3.3"],
+                                         pool_size=1, stop_early=True)
+        self.assertEqual(results, {'2.2.2.2': []})
+
     def tearDown(self):
         ssh.is_ssh_up = self.real_is_ssh_up
+        ssh.probe_ssh = self.real_probe_ssh
 
 
 if __name__ == '__main__':
@@ -0,0 +1,66 @@
+import BaseHTTPServer
+import datetime
+import imp
+import json
+import os
+import threading
+import unittest
+
+import bootstrap_salt
+
+bootstrap_report = imp.load_source(
+    'bootstrap_report',
+    os.path.join(os.path.dirname(bootstrap_salt.__file__), 'contrib', 'bootstrap_report.py'))
+
+
+class FakeS3Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """A local stand-in for S3 that records PUT requests"""
+    requests = []
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.requests.append((self.path, dict(self.headers.items()), body))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class BootstrapReportTestCase(unittest.TestCase):
+
+    def setUp(self):
+        FakeS3Handler.requests = []
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), FakeS3Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.endpoint = 'http://127.0.0.1:{0}'.format(self.server.server_port)
+
+    def test_put_object(self):
+        """
+        test_put_object: markers are uploaded with a signed PUT
+        """
+        marker = bootstrap_report.build_marker('i-1', 'done', exit_code=0, started=100.0, now=160.0)
+        self.assertEqual(marker, {'instance_id': 'i-1', 'stage': 'done', 'exit_code': 0,
+                                  'reported': 160.0, 'started': 100.0, 'duration': 60.0})
+        bootstrap_report.put_object(self.endpoint, 'eu-west-1', 'my-stack-salt', 'bootstrap/i-1/done',
+                                    json.dumps(marker), ('AKID', 'secret', 'token'),
+                                    now=datetime.datetime(2016, 1, 2, 3, 4, 5))
+
+        path, headers, body = FakeS3Handler.requests[0]
+        self.assertEqual(path, '/my-stack-salt/bootstrap/i-1/done')
+        self.assertEqual(json.loads(body), marker)
+        self.assertEqual(headers['x-amz-date'], '20160102T030405Z')
+        self.assertEqual(headers['x-amz-security-token'], 'token')
+        self.assertTrue(headers['authorization'].startswith(
+            'AWS4-HMAC-SHA256 Credential=AKID/20160102/eu-west-1/s3/aws4_request, '
+            'SignedHeaders=host;x-amz-content-sha256;x-amz-date;x-amz-security-token, Signature='))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == '__main__':
+    unittest.main()
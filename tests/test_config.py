@@ -92,6 +92,24 @@ class TestConfig(unittest.TestCase):
                                         ]
                                     ]
                                 }
+                            },
+                            {
+                                "Action": [
+                                    "s3:PutObject"
+                                ],
+                                "Effect": "Allow",
+                                "Resource": {
+                                    "Fn::Join": [
+                                        "",
+                                        [
+                                            "arn:aws:s3:::",
+                                            {
+                                                "Ref": "SaltBucket"
+                                            },
+                                            "/bootstrap/*"
+                                        ]
+                                    ]
+                                }
                             }
                         ]
                     },
@@ -126,9 +144,120 @@ class TestConfig(unittest.TestCase):
         mock_env.bootstrap_tmp_path = '/tmp'
         version = pkg_resources.get_distribution("bootstrap_salt").version
 
-        expected = [{'content': 'runcmd: [/usr/local/bin/bootstrap.sh v{0}]\n'.format(version),
+        write_files = (
+            'write_files:\n'
+            "- {content: fake-key-data, encoding: b64, owner: 'root:root', path: /etc/salt.key.enc,\n"
+            "  permissions: '0600'}\n"
+            '- {content: "#!/bin/bash\\nREVISION=$1\\nSALT_BUCKET=$2\\nSTARTED=$(date +%s)\\nREPORT=\\"\\\n'
+            '    $(dirname $0)/bootstrap_report.py\\"\\nLOG=/var/log/bootstrap-salt.log\\nSTAGE=ssh-up\\n\\\n'
+            '    exec > >(tee -a $LOG) 2>&1\\n\\nreport() {\\n    if [ -n \\"$SALT_BUCKET\\" ]; then\\n\\\n'
+            '    \\        # Reporting is best effort and must not trigger the ERR trap\\n      \\\n'
+            '    \\  python $REPORT $SALT_BUCKET \\"$@\\" --started $STARTED || true\\n    fi\\n}\\n\\n\\\n'
+            '    stage_done() {\\n    report $STAGE\\n    STAGE=$1\\n}\\n\\nfail() {\\n    EXIT_CODE=$?\\n\\\n'
+            '    \\    trap - ERR\\n    echo \\"bootstrap.sh: failed in stage $STAGE with exit code\\\n'
+            '    \\ $EXIT_CODE\\"\\n    { echo \\"$STAGE\\"; tail -n 50 $LOG; } > /tmp/bootstrap_failed\\n\\\n'
+            '    \\    report failed --exit-code $EXIT_CODE --failed-stage $STAGE --log $LOG\\n \\\n'
+            '    \\   exit $EXIT_CODE\\n}\\nset -o errtrace\\ntrap fail ERR\\n\\nstage_done packages\\n\\\n'
+            '    wget https://raw.githubusercontent.com/saltstack/salt-bootstrap/6080a18e6c7c2d49335978fa69fa63645b45bc2a/bootstrap-salt.sh\\\n'
+            '    \\ -O /tmp/bootstrap-salt.sh\\nchmod 700 /tmp/bootstrap-salt.sh\\napt-get update\\n\\\n'
+            '    apt-get -y install python-pip git python-dev\\npip install boto\\npip install gnupg\\n\\\n'
+            '    pip install --pre github3.py\\npip install -U urllib3==1.14\\ncd /tmp\\ngit clone\\\n'
+            '    \\ --depth 1 --branch $REVISION https://github.com/ministryofjustice/bootstrap-salt.git\\n\\\n'
+            '    cd ./bootstrap-salt/bootstrap_salt\\ncp -Lrf ./contrib/* /\\nstage_done salt-installed\\n\\\n'
+            '    /tmp/bootstrap-salt.sh git v2014.7.5\\nsalt-call saltutil.sync_all\\nstage_done\\\n'
+            "    \\ highstated\\n# A failed initial highstate doesn't fail the bootstrap, its exit\\\n"
+            '    \\ code is\\n# reported with the done marker\\nHIGHSTATE_EXIT_CODE=0\\n/usr/local/bin/salt_utils.py\\\n'
+            '    \\ -s highstate || HIGHSTATE_EXIT_CODE=$?\\nstage_done done\\ntrap - ERR\\ntouch /tmp/bootstrap_done\\n\\\n'
+            '    report done --exit-code $HIGHSTATE_EXIT_CODE\\n", owner: \'root:root\', path: /usr/local/bin/bootstrap.sh,\n'
+            "  permissions: '0700'}\n"
+            '- {content: "#!/usr/bin/env python\\n\\"\\"\\"\\nPublish bootstrap progress markers to\\\n'
+            "    \\ the stack's salt bucket.\\n\\nbootstrap.sh runs this before boto or anything else\\\n"
+            '    \\ has been installed, so\\nit only uses the standard library. Requests are signed\\\n'
+            "    \\ with the instance\\nrole's credentials from the metadata service, or with the\\\n"
+            '    \\ AWS_* environment\\nvariables if they are set.\\n\\nMarkers are written to bootstrap/<instance-id>/<stage>,\\\n'
+            '    \\ so that\\nwait_for_minions can see the progress of every instance with a single\\n\\\n'
+            '    listing of the bucket. The stages are ssh-up, packages, salt-installed,\\nhighstated\\\n'
+            '    \\ and done, or failed if the bootstrap script fails.\\n\\"\\"\\"\\nimport argparse\\n\\\n'
+            '    import datetime\\nimport hashlib\\nimport hmac\\nimport json\\nimport os\\nimport sys\\n\\\n'
+            "    import time\\nimport urllib\\nimport urllib2\\n\\nMETADATA_URL = 'http://169.254.169.254/latest/meta-data/'\\n\\\n"
+            "    MARKER_PREFIX = 'bootstrap'\\n\\n\\ndef get_metadata(path):\\n    return urllib2.urlopen(METADATA_URL\\\n"
+            '    \\ + path, timeout=5).read()\\n\\n\\ndef get_credentials():\\n    \\"\\"\\"\\n    Returns:\\n\\\n'
+            '    \\        (tuple): The access key, secret key and session token, which may be\\n\\\n'
+            '    \\            None\\n    \\"\\"\\"\\n    if os.environ.get(\'AWS_ACCESS_KEY_ID\'):\\n \\\n'
+            "    \\       return (os.environ['AWS_ACCESS_KEY_ID'],\\n                os.environ['AWS_SECRET_ACCESS_KEY'],\\n\\\n"
+            "    \\                os.environ.get('AWS_SESSION_TOKEN'))\\n    role = get_metadata('iam/security-credentials/').splitlines()[0]\\n\\\n"
+            "    \\    creds = json.loads(get_metadata('iam/security-credentials/' + role))\\n  \\\n"
+            "    \\  return creds['AccessKeyId'], creds['SecretAccessKey'], creds['Token']\\n\\n\\n\\\n"
+            "    def get_region():\\n    if os.environ.get('AWS_DEFAULT_REGION'):\\n        return\\\n"
+            "    \\ os.environ['AWS_DEFAULT_REGION']\\n    return get_metadata('placement/availability-zone')[:-1]\\n\\\n"
+            "    \\n\\ndef sign(key, msg):\\n    return hmac.new(key, msg.encode('utf-8'), hashlib.sha256).digest()\\n\\\n"
+            '    \\n\\ndef put_object(endpoint, region, bucket, key, body, credentials, now=None):\\n\\\n'
+            '    \\    \\"\\"\\"\\n    Upload an object to S3 with a signature version 4 PUT request.\\n\\\n'
+            '    \\n    Args:\\n        endpoint(string): The S3 endpoint, e.g. https://s3.eu-west-1.amazonaws.com\\n\\\n'
+            "    \\        region(string): The bucket's region\\n        bucket(string): The bucket\\\n"
+            '    \\ name\\n        key(string): The object key\\n        body(string): The object\\\n'
+            '    \\ contents\\n        credentials(tuple): The access key, secret key and session\\\n'
+            '    \\ token\\n        now(datetime): The time to sign the request with, defaults to\\\n'
+            '    \\ now\\n    \\"\\"\\"\\n    access_key, secret_key, token = credentials\\n    now =\\\n'
+            "    \\ now or datetime.datetime.utcnow()\\n    amz_date = now.strftime('%Y%m%dT%H%M%SZ')\\n\\\n"
+            "    \\    date_stamp = now.strftime('%Y%m%d')\\n    host = endpoint.split('://', 1)[-1].rstrip('/')\\n\\\n"
+            "    \\    uri = '/{0}/{1}'.format(bucket, urllib.quote(key, safe='/~'))\\n    payload_hash\\\n"
+            "    \\ = hashlib.sha256(body).hexdigest()\\n\\n    headers = {'host': host,\\n       \\\n"
+            "    \\        'x-amz-content-sha256': payload_hash,\\n               'x-amz-date': amz_date}\\n\\\n"
+            "    \\    if token:\\n        headers['x-amz-security-token'] = token\\n    signed_headers\\\n"
+            "    \\ = ';'.join(sorted(headers))\\n    canonical_request = '\\\\n'.join([\\n        'PUT',\\\n"
+            "    \\ uri, '',\\n        ''.join('{0}:{1}\\\\n'.format(name, headers[name])\\n       \\\n"
+            '    \\         for name in sorted(headers)),\\n        signed_headers, payload_hash])\\n\\\n'
+            "    \\n    scope = '{0}/{1}/s3/aws4_request'.format(date_stamp, region)\\n    string_to_sign\\\n"
+            "    \\ = '\\\\n'.join([\\n        'AWS4-HMAC-SHA256', amz_date, scope,\\n        hashlib.sha256(canonical_request).hexdigest()])\\n\\\n"
+            "    \\    signing_key = sign(('AWS4' + secret_key).encode('utf-8'), date_stamp)\\n \\\n"
+            "    \\   for part in (region, 's3', 'aws4_request'):\\n        signing_key = sign(signing_key,\\\n"
+            "    \\ part)\\n    signature = hmac.new(signing_key, string_to_sign.encode('utf-8'),\\n\\\n"
+            "    \\                         hashlib.sha256).hexdigest()\\n    headers['Authorization']\\\n"
+            "    \\ = (\\n        'AWS4-HMAC-SHA256 Credential={0}/{1}, SignedHeaders={2}, '\\n  \\\n"
+            "    \\      'Signature={3}'.format(access_key, scope, signed_headers, signature))\\n\\\n"
+            "    \\    headers['Content-Type'] = 'application/json'\\n\\n    request = urllib2.Request(endpoint.rstrip('/')\\\n"
+            '    \\ + uri, data=body,\\n                              headers=headers)\\n    request.get_method\\\n'
+            "    \\ = lambda: 'PUT'\\n    urllib2.urlopen(request, timeout=30).read()\\n\\n\\ndef build_marker(instance_id,\\\n"
+            '    \\ stage, exit_code=None, started=None,\\n                 log_file=None, log_lines=50,\\\n'
+            '    \\ failed_stage=None, now=None):\\n    \\"\\"\\"\\n    Returns:\\n        (dict): The\\\n'
+            '    \\ marker contents: the instance, stage, exit code,\\n            timings, the stage\\\n'
+            '    \\ that failed if any and, if a log file is\\n            given, the tail of the\\\n'
+            '    \\ log\\n    \\"\\"\\"\\n    now = now or time.time()\\n    marker = {\'instance_id\':\\\n'
+            "    \\ instance_id,\\n              'stage': stage,\\n              'exit_code': exit_code,\\n\\\n"
+            "    \\              'reported': now}\\n    if failed_stage:\\n        marker['failed_stage']\\\n"
+            "    \\ = failed_stage\\n    if started is not None:\\n        marker['started'] = started\\n\\\n"
+            "    \\        marker['duration'] = now - started\\n    if log_file:\\n        try:\\n\\\n"
+            "    \\            with open(log_file) as log:\\n                marker['log_tail'] =\\\n"
+            '    \\ log.readlines()[-log_lines:]\\n        except IOError:\\n            pass\\n  \\\n'
+            '    \\  return marker\\n\\n\\ndef main(argv=None):\\n    parser = argparse.ArgumentParser(\\n\\\n'
+            "    \\        description='Publish a bootstrap progress marker to the salt bucket')\\n\\\n"
+            "    \\    parser.add_argument('bucket', help='The stack salt bucket')\\n    parser.add_argument('stage',\\\n"
+            "    \\ help='The bootstrap stage reached')\\n    parser.add_argument('--exit-code',\\\n"
+            "    \\ dest='exit_code', type=int,\\n                        default=None)\\n    parser.add_argument('--started',\\\n"
+            "    \\ dest='started', type=float,\\n                        help='Unix time the bootstrap\\\n"
+            "    \\ started', default=None)\\n    parser.add_argument('--log', dest='log_file', default=None,\\n\\\n"
+            "    \\                        help='Log file to include the tail of')\\n    parser.add_argument('--failed-stage',\\\n"
+            "    \\ dest='failed_stage', default=None,\\n                        help='The stage\\\n"
+            "    \\ the bootstrap failed in')\\n    parser.add_argument('--instance-id', dest='instance_id',\\\n"
+            "    \\ default=None)\\n    parser.add_argument('--endpoint', dest='endpoint', default=None,\\n\\\n"
+            "    \\                        help='S3 endpoint, for testing against a stand-in')\\n\\\n"
+            "    \\    args = parser.parse_args(argv)\\n\\n    instance_id = args.instance_id or get_metadata('instance-id')\\n\\\n"
+            "    \\    region = get_region()\\n    endpoint = args.endpoint or 'https://s3.{0}.amazonaws.com'.format(region)\\n\\\n"
+            '    \\    marker = build_marker(instance_id, args.stage, exit_code=args.exit_code,\\n\\\n'
+            '    \\                          started=args.started, log_file=args.log_file,\\n   \\\n'
+            "    \\                       failed_stage=args.failed_stage)\\n    key = '{0}/{1}/{2}'.format(MARKER_PREFIX,\\\n"
+            '    \\ instance_id, args.stage)\\n    try:\\n        put_object(endpoint, region, args.bucket,\\\n'
+            '    \\ key, json.dumps(marker),\\n                   get_credentials())\\n    except\\\n'
+            '    \\ (urllib2.URLError, IOError, ValueError, KeyError) as err:\\n        # Reporting\\\n'
+            "    \\ is best effort, it must never break the bootstrap\\n        sys.stderr.write('bootstrap_report:\\\n"
+            "    \\ could not publish {0}: {1}\\\\n'\\n                         .format(key, err))\\n\\\n"
+            '    \\        return 1\\n    return 0\\n\\n\\nif __name__ == \'__main__\':\\n    sys.exit(main())\\n",\n'
+            "  owner: 'root:root', path: /usr/local/bin/bootstrap_report.py, permissions: '0700'}\n")
+        expected = [{'content': 'runcmd: [/usr/local/bin/bootstrap.sh v{0} my-stack-salt]\n'.format(version),
                      'mime_type': 'text/cloud-config'},
-                    {'content': "write_files:\n- {content: fake-key-data, encoding: b64, owner: 'root:root', path: /etc/salt.key.enc,\n  permissions: '0600'}\n- {content: '#!/bin/bash\n\n    REVISION=$1\n\n    wget https://raw.githubusercontent.com/saltstack/salt-bootstrap/6080a18e6c7c2d49335978fa69fa63645b45bc2a/bootstrap-salt.sh\n    -O /tmp/bootstrap-salt.sh\n\n    chmod 700 /tmp/bootstrap-salt.sh\n\n    apt-get update && apt-get -y install python-pip git python-dev\n\n    pip install boto\n\n    pip install gnupg\n\n    pip install --pre github3.py\n\n    pip install -U urllib3==1.14\n\n    cd /tmp\n\n    git clone --depth 1 --branch $REVISION https://github.com/ministryofjustice/bootstrap-salt.git\n\n    cd ./bootstrap-salt/bootstrap_salt\n\n    cp -Lrf ./contrib/* /\n\n    /tmp/bootstrap-salt.sh git v2014.7.5\n\n    salt-call saltutil.sync_all\n\n    /usr/local/bin/salt_utils.py -s highstate\n\n    touch /tmp/bootstrap_done\n\n    ', owner: 'root:root', path: /usr/local/bin/bootstrap.sh, permissions: '0700'}\n", 'mime_type': 'text/cloud-config'}]  # NOQA
+                    {'content': write_files,
+                     'mime_type': 'text/cloud-config'}]
 
         x = MyConfigParser({}, 'my-stack').get_ec2_userdata()
         compare(x, expected)
@@ -1,10 +1,30 @@
+import os
 import unittest
 
-from mock import patch
+from mock import call, Mock, patch
 
 from testfixtures import compare
 
-from bootstrap_salt import fab_tasks
+from bootstrap_salt import errors, fab_tasks, ssh
+
+
+class FakeKey(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeS3(object):
+    """A local stand-in for the salt bucket"""
+    def __init__(self):
+        self.objects = {}
+        self.listings = 0
+
+    def list_keys(self, bucket_name, prefix=''):
+        self.listings += 1
+        return [FakeKey(name) for name in sorted(self.objects) if name.startswith(prefix)]
+
+    def get_json(self, bucket_name, key_name):
+        return self.objects.get(key_name)
 
 
 class TestFabTasks(unittest.TestCase):
@@ -13,26 +33,245 @@ class TestFabTasks(unittest.TestCase):
         pass
 
     def test_get_ips_batch(self):
+        def placements(ips, az='eu-west-1a', asg='web'):
+            return [{'ip': ip, 'az': az, 'asg': asg} for ip in ips]
+
         # Test one batch
-        mock_ret = ['1.1.1.1', '2.2.2.2']
-        with patch.object(fab_tasks, 'get_instance_ips', return_value=mock_ret):
+        mock_ret = placements(['1.1.1.1', '2.2.2.2'])
+        with patch.object(fab_tasks, 'get_instance_placements', return_value=mock_ret):
             expected = [['1.1.1.1', '2.2.2.2']]
             x = fab_tasks.get_ips_batch()
             compare(x, expected)
         # Test 50% batch
-        mock_ret = ['1.1.1.1', '2.2.2.2', '3.3.3.3', '4.4.4.4']
-        with patch.object(fab_tasks, 'get_instance_ips', return_value=mock_ret):
+        mock_ret = placements(['1.1.1.1', '2.2.2.2', '3.3.3.3', '4.4.4.4'])
+        with patch.object(fab_tasks, 'get_instance_placements', return_value=mock_ret):
             expected = [['1.1.1.1', '2.2.2.2'],
                         ['3.3.3.3', '4.4.4.4']]
             x = fab_tasks.get_ips_batch(0.5)
             compare(x, expected)
         # 50% batch uneven nodes
-        mock_ret = ['1.1.1.1', '2.2.2.2', '3.3.3.3']
-        with patch.object(fab_tasks, 'get_instance_ips', return_value=mock_ret):
+        mock_ret = placements(['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+        with patch.object(fab_tasks, 'get_instance_placements', return_value=mock_ret):
             expected = [['1.1.1.1', '2.2.2.2'],
                         ['3.3.3.3']]
             x = fab_tasks.get_ips_batch(0.5)
             compare(x, expected)
+        # Each batch takes half of each AZ, and of each ASG
+        mock_ret = (placements(['a1', 'a2'], 'eu-west-1a') +
+                    placements(['b1', 'b2'], 'eu-west-1b') +
+                    placements(['c1', 'c2'], 'eu-west-1a', asg='worker') +
+                    placements(['d1', 'd2'], 'eu-west-1b', asg='worker'))
+        with patch.object(fab_tasks, 'get_instance_placements', return_value=mock_ret):
+            expected = [['a1', 'b1', 'c1', 'd1'],
+                        ['a2', 'b2', 'c2', 'd2']]
+            x = fab_tasks.get_ips_batch(0.5)
+            compare(x, expected)
+
+    def test_spread_by_placement_uneven(self):
+        """
+        test_spread_by_placement_uneven: a smaller AZ is spread through the list rather than bunched at the front
+        """
+        instances = ([{'ip': 'a{0}'.format(i), 'az': 'eu-west-1a', 'asg': 'web'} for i in range(4)] +
+                     [{'ip': 'b{0}'.format(i), 'az': 'eu-west-1b', 'asg': 'web'} for i in range(2)])
+        compare(fab_tasks.spread_by_placement(instances),
+                ['a0', 'b0', 'a1', 'a2', 'b1', 'a3'])
+
+    @patch('bootstrap_salt.fab_tasks.wait_for_healthy')
+    @patch('bootstrap_salt.fab_tasks.get_boot_id')
+    @patch('bootstrap_salt.fab_tasks.run_upgrade_packages')
+    def test_upgrade_packages(self, mock_upgrade, mock_boot_id, mock_healthy):
+        """
+        test_upgrade_packages: hosts are upgraded in a rolling window gated on their health
+        """
+        mock_boot_id.side_effect = lambda host: 'boot-' + host
+        mock_healthy.side_effect = lambda host, boot_id, timeout: host != '2.2.2.2'
+        with patch.object(fab_tasks, 'get_instance_placements',
+                          return_value=[{'ip': ip, 'az': 'eu-west-1a', 'asg': 'web'}
+                                        for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3']]):
+            with self.assertRaises(errors.RolloutError) as raised:
+                fab_tasks.upgrade_packages('["openssl"]', fraction='0.3',
+                                           restart='True')
+        compare(raised.exception.hosts, ['2.2.2.2', '3.3.3.3'])
+        compare(mock_upgrade.call_args_list,
+                [(('1.1.1.1', '["openssl"]', True),),
+                 (('2.2.2.2', '["openssl"]', True),)])
+        mock_healthy.assert_any_call('1.1.1.1', 'boot-1.1.1.1', 600)
+
+    @patch('bootstrap_salt.ssh.get_connection')
+    @patch('bootstrap_salt.fab_tasks.run_state_on_host')
+    def test_run_state(self, mock_run_state_on_host, mock_get_connection):
+        """
+        test_run_state: the state runs on a canary, then the rest of the stack, and results are summarised
+        """
+        failed_state = {'id': 'user_|-bob_|-bob_|-present', 'sls': 'users', 'comment': 'No such group'}
+        mock_get_connection.side_effect = lambda host, user: Mock(host=host)
+
+        def run_state_on_host(conn, state, extra_args):
+            host = conn.host
+            failed = host == '3.3.3.3'
+            return {'return_code': int(failed), 'succeeded': not failed,
+                    'duration': {'1.1.1.1': 10.0, '2.2.2.2': 30.0, '3.3.3.3': 20.0}[host],
+                    'report': {'failed': [failed_state] if failed else []},
+                    'output': ['State did not execute successfully'] if failed else []}
+        mock_run_state_on_host.side_effect = run_state_on_host
+        placements = [{'ip': ip, 'az': 'eu-west-1a', 'asg': 'web'}
+                      for ip in ['1.1.1.1', '2.2.2.2', '3.3.3.3']]
+        with patch.object(fab_tasks, 'get_instance_placements', return_value=placements):
+            with self.assertRaises(errors.RolloutError) as raised:
+                fab_tasks.run_state('users', slowest='2')
+        compare(raised.exception.hosts, ['3.3.3.3'])
+        compare(mock_run_state_on_host.call_args_list[0][0][0].host, '1.1.1.1')
+        compare(mock_run_state_on_host.call_args_list[0][0][1:], ('users', ''))
+
+        results = dict((host, run_state_on_host(Mock(host=host), 'users', ''))
+                       for host in ['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+        summary = fab_tasks.summarise_state_results(['1.1.1.1', '2.2.2.2', '3.3.3.3'],
+                                                    results, slowest=2)
+        compare(summary['succeeded'], ['1.1.1.1', '2.2.2.2'])
+        compare(summary['slowest'], [{'host': '2.2.2.2', 'duration': 30.0},
+                                     {'host': '3.3.3.3', 'duration': 20.0}])
+        compare(summary['failing_states'],
+                {'user_|-bob_|-bob_|-present': {'sls': 'users', 'hosts': ['3.3.3.3'],
+                                                'comment': 'No such group'}})
+
+    @patch('bootstrap_salt.ssh.get_connection')
+    @patch('bootstrap_salt.fab_tasks.run_state_on_host')
+    def test_run_state_canary_failed(self, mock_run_state_on_host, mock_get_connection):
+        """
+        test_run_state_canary_failed: the rest of the stack is skipped when the canary fails
+        """
+        mock_run_state_on_host.side_effect = errors.RemoteCommandError('1.1.1.1', 'rm', 255, '')
+        placements = [{'ip': ip, 'az': 'eu-west-1a', 'asg': 'web'} for ip in ['1.1.1.1', '2.2.2.2']]
+        with patch.object(fab_tasks, 'get_instance_placements', return_value=placements):
+            with self.assertRaises(errors.RolloutError) as raised:
+                fab_tasks.run_state()
+        compare(raised.exception.results, {'1.1.1.1': 'failed', '2.2.2.2': 'skipped'})
+        compare(mock_run_state_on_host.call_count, 1)
+
+        # A fabric abort is the host's failure rather than the end of the run
+        mock_run_state_on_host.side_effect = SystemExit('Needed to prompt for a sudo password')
+        with patch.object(fab_tasks, 'get_instance_placements', return_value=placements):
+            with self.assertRaises(errors.RolloutError) as raised:
+                fab_tasks.run_state()
+        compare(raised.exception.results, {'1.1.1.1': 'failed', '2.2.2.2': 'skipped'})
+
+    @patch('bootstrap_salt.fab_tasks.local')
+    @patch('bootstrap_salt.fab_tasks.encrypt_file')
+    @patch('bootstrap_salt.fab_tasks.KMS')
+    @patch('bootstrap_salt.ssh.get_connection')
+    def test_publish_github_tokens(self, mock_ssh_connection, mock_kms,
+                                   mock_encrypt_file, mock_local):
+        """
+        test_publish_github_tokens: the token is published once per stack, not once per host
+        """
+        def get_connection(host, user):
+            conn = Mock(host=host)
+            if host == '3.3.3.3':
+                conn.read_file.side_effect = errors.RemoteCommandError('3.3.3.3', 'cat', 1, 'No such file')
+            else:
+                conn.read_file.return_value = 'key'
+            return conn
+        mock_ssh_connection.side_effect = get_connection
+        mock_local.return_value.failed = False
+        stack_names = {'1.1.1.1': 'app-dev', '2.2.2.2': 'app-dev', '3.3.3.3': 'app-prod'}
+        self.addCleanup(os.system, 'rm -f /tmp/ght-app-dev /tmp/ght-app-prod')
+        with patch.dict(fab_tasks.env, {'github_token': 'token', 'aws': 'dev'}):
+            published = fab_tasks.publish_github_tokens(['1.1.1.1', '2.2.2.2', '3.3.3.3'],
+                                                        stack_names, pool_size=1,
+                                                        stack_regions={'app-dev': 'eu-central-1'})
+        compare(published, set(['app-dev']))
+        compare(mock_encrypt_file.call_count, 1)
+        compare(mock_encrypt_file.call_args[0][0], '/tmp/ght-app-dev')
+        mock_kms.assert_called_once_with('dev', 'eu-central-1')
+        mock_local.assert_called_once_with(
+            'aws s3 --profile dev cp /tmp/ght-app-dev.gpg s3://app-dev-salt/ght-app-dev.gpg')
+
+        # A failed upload skips the stack instead of aborting
+        mock_local.return_value.failed = True
+        with patch.dict(fab_tasks.env, {'github_token': 'token', 'aws': 'dev'}):
+            published = fab_tasks.publish_github_tokens(['1.1.1.1'], stack_names)
+        compare(published, set())
+
+        # So does a fabric abort
+        mock_local.side_effect = SystemExit('local() encountered an error')
+        with patch.dict(fab_tasks.env, {'github_token': 'token', 'aws': 'dev'}):
+            published = fab_tasks.publish_github_tokens(['1.1.1.1'], stack_names)
+        compare(published, set())
+
+    @patch('bootstrap_salt.fab_tasks.is_bootstrap_done')
+    @patch('bootstrap_salt.fab_tasks.get_connection')
+    @patch('bootstrap_salt.fab_tasks.get_inventory')
+    @patch('bootstrap_salt.fab_tasks.get_stack_name')
+    @patch('bootstrap_salt.fab_tasks._validate_fabric_env')
+    def test_wait_for_minions_ssh(self, mock_validate, mock_stack_name, mock_inventory,
+                                  mock_connection, mock_bootstrap_done):
+        """
+        test_wait_for_minions_ssh: instances are looked up once SSH is up, so late launches are waited for
+        """
+        events = []
+        mock_connection.return_value.wait_for_ssh.side_effect = lambda stack: events.append('ssh')
+        mock_inventory.return_value.ips.side_effect = lambda: events.append('ips') or ['1.1.1.1', '2.2.2.2']
+        mock_bootstrap_done.return_value = True
+        mock_bootstrap_done.__name__ = 'is_bootstrap_done'
+        fab_tasks.wait_for_minions()
+        compare(events, ['ssh', 'ips'])
+        compare(mock_bootstrap_done.call_args[0][0], set(['1.1.1.1', '2.2.2.2']))
+
+    @patch('time.sleep')
+    @patch('bootstrap_salt.fab_tasks.get_connection')
+    @patch('bootstrap_salt.fab_tasks.get_inventory')
+    @patch('bootstrap_salt.fab_tasks.get_stack_name')
+    @patch('bootstrap_salt.fab_tasks._validate_fabric_env')
+    def test_wait_for_minions_s3(self, mock_validate, mock_stack_name, mock_inventory,
+                                 mock_connection, mock_sleep):
+        """
+        test_wait_for_minions_s3: instances are looked up on every check until the stack has launched
+        """
+        s3 = FakeS3()
+        mock_connection.return_value = s3
+        mock_stack_name.return_value = 'my-stack'
+        launched = mock_inventory.return_value
+        launched.desired_capacity.return_value = 2
+        # Nothing has launched, then one instance that reports before the
+        # second is found
+        launched.instances.side_effect = [
+            [],
+            [{'id': 'i-1'}],
+            [{'id': 'i-1'}, {'id': 'i-2'}],
+            [{'id': 'i-1'}, {'id': 'i-2'}]]
+
+        def sleep(seconds):
+            if launched.instances.call_count == 2:
+                s3.objects['bootstrap/i-1/done'] = {'exit_code': 0, 'duration': 120.0}
+            if launched.instances.call_count == 3:
+                s3.objects['bootstrap/i-2/done'] = {'exit_code': 0, 'duration': 130.0}
+        mock_sleep.side_effect = sleep
+
+        fab_tasks.wait_for_minions(method='s3')
+        mock_inventory.assert_called_with(states=fab_tasks.NON_TERMINATED)
+        compare(launched.instances.call_args_list, [call(refresh=True)] * 4)
+        compare(s3.listings, 4)
+
+    @patch('bootstrap_salt.ssh.pool')
+    @patch('bootstrap_salt.ssh.get_connection')
+    def test_run_upgrade_packages(self, mock_get_connection, mock_pool):
+        """
+        test_run_upgrade_packages: the upgrade and reboot are sent in one batch
+        """
+        conn = mock_get_connection.return_value
+        upgraded = ssh.CommandResult('upgraded')
+        upgraded.return_code = 0
+        conn.run_batch.return_value = [upgraded, ssh.CommandResult('')]
+        fab_tasks.run_upgrade_packages('1.1.1.1', '["openssl"]', restart=True)
+        conn.run_batch.assert_called_once_with(
+            ["/usr/bin/salt-call pkg.install refresh=True only_upgrade=True pkgs='[\"openssl\"]'",
+             '/usr/bin/salt-call system.reboot'], sudo=True, warn_only=True,
+            timeout=fab_tasks.UPGRADE_OUTPUT_TIMEOUT)
+        mock_pool.discard.assert_called_once_with(conn.host_string)
+
+        upgraded.return_code = 1
+        self.assertRaises(errors.RemoteCommandError, fab_tasks.run_upgrade_packages,
+                          '1.1.1.1', '["openssl"]')
 
     def tearDown(self):
         pass
@@ -47,3 +286,66 @@ class TestFabTasks(unittest.TestCase):
         x = lambda x: x
         fab_tasks.cfn_delete(pre_delete_callbacks=[x])
         mock_cfn_delete.assert_called_once_with(pre_delete_callbacks=[x, fab_tasks.delete_tar])
+
+    @patch('bootstrap_salt.ssh.get_connection')
+    def test_is_bootstrap_done(self, mock_get_connection):
+        """
+        test_is_bootstrap_done: hosts are checked together and finished ones are dropped
+        """
+        fab_tasks.env.user = 'ubuntu'
+        done = set(['1.1.1.1'])
+
+        def get_connection(host, user):
+            if host == '3.3.3.3':
+                raise fab_tasks.NetworkError('Timed out trying to connect to 3.3.3.3')
+            conn = ssh.PooledConnection('ubuntu@{0}:22'.format(host), None)
+
+            def run(command, warn_only=False):
+                result = ssh.CommandResult('')
+                result.return_code = int(not (host in done and command.endswith('bootstrap_done')))
+                return result
+            conn.run = run
+            return conn
+        mock_get_connection.side_effect = get_connection
+
+        hosts = set(['1.1.1.1', '2.2.2.2', '3.3.3.3'])
+        self.assertFalse(fab_tasks.is_bootstrap_done(hosts))
+        compare(hosts, set(['2.2.2.2', '3.3.3.3']))
+        compare(sorted(call[0] for call in mock_get_connection.call_args_list),
+                [('1.1.1.1', 'ubuntu'), ('2.2.2.2', 'ubuntu'), ('3.3.3.3', 'ubuntu')])
+
+        done.add('2.2.2.2')
+        self.assertFalse(fab_tasks.is_bootstrap_done(hosts))
+        compare(hosts, set(['3.3.3.3']))
+
+    def test_is_bootstrap_reported(self):
+        """
+        test_is_bootstrap_reported: markers are read with one listing and finished instances dropped
+        """
+        s3 = FakeS3()
+        s3.objects['bootstrap/i-1/done'] = {'exit_code': 0, 'duration': 120.0}
+        s3.objects['srv.tar.gpg'] = {}
+        pending = set(['i-1', 'i-2'])
+        self.assertFalse(fab_tasks.is_bootstrap_reported(s3, 'my-stack-salt', pending))
+        compare(pending, set(['i-2']))
+        compare(s3.listings, 1)
+
+        s3.objects['bootstrap/i-2/done'] = {'exit_code': 2, 'duration': 130.0}
+        self.assertTrue(fab_tasks.is_bootstrap_reported(s3, 'my-stack-salt', pending))
+        compare(s3.listings, 2)
+
+    def test_is_bootstrap_reported_failed(self):
+        """
+        test_is_bootstrap_reported_failed: a failed bootstrap aborts the wait with its stage and log
+        """
+        s3 = FakeS3()
+        s3.objects['bootstrap/i-1/ssh-up'] = {}
+        s3.objects['bootstrap/i-1/packages'] = {}
+        s3.objects['bootstrap/i-2/ssh-up'] = {}
+        s3.objects['bootstrap/i-2/failed'] = {'failed_stage': 'salt-installed',
+                                              'log_tail': ['E: Unable to locate package\n']}
+        with self.assertRaises(errors.BootstrapError) as raised:
+            fab_tasks.is_bootstrap_reported(s3, 'my-stack-salt', set(['i-1', 'i-2']))
+        compare(raised.exception.host, 'i-2')
+        compare(raised.exception.stage, 'salt-installed')
+        compare(raised.exception.log_tail, ['E: Unable to locate package\n'])
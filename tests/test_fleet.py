@@ -0,0 +1,98 @@
+import threading
+import time
+import unittest
+
+import mock
+
+from testfixtures import compare
+
+from bootstrap_salt import errors
+from bootstrap_salt.fleet import FleetExecutor
+
+
+class FleetExecutorTestCase(unittest.TestCase):
+
+    def connect(self, host, user):
+        if host == 'unreachable':
+            raise errors.RemoteCommandError(host, 'connect', None, 'No route to host')
+        conn = mock.Mock(name='PooledConnection')
+        conn.host = host
+        return conn
+
+    def test_run(self):
+        """
+        test_run: each host gets its own connection, at most pool_size at a time
+        """
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0}
+
+        def func(conn):
+            with lock:
+                state['running'] += 1
+                state['max_running'] = max(state['max_running'], state['running'])
+            time.sleep(0.05)
+            with lock:
+                state['running'] -= 1
+            if conn.host == 'broken':
+                raise ValueError('bad pillar')
+            return conn.host.upper()
+
+        executor = FleetExecutor(pool_size=2, user='ubuntu', connect=self.connect)
+        results = executor.run(func, ['a', 'b', 'c', 'broken', 'unreachable'])
+        compare(dict((host, result.value) for host, result in results.items() if result.ok),
+                {'a': 'A', 'b': 'B', 'c': 'C'})
+        self.assertIsInstance(results['broken'].error, ValueError)
+        self.assertIsInstance(results['unreachable'].result, errors.RemoteCommandError)
+        compare(state['max_running'], 2)
+
+    def test_abort(self):
+        """
+        test_abort: a fabric abort is recorded as the host's error rather than hanging the run
+        """
+        def connect(host, user):
+            if host == 'prompting':
+                raise SystemExit('Needed to prompt for a connection password')
+            return self.connect(host, user)
+
+        executor = FleetExecutor(pool_size=2, connect=connect)
+        results = executor.run(lambda conn: conn.host, ['a', 'prompting'])
+        compare(results['a'].value, 'a')
+        self.assertIsInstance(results['prompting'].error, SystemExit)
+
+    def test_timeout(self):
+        """
+        test_timeout: a host that hangs is given up on and its connection closed
+        """
+        hang = threading.Event()
+        self.addCleanup(hang.set)
+        conns = {}
+
+        def connect(host, user):
+            conns[host] = self.connect(host, user)
+            return conns[host]
+
+        def func(conn):
+            if conn.host == 'hung':
+                hang.wait(10)
+            return True
+
+        executor = FleetExecutor(pool_size=1, timeout=0.2, connect=connect)
+        started = time.time()
+        results = executor.run(func, ['hung', 'a'])
+        self.assertLess(time.time() - started, 5)
+        self.assertTrue(results['hung'].timed_out)
+        self.assertTrue(conns['hung'].close.called)
+        self.assertTrue(results['a'].ok)
+
+    def test_stop(self):
+        """
+        test_stop: hosts not yet started are skipped once stop returns True
+        """
+        executor = FleetExecutor(pool_size=1, connect=self.connect)
+        results = executor.run(lambda conn: conn.host != 'b', ['a', 'b', 'c'],
+                               stop=lambda host, result: not result.value)
+        compare(sorted(results), ['a', 'b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
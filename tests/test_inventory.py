@@ -0,0 +1,118 @@
+import shutil
+import tempfile
+import unittest
+
+import mock
+from mock import patch
+
+from testfixtures import compare
+
+from bootstrap_salt.inventory import NON_TERMINATED, StackInventory
+
+
+def fake_instance(instance_id, ip, az, asg=None, state='running'):
+    tags = {'aws:cloudformation:stack-name': 'app-dev-12345'}
+    if asg:
+        tags['aws:autoscaling:groupName'] = asg
+    return mock.Mock(id=instance_id, ip_address=ip, private_ip_address='10.0.0.1',
+                     placement=az, tags=tags, state=state)
+
+
+class StackInventoryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        patcher = patch('bootstrap_salt.utils.connect_to_aws')
+        self.mock_connect = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.conn = self.mock_connect.return_value
+        self.conn.get_only_instances.return_value = [
+            fake_instance('i-1', '1.1.1.1', 'eu-west-1a', 'web'),
+            fake_instance('i-2', '2.2.2.2', 'eu-west-1b')]
+
+    def inventory(self, cache_ttl=0, **kwargs):
+        return StackInventory('dev', 'eu-west-1', 'app-dev-12345',
+                              cache_ttl=cache_ttl, cache_dir=self.cache_dir,
+                              **kwargs)
+
+    def test_single_lookup(self):
+        """
+        test_single_lookup: instances come from one filtered DescribeInstances call and are remembered
+        """
+        inventory = self.inventory()
+        compare(inventory.ips(), ['1.1.1.1', '2.2.2.2'])
+        compare(inventory.ids(), ['i-1', 'i-2'])
+        compare(inventory.placements(),
+                [{'ip': '1.1.1.1', 'az': 'eu-west-1a', 'asg': 'web'},
+                 {'ip': '2.2.2.2', 'az': 'eu-west-1b', 'asg': None}])
+        self.conn.get_only_instances.assert_called_once_with(filters={
+            'tag:aws:cloudformation:stack-name': 'app-dev-12345',
+            'instance-state-name': ['running']})
+
+        inventory.instances(refresh=True)
+        compare(self.conn.get_only_instances.call_count, 2)
+
+    @patch('time.time')
+    def test_disk_cache(self, mock_time):
+        """
+        test_disk_cache: a later run reuses the instances until the cache expires
+        """
+        mock_time.return_value = 1000.0
+        self.inventory(cache_ttl=60).ips()
+        # Caching is off by default
+        self.inventory().ips()
+        compare(self.conn.get_only_instances.call_count, 2)
+
+        mock_time.return_value = 1030.0
+        compare(self.inventory(cache_ttl=60).ips(), ['1.1.1.1', '2.2.2.2'])
+        compare(self.conn.get_only_instances.call_count, 2)
+        self.assertEqual(self.mock_connect.call_count, 2)
+
+        mock_time.return_value = 1090.0
+        self.inventory(cache_ttl=60).ips()
+        compare(self.conn.get_only_instances.call_count, 3)
+
+        inventory = self.inventory(cache_ttl=60)
+        inventory.invalidate()
+        inventory.ips()
+        compare(self.conn.get_only_instances.call_count, 4)
+
+    def test_states(self):
+        """
+        test_states: other instance states can be looked up and are cached separately
+        """
+        self.conn.get_only_instances.return_value = [
+            fake_instance('i-1', '1.1.1.1', 'eu-west-1a', 'web'),
+            fake_instance('i-3', None, 'eu-west-1b', 'web', state='pending')]
+        inventory = self.inventory(cache_ttl=60, states=NON_TERMINATED)
+        compare([(i['id'], i['state']) for i in inventory.instances()],
+                [('i-1', 'running'), ('i-3', 'pending')])
+        self.conn.get_only_instances.assert_called_once_with(filters={
+            'tag:aws:cloudformation:stack-name': 'app-dev-12345',
+            'instance-state-name': ['pending', 'running', 'stopping', 'stopped']})
+
+        # A running-only inventory doesn't reuse the cached launching instances
+        self.inventory(cache_ttl=60).ids()
+        compare(self.conn.get_only_instances.call_count, 2)
+        compare(self.inventory(cache_ttl=60, states=NON_TERMINATED).ids(), ['i-1', 'i-3'])
+        compare(self.conn.get_only_instances.call_count, 2)
+
+    def test_desired_capacity(self):
+        """
+        test_desired_capacity: the capacity of every page of the stack's autoscaling groups is summed
+        """
+        def group(name, stack, capacity):
+            return mock.Mock(desired_capacity=capacity,
+                             tags=[mock.Mock(key='aws:cloudformation:stack-name', value=stack)])
+        pages = {None: mock.MagicMock(next_token='page-2'),
+                 'page-2': mock.MagicMock(next_token=None)}
+        pages[None].__iter__.return_value = [group('web', 'app-dev-12345', 2),
+                                             group('other', 'app-prod-12345', 5)]
+        pages['page-2'].__iter__.return_value = [group('worker', 'app-dev-12345', 3)]
+        self.conn.get_all_groups.side_effect = lambda next_token: pages[next_token]
+        compare(self.inventory().desired_capacity(), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
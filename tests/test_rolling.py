@@ -0,0 +1,84 @@
+import threading
+import time
+import unittest
+
+from testfixtures import compare
+
+from bootstrap_salt import rolling
+
+
+class RollingSchedulerTestCase(unittest.TestCase):
+
+    def test_sliding_window(self):
+        """
+        test_sliding_window: a slow host doesn't hold up the rest of the rollout
+        """
+        lock = threading.Lock()
+        state = {'in_flight': 0, 'max_in_flight': 0}
+        order = []
+
+        def action(host):
+            with lock:
+                state['in_flight'] += 1
+                state['max_in_flight'] = max(state['max_in_flight'], state['in_flight'])
+            time.sleep(0.5 if host == 'slow' else 0.05)
+            with lock:
+                state['in_flight'] -= 1
+                order.append(host)
+
+        scheduler = rolling.RollingScheduler(max_in_flight=2)
+        results = scheduler.run(['slow', 'a', 'b', 'c', 'd'], action)
+        compare(results, dict((host, rolling.OK) for host in ['slow', 'a', 'b', 'c', 'd']))
+        compare(state['max_in_flight'], 2)
+        # The other hosts all finish through the second slot while the slow
+        # host is still running
+        compare(order, ['a', 'b', 'c', 'd', 'slow'])
+
+    def test_health_check_gates_hosts(self):
+        """
+        test_health_check_gates_hosts: unhealthy hosts count against the failure budget
+        """
+        started = []
+
+        def action(host):
+            started.append(host)
+
+        def health_check(host):
+            if host == 'bad':
+                raise Exception('minion did not respond')
+            return host != 'sick'
+
+        scheduler = rolling.RollingScheduler(max_in_flight=1, failure_budget=1,
+                                             health_check=health_check)
+        results = scheduler.run(['a', 'sick', 'b', 'bad', 'c', 'd'], action)
+        compare(results, {'a': rolling.OK,
+                          'sick': rolling.UNHEALTHY,
+                          'b': rolling.OK,
+                          'bad': rolling.UNHEALTHY,
+                          'c': rolling.SKIPPED,
+                          'd': rolling.SKIPPED})
+        compare(started, ['a', 'sick', 'b', 'bad'])
+
+    def test_failed_action_stops_rollout(self):
+        """
+        test_failed_action_stops_rollout: with no failure budget the first failure stops the rollout
+        """
+        def action(host):
+            if host == 'b':
+                raise Exception('apt-get failed')
+
+        scheduler = rolling.RollingScheduler(max_in_flight=1)
+        compare(scheduler.run(['a', 'b', 'c'], action),
+                {'a': rolling.OK, 'b': rolling.FAILED, 'c': rolling.SKIPPED})
+        compare(scheduler.run([], action), {})
+
+        # A fabric abort fails the host rather than ending the rollout
+        def abort(host):
+            raise SystemExit('Needed to prompt for a sudo password')
+        scheduler = rolling.RollingScheduler(max_in_flight=1, failure_budget=1)
+        compare(scheduler.run(['a', 'b', 'c'], abort),
+                {'a': rolling.FAILED, 'b': rolling.FAILED, 'c': rolling.SKIPPED})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from bootstrap_salt import salt_utils
+
+
+class SaltUtilsTestCase(unittest.TestCase):
+
+    def test_update_args(self):
+        """
+        test_update_args: update options are passed on to salt_utils_update.py
+        """
+        args = salt_utils.get_parser().parse_args(
+            ['-s', 'highstate', '--splay', '30', '--stagger',
+             '--rate-limit', '2.5', '--retries', '3', '--metrics-dir', '/tmp/metrics'])
+        self.assertEqual(salt_utils.get_update_args(args),
+                         ['salt_utils_update.py', '--loglevel', 'info',
+                          '--splay', '30', '--retries', '3',
+                          '--metrics-dir', '/tmp/metrics',
+                          '--stagger', '--rate-limit', '2.5'])
+
+        # Without them the update script's defaults apply
+        args = salt_utils.get_parser().parse_args(['-s', 'highstate'])
+        update_args = salt_utils.get_update_args(args)
+        self.assertNotIn('--rate-limit', update_args)
+        self.assertEqual(update_args[update_args.index('--retries') + 1], '5')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import fcntl
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from bootstrap_salt.salt_utils_lock import SaltUtilsLock
+
+
+class SaltUtilsLockTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.lock_dir = os.path.join(tempfile.mkdtemp(), 'bootstrap-salt')
+
+    def test_record_run(self):
+        """
+        test_record_run: runs recorded under the lock can be read back by later runs
+        """
+        with SaltUtilsLock(lock_dir=self.lock_dir) as lock:
+            self.assertEqual(lock.last_run('update'), None)
+            lock.record_run('update', version='"abc"')
+
+        lock = SaltUtilsLock(lock_dir=self.lock_dir)
+        last_update = lock.last_run('update')
+        self.assertEqual(last_update['version'], '"abc"')
+        self.assertTrue(last_update['started'] <= last_update['finished'])
+        self.assertEqual(os.stat(self.lock_dir).st_mode & 0777, 0700)
+
+    def test_acquire_waits_for_holder(self):
+        """
+        test_acquire_waits_for_holder: a second run blocks until the lock is free
+        """
+        holder = SaltUtilsLock(lock_dir=self.lock_dir)
+        holder.acquire()
+        calls = []
+        real_flock = fcntl.flock
+
+        def flock(fd, operation):
+            calls.append(operation)
+            if operation == fcntl.LOCK_EX:
+                holder.release()
+            return real_flock(fd, operation)
+
+        with patch('fcntl.flock', side_effect=flock):
+            with SaltUtilsLock(lock_dir=self.lock_dir):
+                pass
+        self.assertEqual(calls[:2], [fcntl.LOCK_EX | fcntl.LOCK_NB, fcntl.LOCK_EX])
+
+    def tearDown(self):
+        shutil.rmtree(os.path.dirname(self.lock_dir), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+from bootstrap_salt.salt_utils_metrics import SaltUtilsMetrics
+
+
+class SaltUtilsMetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.textfile_dir = tempfile.mkdtemp()
+
+    def test_write(self):
+        """
+        test_write: phases, gauges and the run outcome are written for node-exporter
+        """
+        metrics = SaltUtilsMetrics('salt_utils_update', self.textfile_dir)
+        with patch('time.time', side_effect=[100.0, 102.5]):
+            with metrics.phase('download'):
+                pass
+        metrics.set('bootstrap_salt_bundle_info', 1, version='abc')
+        with patch('time.time', return_value=200.0):
+            metrics.write(True)
+
+        path = os.path.join(self.textfile_dir, 'bootstrap_salt_salt_utils_update.prom')
+        with open(path) as textfile:
+            lines = textfile.read().splitlines()
+        self.assertIn('# TYPE bootstrap_salt_phase_duration_seconds gauge', lines)
+        self.assertIn('bootstrap_salt_phase_duration_seconds'
+                      '{phase="download",script="salt_utils_update"} 2.5', lines)
+        self.assertIn('bootstrap_salt_bundle_info'
+                      '{script="salt_utils_update",version="abc"} 1.0', lines)
+        self.assertIn('bootstrap_salt_last_run_success{script="salt_utils_update"} 1.0', lines)
+        self.assertIn('bootstrap_salt_last_success_timestamp_seconds'
+                      '{script="salt_utils_update"} 200.0', lines)
+        self.assertEqual(os.listdir(self.textfile_dir), ['bootstrap_salt_salt_utils_update.prom'])
+
+    def test_write_failure_keeps_last_success(self):
+        """
+        test_write_failure_keeps_last_success: a failed run keeps the previous success timestamp
+        """
+        with patch('time.time', return_value=200.0):
+            SaltUtilsMetrics('salt_utils_state', self.textfile_dir).write(True)
+        metrics = SaltUtilsMetrics('salt_utils_state', self.textfile_dir)
+        with patch('time.time', return_value=300.0):
+            metrics.write(False)
+        self.assertEqual(metrics.previous_value('bootstrap_salt_last_success_timestamp_seconds'),
+                         200.0)
+        self.assertEqual(metrics.previous_value('bootstrap_salt_last_run_timestamp_seconds'),
+                         300.0)
+        self.assertEqual(metrics.previous_value('bootstrap_salt_last_run_success'), 0.0)
+
+    def test_reset(self):
+        """
+        test_reset: a reused instance only writes the series from the latest run
+        """
+        metrics = SaltUtilsMetrics('salt_utils_update', self.textfile_dir)
+        metrics.set('bootstrap_salt_bundle_info', 1, version='abc')
+        metrics.write(True)
+        metrics.reset()
+        metrics.set('bootstrap_salt_bundle_info', 1, version='def')
+        metrics.write(True)
+        path = os.path.join(self.textfile_dir, 'bootstrap_salt_salt_utils_update.prom')
+        with open(path) as textfile:
+            text = textfile.read()
+        self.assertIn('version="def"', text)
+        self.assertNotIn('version="abc"', text)
+
+    def test_write_without_collector(self):
+        """
+        test_write_without_collector: nothing is written when node-exporter isn't set up
+        """
+        missing_dir = os.path.join(self.textfile_dir, 'missing')
+        SaltUtilsMetrics('salt_utils', missing_dir).write(True)
+        self.assertFalse(os.path.exists(missing_dir))
+
+    def tearDown(self):
+        shutil.rmtree(self.textfile_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,9 @@
+import os
+import shutil
+from StringIO import StringIO
+import tempfile
 import unittest
-from mock import patch
+from mock import call, patch
 from nose.tools import raises
 from bootstrap_salt.salt_utils_state import SaltUtilsStateWrapper, SaltParserError, SaltStateError
 
@@ -167,6 +171,199 @@ class SaltUtilsStateTestCase(unittest.TestCase):
         salt_utils_state = SaltUtilsStateWrapper()
         salt_utils_state.check_state_result(result)
 
+    @patch('salt.client.Caller')
+    @patch('salt.config')
+    @patch('salt.output')
+    def test_check_state_result_test_mode(self,
+                                          mock_salt_output,
+                                          mock_salt_config,
+                                          mock_salt_client_caller):
+        """
+        test_check_state_result_test_mode: pending changes in a test run are not failures
+        """
+        result = {'state': {'result': None},
+                  'state1': {'result': True}}
+        salt_utils_state = SaltUtilsStateWrapper()
+        self.assertTrue(salt_utils_state.check_state_result(result, test=True))
+        self.assertRaises(SaltStateError,
+                          salt_utils_state.check_state_result,
+                          {'state': {'result': False}}, test=True)
+
+    @patch('salt.client.Caller')
+    @patch('salt.config')
+    @patch('salt.output')
+    def test_run_unchanged(self,
+                           mock_salt_output,
+                           mock_salt_config,
+                           mock_salt_client_caller):
+        """
+        test_run_unchanged: a state is skipped or test run when its inputs have not changed
+        """
+        instance = mock_salt_client_caller.return_value
+        grains = {'id': 'minion'}
+
+        def function(name, *args, **kwargs):
+            if name == 'grains.items':
+                return grains
+            if name == 'pillar.items':
+                return {'admins': {}}
+            return {'state': {'result': True}}
+        instance.function.side_effect = function
+
+        lock_dir = tempfile.mkdtemp()
+        try:
+            with patch('bootstrap_salt.salt_utils_lock.LOCK_DIR', lock_dir), \
+                    patch('bootstrap_salt.salt_utils_state.BUNDLE_FILE', '/nonexistent'):
+                salt_utils_state = SaltUtilsStateWrapper()
+                salt_utils_state.run('highstate', unchanged='skip')
+                salt_utils_state.run('highstate', unchanged='skip')
+                salt_utils_state.run('highstate', unchanged='test')
+                highstates = [c for c in instance.function.call_args_list
+                              if c[0][0] == 'state.highstate']
+                self.assertEqual(highstates, [call('state.highstate'),
+                                              call('state.highstate', test=True)])
+
+                grains['id'] = 'changed'
+                salt_utils_state.run('highstate', unchanged='skip')
+                highstates = [c for c in instance.function.call_args_list
+                              if c[0][0] == 'state.highstate']
+                self.assertEqual(len(highstates), 3)
+        finally:
+            shutil.rmtree(lock_dir)
+
+    @patch('salt.client.Caller')
+    @patch('salt.config')
+    @patch('salt.output')
+    @patch('bootstrap_salt.sls_index.affected_sls')
+    def test_changed_highstate(self,
+                               mock_affected_sls,
+                               mock_salt_output,
+                               mock_salt_config,
+                               mock_salt_client_caller):
+        """
+        test_changed_highstate: only affected states in this minion's top are applied
+        """
+        instance = mock_salt_client_caller.return_value
+        instance.function.side_effect = [{'base': ['nginx', 'users']},
+                                         {'state': {'result': True}}]
+        mock_affected_sls.return_value = set(['nginx', 'nginx.conf', 'mysql'])
+        salt_utils_state = SaltUtilsStateWrapper()
+        self.assertTrue(salt_utils_state.changed_highstate())
+        instance.function.assert_called_with('state.sls', 'nginx')
+
+        # Fall back to a highstate when the index can't tell
+        instance.function.side_effect = None
+        instance.function.return_value = {'state': {'result': True}}
+        mock_affected_sls.return_value = None
+        self.assertTrue(salt_utils_state.changed_highstate())
+        instance.function.assert_called_with('state.highstate')
+
+    @patch('salt.client.Caller')
+    def test_timing_report(self, mock_salt_client_caller):
+        """
+        test_timing_report: durations are summarised per state, per sls and by changes
+        """
+        result = {
+            'pkg_|-nginx_|-nginx_|-installed': {'result': True, 'changes': {'nginx': {}},
+                                                'duration': 900.0, '__sls__': 'nginx',
+                                                '__run_num__': 0},
+            'file_|-conf_|-/etc/nginx.conf_|-managed': {'result': True, 'changes': {},
+                                                        'duration': '100.5 ms', '__sls__': 'nginx',
+                                                        '__run_num__': 1},
+            'user_|-bob_|-bob_|-present': {'result': True, 'changes': {},
+                                           'duration': 50.0, '__sls__': 'users',
+                                           '__run_num__': 2},
+        }
+        salt_utils_state = SaltUtilsStateWrapper(slowest=2)
+        report = salt_utils_state.timing_report(result)
+        self.assertEqual(report['states'], 3)
+        self.assertEqual(report['total'], 1050.5)
+        self.assertEqual(report['changed'], 900.0)
+        self.assertEqual(report['unchanged'], 150.5)
+        self.assertEqual(report['by_sls'], {'nginx': 1000.5, 'users': 50.0})
+        self.assertEqual([s['id'] for s in report['slowest']],
+                         ['pkg_|-nginx_|-nginx_|-installed',
+                          'file_|-conf_|-/etc/nginx.conf_|-managed'])
+
+    @patch('salt.client.Caller')
+    @patch('salt.config')
+    @patch('salt.output')
+    @patch('sys.stdout', new_callable=StringIO)
+    def test_check_state_result_compact(self,
+                                        mock_stdout,
+                                        mock_salt_output,
+                                        mock_salt_config,
+                                        mock_salt_client_caller):
+        """
+        test_check_state_result_compact: compact output lists only failures and changes
+        """
+        result = {
+            'pkg_|-nginx_|-nginx_|-installed': {'result': True, 'changes': {'nginx': {}},
+                                                '__sls__': 'nginx'},
+            'file_|-conf_|-/etc/nginx.conf_|-managed': {'result': True, 'changes': {},
+                                                        '__sls__': 'nginx'},
+            'user_|-bob_|-bob_|-present': {'result': False, 'changes': {},
+                                           'comment': 'No such group', '__sls__': 'users'},
+        }
+        salt_utils_state = SaltUtilsStateWrapper(output='compact')
+        with patch.object(salt_utils_state, 'log_timing_report') as mock_log_timing_report, \
+                patch.object(salt_utils_state, 'timing_report') as mock_timing_report:
+            self.assertRaises(SaltStateError, salt_utils_state.check_state_result, result)
+        # The timing report is built in the same pass as the check
+        self.assertFalse(mock_timing_report.called)
+        report = mock_log_timing_report.call_args[0][0]
+        self.assertEqual(report['states'], 3)
+        self.assertEqual(report['failed'],
+                         [{'id': 'user_|-bob_|-bob_|-present', 'sls': 'users',
+                           'comment': 'No such group'}])
+        self.assertFalse(mock_salt_output.display_output.called)
+        self.assertEqual(sorted(mock_stdout.getvalue().splitlines()),
+                         ['Changed: pkg.installed: nginx (nginx): nginx',
+                          'Failed:  user.present: bob (users): No such group',
+                          'Summary: 3 states, 1 changed, 1 failed'])
+        samples = salt_utils_state.metrics.samples
+        self.assertEqual(samples[('bootstrap_salt_states', (('script', 'salt_utils_state'),
+                                                            ('status', 'failed')))], 1)
+
+    @patch('salt.client.Caller')
+    @patch('salt.config')
+    @patch('salt.output')
+    @patch('bootstrap_salt.sls_index.independent_groups')
+    def test_state_multiple_concurrent(self,
+                                       mock_independent_groups,
+                                       mock_salt_output,
+                                       mock_salt_config,
+                                       mock_salt_client_caller):
+        """
+        test_state_multiple_concurrent: independent groups run concurrently and their results are merged
+        """
+        instance = mock_salt_client_caller.return_value
+
+        def function(name, sls, **kwargs):
+            return {'{0}_state'.format(sls): {'result': sls != 'bad',
+                                              'pid': os.getpid(),
+                                              'kwargs': kwargs}}
+        instance.function.side_effect = function
+        mock_independent_groups.return_value = [['nginx'], ['users']]
+
+        salt_utils_state = SaltUtilsStateWrapper()
+        self.assertTrue(salt_utils_state.state('nginx,users', concurrent=True))
+        # Each group runs in a worker process with its own caller
+        results = salt_utils_state.concurrent_sls(['nginx', 'users'], test=True)
+        self.assertEqual(sorted(results.keys()), ['nginx_state', 'users_state'])
+        for result in results.values():
+            self.assertNotEqual(result['pid'], os.getpid())
+            self.assertEqual(result['kwargs'], {'concurrent': True, 'test': True})
+        self.assertFalse(instance.function.called)
+
+        mock_independent_groups.return_value = [['nginx'], ['bad']]
+        self.assertRaises(SaltStateError, salt_utils_state.state, 'nginx,bad', concurrent=True)
+
+        # Without --concurrent everything goes in one call
+        instance.function.reset_mock()
+        self.assertTrue(salt_utils_state.state('nginx,users'))
+        instance.function.assert_called_once_with('state.sls', 'nginx,users')
+
     def tearDown(self):
         pass
 
@@ -1,4 +1,8 @@
+import os
+import shutil
+import tempfile
 import unittest
+from boto.exception import BotoServerError
 from mock import call, MagicMock, patch
 from bootstrap_salt.salt_utils_update import SaltUtilsUpdateWrapper
 
@@ -69,6 +73,155 @@ class SaltUtilsUpdateTestCase(unittest.TestCase):
                                  expected_method_calls)
                          )
 
+    @patch('salt.client.Caller')
+    @patch('bootstrap_salt.salt_utils_update.SaltUtilsUpdateWrapper.get_applied_version')
+    @patch('bootstrap_salt.salt_utils_update.SaltUtilsUpdateWrapper.get_remote_bundle')
+    def test_is_update_available(self,
+                                 mock_get_remote_bundle,
+                                 mock_get_applied_version,
+                                 mock_salt_client_caller):
+        """
+        test_is_update_available: a new bundle is only reported when its etag differs
+        """
+        mock_get_remote_bundle.return_value = MagicMock(etag='"abc"')
+        mock_get_applied_version.return_value = '"abc"'
+        salt_utils_update = SaltUtilsUpdateWrapper()
+        self.assertFalse(salt_utils_update.is_update_available())
+
+        mock_get_applied_version.return_value = '"old"'
+        self.assertTrue(salt_utils_update.is_update_available())
+
+        mock_get_remote_bundle.return_value = None
+        self.assertFalse(salt_utils_update.is_update_available())
+
+    @patch('salt.client.Caller')
+    @patch('boto.kms.connect_to_region')
+    @patch('boto.s3.connect_to_region')
+    def test_get_data_key_is_cached(self,
+                                    mock_s3_connect,
+                                    mock_kms_connect,
+                                    mock_salt_client_caller):
+        """
+        test_get_data_key_is_cached: KMS is only asked to decrypt the data key once per process
+        """
+        instance = mock_salt_client_caller.return_value
+        instance.function.return_value = MagicMock()
+        kms = mock_kms_connect.return_value
+        kms.decrypt.return_value = {'Plaintext': 'plaintext-key'}
+        key_file = tempfile.NamedTemporaryFile()
+        key_file.write('encrypted-key')
+        key_file.flush()
+
+        salt_utils_update = SaltUtilsUpdateWrapper(key_cache_ttl=0)
+        self.assertEqual(salt_utils_update.get_data_key(key_file.name), 'plaintext-key')
+        self.assertEqual(salt_utils_update.get_data_key(key_file.name), 'plaintext-key')
+        kms.decrypt.assert_called_once_with('encrypted-key')
+        self.assertEqual(mock_s3_connect.call_count, 1)
+
+    @patch('salt.client.Caller')
+    @patch('boto.kms.connect_to_region')
+    @patch('boto.s3.connect_to_region')
+    def test_get_data_key_tmpfs_cache(self,
+                                      mock_s3_connect,
+                                      mock_kms_connect,
+                                      mock_salt_client_caller):
+        """
+        test_get_data_key_tmpfs_cache: the cached key is shared between runs and invalidated when the encrypted key changes
+        """
+        instance = mock_salt_client_caller.return_value
+        instance.function.return_value = MagicMock()
+        kms = mock_kms_connect.return_value
+        kms.decrypt.return_value = {'Plaintext': 'plaintext-key'}
+        cache_dir = tempfile.mkdtemp()
+        cache_file = os.path.join(cache_dir, 'run', 'salt.key')
+        key_file = tempfile.NamedTemporaryFile()
+        key_file.write('encrypted-key')
+        key_file.flush()
+
+        try:
+            with patch('bootstrap_salt.salt_utils_update.DATA_KEY_CACHE_FILE', cache_file):
+                SaltUtilsUpdateWrapper().get_data_key(key_file.name)
+                self.assertEqual(os.stat(cache_file).st_mode & 0777, 0600)
+                self.assertEqual(os.stat(os.path.dirname(cache_file)).st_mode & 0777, 0700)
+
+                # A second run uses the cached key
+                self.assertEqual(SaltUtilsUpdateWrapper().get_data_key(key_file.name), 'plaintext-key')
+                self.assertEqual(kms.decrypt.call_count, 1)
+
+                # A new encrypted key invalidates the cache
+                key_file.write('-rotated')
+                key_file.flush()
+                SaltUtilsUpdateWrapper().get_data_key(key_file.name)
+                self.assertEqual(kms.decrypt.call_count, 2)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    @patch('salt.client.Caller')
+    def test_get_splay_delay_staggered(self, mock_salt_client_caller):
+        """
+        test_get_splay_delay_staggered: staggered delays are stable per instance and inside the window
+        """
+        instance = mock_salt_client_caller.return_value
+        instance.function.return_value = {'aws_instance_id': 'i-12345678'}
+
+        salt_utils_update = SaltUtilsUpdateWrapper(splay=120, stagger=True)
+        delay = salt_utils_update.get_splay_delay()
+        self.assertTrue(0 <= delay < 120)
+        self.assertEqual(delay, salt_utils_update.get_splay_delay())
+
+        self.assertEqual(SaltUtilsUpdateWrapper().get_splay_delay(), 0)
+
+    @patch('time.sleep')
+    @patch('salt.client.Caller')
+    def test_call_aws_retries_throttling(self, mock_salt_client_caller, mock_sleep):
+        """
+        test_call_aws_retries_throttling: throttled calls are retried, other errors are raised
+        """
+        func = MagicMock(__name__='decrypt')
+        func.side_effect = [BotoServerError(400, 'Bad Request', body={'Error': {'Code': 'Throttling'}}),
+                            BotoServerError(503, 'Slow Down'),
+                            'ok']
+        salt_utils_update = SaltUtilsUpdateWrapper(retries=2)
+        self.assertEqual(salt_utils_update.call_aws(func, 'blob'), 'ok')
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(mock_sleep.call_count, 2)
+
+        func.reset_mock()
+        func.side_effect = BotoServerError(403, 'Forbidden')
+        self.assertRaises(BotoServerError, salt_utils_update.call_aws, func, 'blob')
+        self.assertEqual(func.call_count, 1)
+
+    @patch('salt.client.Caller')
+    @patch('bootstrap_salt.salt_utils_update.SaltUtilsUpdateWrapper.is_update_available')
+    @patch('bootstrap_salt.salt_utils_update.SaltUtilsUpdateWrapper.sync_remote_salt_data')
+    def test_update_coalesces(self,
+                              mock_sync_remote_salt_data,
+                              mock_is_update_available,
+                              mock_salt_client_caller):
+        """
+        test_update_coalesces: an update that finished while waiting for the lock is reused if still current
+        """
+        mock_is_update_available.return_value = False
+        lock_dir = tempfile.mkdtemp()
+        try:
+            with patch('bootstrap_salt.salt_utils_lock.LOCK_DIR', lock_dir):
+                salt_utils_update = SaltUtilsUpdateWrapper()
+                salt_utils_update.update()
+                self.assertEqual(mock_sync_remote_salt_data.call_count, 1)
+
+                # Pretend the previous update finished after this request
+                with patch('time.time', return_value=0):
+                    salt_utils_update.update()
+                self.assertEqual(mock_sync_remote_salt_data.call_count, 1)
+
+                # ...unless a newer bundle has been uploaded since
+                mock_is_update_available.return_value = True
+                with patch('time.time', return_value=0):
+                    salt_utils_update.update()
+                self.assertEqual(mock_sync_remote_salt_data.call_count, 2)
+        finally:
+            shutil.rmtree(lock_dir)
+
     def tearDown(self):
         pass
 
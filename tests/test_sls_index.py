@@ -0,0 +1,116 @@
+import copy
+import os
+import shutil
+import tempfile
+import unittest
+
+from bootstrap_salt import sls_index
+
+
+class TestSlsIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.bundle_root = tempfile.mkdtemp()
+        self.write('srv/salt/top.sls', "base:\n  '*':\n    - web\n")
+        self.write('srv/salt/web.sls',
+                   "include:\n  - nginx\n\napp:\n  pkg.installed:\n    - require:\n      - sls: users\n")
+        self.write('srv/salt/users.sls', "{% for user in pillar.get('admins', {}) %}\n{% endfor %}\n")
+        self.write('srv/salt-formulas/nginx/init.sls',
+                   "include:\n  - .conf\n\nnginx:\n  pkg.installed\n")
+        self.write('srv/salt-formulas/nginx/conf.sls',
+                   "/etc/nginx/nginx.conf:\n  file.managed:\n    - source: salt://nginx/files/nginx.conf\n")
+        self.write('srv/salt-formulas/nginx/files/nginx.conf', "workers {{ pillar['nginx']['workers'] }}\n")
+        self.write('srv/salt-formulas/nginx/files/unused.conf', "\n")
+        self.write('srv/pillar/top.sls', "base:\n  '*':\n    - nginx\n")
+        self.write('srv/pillar/nginx.sls', "nginx:\n  workers: 4\n")
+        self.write('srv/pillar/admins.sls', "admins:\n  bob: {}\n")
+        self.old_index = self.build()
+
+    def write(self, path, content):
+        path = os.path.join(self.bundle_root, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as handle:
+            handle.write(content)
+
+    def build(self):
+        return sls_index.build_index(self.bundle_root,
+                                     state_roots=['/srv/salt', '/srv/salt-formulas/'],
+                                     pillar_root='/srv/pillar')
+
+    def test_build_index(self):
+        sls = self.old_index['sls']
+        self.assertEqual(sorted(sls.keys()), ['nginx', 'nginx.conf', 'users', 'web'])
+        self.assertEqual(sls['web']['depends'], ['nginx', 'users'])
+        self.assertEqual(sls['nginx']['depends'], ['nginx.conf'])
+        self.assertEqual(sls['nginx.conf']['pillar_keys'], ['nginx'])
+        self.assertEqual(sls['users']['pillar_keys'], ['admins'])
+        self.assertEqual(self.old_index['references']['/srv/salt-formulas/nginx/files/nginx.conf'],
+                         ['nginx.conf'])
+        self.assertEqual(self.old_index['pillar']['/srv/pillar/nginx.sls'], ['nginx'])
+
+    def test_affected_sls_for_template_and_pillar(self):
+        self.write('srv/salt-formulas/nginx/files/nginx.conf', "workers 8\n")
+        self.assertEqual(sls_index.affected_sls(self.old_index, self.build()),
+                         set(['nginx.conf', 'nginx', 'web']))
+
+        index = self.build()
+        self.write('srv/pillar/admins.sls', "admins:\n  alice: {}\n")
+        self.assertEqual(sls_index.affected_sls(index, self.build()),
+                         set(['users', 'web']))
+
+    def test_affected_sls_undecidable(self):
+        self.assertEqual(sls_index.affected_sls(None, self.old_index), None)
+
+        self.write('srv/salt-formulas/nginx/files/unused.conf', "changed\n")
+        self.assertEqual(sls_index.affected_sls(self.old_index, self.build()), None)
+
+        new_index = copy.deepcopy(self.old_index)
+        new_index['files']['/srv/pillar/top.sls'] = 'changed'
+        self.assertEqual(sls_index.affected_sls(self.old_index, new_index), None)
+
+        self.write('srv/pillar/nginx.sls', "{% if grains['id'] %}\nnginx:\n  workers: 4\n{% endif %}\n")
+        self.assertEqual(sls_index.affected_sls(self.old_index, self.build()), None)
+
+    def test_affected_sls_for_pillar_attribute(self):
+        self.write('srv/salt/users.sls', "{% for user in pillar.admins %}\n{% endfor %}\n")
+        index = self.build()
+        self.assertEqual(index['sls']['users']['pillar_keys'], ['admins'])
+        self.assertFalse(index['sls']['users']['dynamic'])
+        self.write('srv/pillar/admins.sls', "admins:\n  alice: {}\n")
+        self.assertEqual(sls_index.affected_sls(index, self.build()),
+                         set(['users', 'web']))
+
+    def test_affected_sls_for_dynamic_pillar_keys(self):
+        for text in ["{% for key, value in pillar.items() %}\n{% endfor %}\n",
+                     "{% set name = 'admins' %}\n{{ salt['pillar.get'](name) }}\n",
+                     "{{ salt['pillar.items']() }}\n"]:
+            self.write('srv/salt/users.sls', text)
+            index = self.build()
+            self.assertTrue(index['sls']['users']['dynamic'])
+            self.write('srv/pillar/admins.sls', "admins:\n  alice: {}\n")
+            self.assertEqual(sls_index.affected_sls(index, self.build()), None)
+
+        # The same goes for a template an SLS renders
+        self.write('srv/salt/users.sls', "users:\n  pkg.installed\n")
+        self.write('srv/salt-formulas/nginx/files/nginx.conf', "workers {{ pillar.get(key) }}\n")
+        index = self.build()
+        self.assertTrue(index['sls']['nginx.conf']['dynamic'])
+        self.assertEqual(sls_index.affected_sls(self.old_index, index), None)
+
+    def test_independent_groups(self):
+        self.write('srv/salt/mysql.sls', "mysql:\n  service.running\n")
+        self.write('srv/salt/redis.sls', "redis:\n  pkg:\n    - installed\n")
+        index = self.build()
+        self.assertEqual(sls_index.independent_groups(index, ['nginx', 'mysql', 'web']),
+                         [['mysql'], ['nginx', 'web']])
+        # Only one group may install packages at a time
+        self.assertEqual(sls_index.independent_groups(index, ['redis', 'mysql', 'nginx']),
+                         [['mysql'], ['redis', 'nginx']])
+        self.assertEqual(sls_index.independent_groups(index, ['nginx', 'unknown']),
+                         [['nginx', 'unknown']])
+        self.assertEqual(sls_index.independent_groups(None, ['nginx', 'mysql']),
+                         [['nginx', 'mysql']])
+
+    def tearDown(self):
+        shutil.rmtree(self.bundle_root)
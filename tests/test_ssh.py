@@ -0,0 +1,248 @@
+import socket
+import subprocess
+import unittest
+
+import mock
+from mock import patch
+
+from testfixtures import compare
+
+from bootstrap_salt import errors, ssh
+
+
+def fake_client(active=True):
+    client = mock.Mock(name='SSHClient')
+    client.get_transport.return_value.is_active.return_value = active
+    return client
+
+
+class SSHConnectionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.connections = {}
+        patcher = patch('bootstrap_salt.ssh.connections', self.connections)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.pool = ssh.SSHConnectionPool(idle_timeout=60)
+
+    @patch('bootstrap_salt.ssh.network.connect')
+    def test_get_reuses_connection(self, mock_connect):
+        """
+        test_get_reuses_connection: one session per user@host is shared between tasks
+        """
+        mock_connect.return_value = fake_client()
+        conn = self.pool.get('ubuntu@1.1.1.1')
+        compare(conn.host_string, 'ubuntu@1.1.1.1:22')
+        self.assertIs(self.pool.get('ubuntu@1.1.1.1:22'), conn)
+        self.assertIs(self.connections['ubuntu@1.1.1.1:22'], conn.client)
+        compare(mock_connect.call_count, 1)
+
+        self.pool.get('ubuntu@2.2.2.2')
+        compare(mock_connect.call_count, 2)
+
+    @patch('bootstrap_salt.ssh.network.connect')
+    def test_get_replaces_dead_connection(self, mock_connect):
+        """
+        test_get_replaces_dead_connection: sessions that fail the health check are reopened
+        """
+        dead, alive = fake_client(), fake_client()
+        mock_connect.side_effect = [dead, alive]
+        self.pool.get('ubuntu@1.1.1.1')
+        dead.get_transport.return_value.is_active.return_value = False
+        conn = self.pool.get('ubuntu@1.1.1.1')
+        self.assertIs(conn.client, alive)
+        self.assertTrue(dead.close.called)
+
+    @patch('time.time')
+    @patch('bootstrap_salt.ssh.network.connect')
+    def test_idle_eviction(self, mock_connect, mock_time):
+        """
+        test_idle_eviction: sessions unused for longer than the idle timeout are closed
+        """
+        idle, fresh = fake_client(), fake_client()
+        mock_connect.side_effect = [idle, fresh]
+        mock_time.return_value = 100.0
+        self.pool.get('ubuntu@1.1.1.1')
+        mock_time.return_value = 200.0
+        conn = self.pool.get('ubuntu@1.1.1.1')
+        self.assertTrue(idle.close.called)
+        self.assertIs(conn.client, fresh)
+
+    @patch('time.time')
+    @patch('bootstrap_salt.ssh.network.connect')
+    def test_busy_connection_not_evicted(self, mock_connect, mock_time):
+        """
+        test_busy_connection_not_evicted: a session running a long command isn't closed as idle
+        """
+        client = fake_client()
+        mock_connect.return_value = client
+        mock_time.return_value = 100.0
+        conn = self.pool.get('ubuntu@1.1.1.1')
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv_exit_status.return_value = 0
+
+        def recv(size):
+            # Another task asks for the host while the command is running
+            mock_time.return_value = 1000.0
+            self.assertIs(self.pool.get('ubuntu@1.1.1.1'), conn)
+            channel.recv.side_effect = ['']
+            return 'highstate done'
+        channel.recv.side_effect = recv
+        compare(conn.run('salt-call state.highstate'), 'highstate done')
+        self.assertFalse(client.close.called)
+        compare(conn.in_use, 0)
+
+    @patch('os.getpid')
+    @patch('bootstrap_salt.ssh.network.connect')
+    def test_forked_process_starts_empty(self, mock_connect, mock_getpid):
+        """
+        test_forked_process_starts_empty: a forked task doesn't use or close its parent's sessions
+        """
+        parent = fake_client()
+        mock_connect.return_value = parent
+        mock_getpid.return_value = 1
+        pool = ssh.SSHConnectionPool()
+        pool.get('ubuntu@1.1.1.1')
+        self.connections.clear()
+        mock_getpid.return_value = 2
+        mock_connect.return_value = fake_client()
+        self.assertIsNot(pool.get('ubuntu@1.1.1.1').client, parent)
+        self.assertFalse(parent.close.called)
+
+    def test_run(self):
+        """
+        test_run: commands run on their own channel and failures raise unless warn_only is set
+        """
+        client = fake_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv.side_effect = ['{"local": ', '{}}\n', '']
+        channel.recv_exit_status.return_value = 0
+        conn = ssh.PooledConnection('ubuntu@1.1.1.1:22', client)
+        result = conn.sudo('salt-call pillar.get admins --out=json')
+        compare(result, '{"local": {}}')
+        self.assertTrue(result.succeeded)
+        channel.exec_command.assert_called_once_with('sudo -n -H salt-call pillar.get admins --out=json')
+
+        channel.recv.side_effect = ['\x00key\n', '']
+        compare(conn.read_file('/etc/salt.key.enc', use_sudo=True), '\x00key\n')
+
+        channel.recv.side_effect = ['No such file\n', '']
+        channel.recv_exit_status.return_value = 1
+        self.assertRaises(errors.RemoteCommandError, conn.read_file, '/missing')
+        channel.recv.side_effect = ['No such file\n', '']
+        self.assertTrue(conn.run('cat /missing', warn_only=True).failed)
+
+    def test_run_sudo_password(self):
+        """
+        test_run_sudo_password: fabric's password is given to sudo only when it asks for one
+        """
+        client = fake_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv_exit_status.return_value = 0
+        conn = ssh.PooledConnection('deploy@1.1.1.1:22', client)
+        with patch.dict(ssh.env, {'password': 'secret', 'passwords': {}}):
+            channel.recv.side_effect = [ssh.SUDO_PROMPT, 'root\n', '']
+            compare(conn.sudo('whoami'), 'root')
+            channel.exec_command.assert_called_with(
+                "sudo -S -p 'bootstrap-salt sudo password:' -H whoami")
+            channel.sendall.assert_called_once_with('secret\n')
+            self.assertTrue(channel.shutdown_write.called)
+
+            # With NOPASSWD sudo doesn't prompt and nothing is sent
+            channel.sendall.reset_mock()
+            channel.recv.side_effect = ['root\n', 'more\n', '']
+            compare(conn.sudo('whoami'), 'root\nmore')
+            self.assertFalse(channel.sendall.called)
+
+            # The per-host password wins, as it does in fabric
+            ssh.env.passwords['deploy@1.1.1.1:22'] = 'host-secret'
+            channel.recv.side_effect = [ssh.SUDO_PROMPT, '', '']
+            conn.sudo('whoami')
+            channel.sendall.assert_called_once_with('host-secret\n')
+
+
+def local_client():
+    """An SSHClient whose commands run in a local shell"""
+    client = fake_client()
+    channel = client.get_transport.return_value.open_session.return_value
+
+    def exec_command(command):
+        process = subprocess.Popen('exec ' + command, shell=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        channel.recv.side_effect = [output, '']
+        # Like paramiko, -1 if the command was killed and sent no exit status
+        channel.recv_exit_status.return_value = max(process.returncode, -1)
+    channel.exec_command.side_effect = exec_command
+    return client
+
+
+class RunBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.conn = ssh.PooledConnection('ubuntu@1.1.1.1:22', local_client())
+
+    def test_run_batch(self):
+        """
+        test_run_batch: commands run in one exec and each has its own output and exit code
+        """
+        results = self.conn.run_batch(["echo 'sync modules'; echo done",
+                                       "printf 'no newline'",
+                                       "echo users >&2"])
+        compare(results, ['sync modules\ndone', 'no newline', 'users'])
+        compare([result.return_code for result in results], [0, 0, 0])
+        channel = self.conn.client.get_transport.return_value.open_session.return_value
+        compare(channel.exec_command.call_count, 1)
+
+    def test_run_batch_failure(self):
+        """
+        test_run_batch_failure: a failed command stops the batch and raises unless warn_only is set
+        """
+        commands = ['echo ok', 'echo broken; exit 3', 'echo never']
+        with self.assertRaises(errors.RemoteCommandError) as raised:
+            self.conn.run_batch(commands)
+        compare(raised.exception.command, 'echo broken; exit 3')
+        compare(raised.exception.return_code, 3)
+
+        results = self.conn.run_batch(commands, warn_only=True)
+        compare([(result, result.return_code) for result in results],
+                [('ok', 0), ('broken', 3)])
+
+        results = self.conn.run_batch(commands, warn_only=True, stop_on_error=False)
+        compare([result.return_code for result in results], [0, 3, 0])
+
+    def test_run_batch_interrupted(self):
+        """
+        test_run_batch_interrupted: a command that never finishes, like a reboot, has no exit code
+        """
+        results = self.conn.run_batch(['echo upgraded', 'echo rebooting; kill -9 $$'],
+                                      warn_only=True)
+        compare([(result, result.return_code) for result in results],
+                [('upgraded', 0), ('rebooting', None)])
+
+    @patch('uuid.uuid4')
+    def test_run_batch_timeout(self, mock_uuid4):
+        """
+        test_run_batch_timeout: a command that stops answering, like a host going down, is treated as unfinished
+        """
+        mock_uuid4.return_value.hex = 'm'
+        client = fake_client()
+        channel = client.get_transport.return_value.open_session.return_value
+        channel.recv.side_effect = ['bootstrap-salt-batch-m start 0\nupgraded\n'
+                                    '\nbootstrap-salt-batch-m end 0 0\n'
+                                    'bootstrap-salt-batch-m start 1\nrebooting\n',
+                                    socket.timeout()]
+        conn = ssh.PooledConnection('ubuntu@1.1.1.1:22', client)
+        results = conn.run_batch(['upgrade', 'reboot'], warn_only=True, timeout=30)
+        compare([(result, result.return_code) for result in results],
+                [('upgraded', 0), ('rebooting', None)])
+        channel.settimeout.assert_called_once_with(30)
+        self.assertFalse(channel.recv_exit_status.called)
+
+        # A single command still raises
+        channel.recv.side_effect = socket.timeout()
+        self.assertRaises(socket.timeout, conn.run, 'upgrade', timeout=30)
+
+
+if __name__ == '__main__':
+    unittest.main()
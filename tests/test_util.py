@@ -1,9 +1,13 @@
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
 
-from bootstrap_salt import utils
+from mock import patch
+
+from bootstrap_salt import errors, utils
 
 
 class TestUtils(unittest.TestCase):
@@ -41,3 +45,101 @@ class TestUtils(unittest.TestCase):
         finally:
             shutil.rmtree(tmp_src_folder, ignore_errors=True)
             shutil.rmtree(tmp_dst_folder, ignore_errors=True)
+
+    def test_run_concurrently(self):
+        def square(x):
+            if x == 3:
+                raise ValueError('bad item')
+            return x * x
+
+        results = utils.run_concurrently(square, [1, 2, 3, 4], pool_size=2)
+        self.assertEqual(sorted(results.keys()), [1, 2, 3, 4])
+        self.assertEqual(results[2], 4)
+        self.assertTrue(isinstance(results[3], ValueError))
+
+        # Stopping early skips the calls that haven't started yet
+        results = utils.run_concurrently(square, range(100), pool_size=1,
+                                         stop=lambda item, result: item == 0)
+        self.assertEqual(results, {0: 0})
+
+        # A fabric abort is a result, it doesn't leave the pool waiting
+        def abort(x):
+            raise SystemExit(1)
+        results = utils.run_concurrently(abort, ['a', 'b'])
+        self.assertTrue(isinstance(results['a'], SystemExit))
+
+        # Only calls that had started are made, and they are waited for
+        called = []
+
+        def record(x):
+            called.append(x)
+            return x
+        results = utils.run_concurrently(record, range(100), pool_size=4,
+                                         stop=lambda item, result: True)
+        self.assertEqual(sorted(results), sorted(called))
+        self.assertTrue(len(called) <= 4)
+
+        # A call that hangs is given up on and the next item started
+        hang = threading.Event()
+        self.addCleanup(hang.set)
+
+        def wait(x):
+            if x == 'hung':
+                hang.wait(10)
+            return x
+        started = time.time()
+        results = utils.run_concurrently(wait, ['hung', 'a'], pool_size=1,
+                                         timeout=0.2)
+        self.assertLess(time.time() - started, 5)
+        self.assertTrue(isinstance(results['hung'], errors.HostTimeoutError))
+        self.assertEqual(results['a'], 'a')
+
+    @patch('time.sleep')
+    @patch('bootstrap_salt.utils.monotonic')
+    def test_poller_deadline(self, mock_clock, mock_sleep):
+        # Each check takes 2 seconds, which counts towards the deadline
+        clock = [0.0]
+        mock_clock.side_effect = lambda: clock[0]
+        mock_sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+        attempts = []
+
+        def check():
+            clock[0] += 2
+            return False
+
+        poller = utils.Poller(30, 4, backoff=2, max_interval=10,
+                              first_interval=1,
+                              on_attempt=lambda *args: attempts.append(args))
+        self.assertRaises(errors.CfnTimeoutError, poller.run, check)
+        # A quick first retry, then backoff up to max_interval, and the
+        # last wait is cut short to make a final check at the deadline
+        self.assertEqual([call[0][0] for call in mock_sleep.call_args_list],
+                         [1, 4, 8, 9])
+        self.assertEqual([(attempt, elapsed, duration)
+                          for attempt, elapsed, duration, _ in attempts],
+                         [(1, 2, 2), (2, 5, 2), (3, 11, 2), (4, 21, 2), (5, 32, 2)])
+        self.assertEqual(clock[0], 32)
+
+    @patch('time.sleep')
+    def test_poller_jitter(self, mock_sleep):
+        results = iter([False] * 20 + ['done'])
+        poller = utils.Poller(600, 10, jitter=0.5)
+        self.assertEqual(poller.run(lambda: next(results)), 'done')
+        delays = [call[0][0] for call in mock_sleep.call_args_list]
+        self.assertTrue(all(5 <= delay <= 15 for delay in delays))
+        self.assertTrue(len(set(delays)) > 1)
+
+    def test_timeout_async(self):
+        results = iter([False, False, 'done'])
+
+        @utils.timeout_async(5, 0.01)
+        def check():
+            return next(results)
+        self.assertEqual(check().result(), 'done')
+
+        @utils.timeout_async(0.05, 0.01)
+        def never():
+            return False
+        poll = never()
+        self.assertRaises(errors.CfnTimeoutError, poll.result)
+        self.assertTrue(poll.done())